@@ -0,0 +1,98 @@
+import math
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+# Rolling windows are answered from hourly buckets, so the longest window bounds the work
+BUCKET_SECONDS = 3600
+MAX_WINDOW = timedelta(days=7)
+
+
+@dataclass
+class WindowStats:
+    total: int = 0
+    detections: int = 0
+    confidence_sum: float = 0.0
+
+    @property
+    def mean_confidence(self) -> float:
+        return self.confidence_sum / self.total if self.total else 0.0
+
+
+@dataclass
+class AnalysisStats:
+    """Running totals over analysis results, updated in O(1) per result."""
+
+    total: int = 0
+    detections: int = 0
+    confidence_sum: float = 0.0
+    confidence_sq_sum: float = 0.0
+    by_disease: Counter = field(default_factory=Counter)
+    by_risk: Counter = field(default_factory=Counter)
+    by_day: Counter = field(default_factory=Counter)
+    _buckets: Dict[int, WindowStats] = field(default_factory=dict, repr=False)
+
+    def add(self, result: dict):
+        confidence = result.get('confidence', 0.0)
+        has_detection = bool(result.get('has_detection'))
+        timestamp = result['timestamp']
+
+        self.total += 1
+        self.detections += has_detection
+        self.confidence_sum += confidence
+        self.confidence_sq_sum += confidence * confidence
+        self.by_disease[result.get('detected_disease') or 'Normal'] += 1
+        self.by_risk[result.get('risk_level', 'N/A')] += 1
+        self.by_day[timestamp.date().isoformat()] += 1
+
+        key = _bucket(timestamp)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = WindowStats()
+            self._expire(key)
+        bucket.total += 1
+        bucket.detections += has_detection
+        bucket.confidence_sum += confidence
+
+    def clear(self):
+        self.__init__()
+
+    @property
+    def normal(self) -> int:
+        return self.total - self.detections
+
+    @property
+    def mean_confidence(self) -> float:
+        return self.confidence_sum / self.total if self.total else 0.0
+
+    @property
+    def std_confidence(self) -> float:
+        if self.total < 2:
+            return 0.0
+        variance = (self.confidence_sq_sum - self.confidence_sum ** 2 / self.total) / (self.total - 1)
+        return math.sqrt(max(variance, 0.0))
+
+    def window(self, span: timedelta, now: Optional[datetime] = None) -> WindowStats:
+        """Totals for results in the last ``span`` (at most seven days, hourly resolution)."""
+        span = min(span, MAX_WINDOW)
+        newest = _bucket(now or datetime.now())
+        oldest = newest - int(span.total_seconds() // BUCKET_SECONDS) + 1
+        stats = WindowStats()
+        for key in range(oldest, newest + 1):
+            bucket = self._buckets.get(key)
+            if bucket:
+                stats.total += bucket.total
+                stats.detections += bucket.detections
+                stats.confidence_sum += bucket.confidence_sum
+        return stats
+
+    def _expire(self, newest: int):
+        # Runs once per new bucket, i.e. at most once an hour
+        cutoff = newest - int(MAX_WINDOW.total_seconds() // BUCKET_SECONDS)
+        for key in [k for k in self._buckets if k <= cutoff]:
+            del self._buckets[key]
+
+
+def _bucket(timestamp: datetime) -> int:
+    return int(timestamp.timestamp() // BUCKET_SECONDS)
@@ -0,0 +1,247 @@
+# Analysis history as a date-partitioned Parquet dataset, for cohort statistics.
+#
+# Exports are incremental: each run appends the analyses added since the last
+# one (tracked by id in the export_watermarks table) as one file per day it
+# touches. Queries read only the partitions and columns they need and
+# aggregate with Arrow compute kernels, so no Python object is built per row.
+#
+#   python analytics.py            # export what is new
+#   python analytics.py --compact  # also merge every past day into one file
+import os
+import shutil
+import tempfile
+import threading
+from datetime import date, datetime
+from typing import List, Optional, Sequence
+
+import config
+from storage import Database, Repository
+
+EXPORT_BATCH = 100_000
+DIMENSIONS = ("month", "diagnosis", "eye")
+CALIBRATION_BIN_WIDTH = 10
+WATERMARK = "analyses"
+
+
+def schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("id", pa.int64()),
+        ("patient_id", pa.string()),
+        ("eye", pa.dictionary(pa.int8(), pa.string())),
+        # Free text (Submit Analysis and the API take any label), so the index needs room for many values
+        ("diagnosis", pa.dictionary(pa.int32(), pa.string())),
+        ("confidence", pa.float32()),
+        ("has_detection", pa.bool_()),
+        ("high_risk", pa.bool_()),
+        ("created_at", pa.timestamp("us")),
+    ])
+
+
+def partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+
+
+class AnalyticsExporter(Repository):
+    def __init__(self, db: Database, root: str = config.ANALYTICS_DIR):
+        super().__init__(db.pool)
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def watermark(self) -> int:
+        with self.reader() as conn:
+            row = conn.execute("SELECT last_id FROM export_watermarks WHERE name = ?", (WATERMARK,)).fetchone()
+        return row["last_id"] if row else 0
+
+    def export_new(self) -> int:
+        """Append analyses added since the last export; returns how many were written."""
+        total, touched = 0, set()
+        while True:
+            written, days = self._export_batch()
+            total += written
+            touched.update(days)
+            if written < EXPORT_BATCH:
+                break
+        # Today's partition keeps growing, so it is left for a later run to merge
+        today = date.today().isoformat()
+        for day in sorted(touched):
+            if day < today:
+                self.compact(day)
+        return total
+
+    def _export_batch(self):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        from trends import is_high_risk
+
+        with self.reader() as conn:
+            row = conn.execute("SELECT last_id FROM export_watermarks WHERE name = ?", (WATERMARK,)).fetchone()
+            rows = conn.execute(
+                "SELECT id, patient_id, eye, diagnosis, confidence, created_at FROM analyses "
+                "WHERE id > ? ORDER BY id LIMIT ?", (row["last_id"] if row else 0, EXPORT_BATCH),
+            ).fetchall()
+        if not rows:
+            return 0, []
+        ids, patient_ids, eyes, diagnoses, confidences, created = zip(*rows)
+        created_at = [datetime.fromisoformat(value) for value in created]
+        dates = [value.date().isoformat() for value in created_at]
+        table = pa.table({
+            "id": ids, "patient_id": patient_ids, "eye": eyes, "diagnosis": diagnoses,
+            "confidence": confidences,
+            "has_detection": [diagnosis.lower() != "normal" for diagnosis in diagnoses],
+            "high_risk": [is_high_risk(d, c) for d, c in zip(diagnoses, confidences)],
+            "created_at": created_at,
+        }, schema=schema()).append_column("date", pa.array(dates, pa.string()))
+        days = sorted(set(dates))
+
+        # Files are named after the batch's first id, so a retry after a crash, or
+        # another process exporting the same rows, overwrites instead of duplicating
+        staging = tempfile.mkdtemp(dir=self.root, prefix=".staging-")
+        try:
+            ds.write_dataset(table, staging, format="parquet", partitioning=partitioning(),
+                             basename_template=f"part-{ids[0]:012d}-{{i}}.parquet")
+            for day in days:
+                target = os.path.join(self.root, f"date={day}")
+                os.makedirs(target, exist_ok=True)
+                for name in os.listdir(os.path.join(staging, f"date={day}")):
+                    os.replace(os.path.join(staging, f"date={day}", name), os.path.join(target, name))
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO export_watermarks (name, last_id, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET last_id = MAX(last_id, excluded.last_id), "
+                "updated_at = excluded.updated_at",
+                (WATERMARK, ids[-1], datetime.now().isoformat()),
+            )
+        return len(rows), days
+
+    def compact(self, day: str):
+        """Merge a day's part files into one; days are small, so this reads a single partition."""
+        import pyarrow.parquet as pq
+
+        directory = os.path.join(self.root, f"date={day}")
+        parts = sorted(name for name in os.listdir(directory) if name.endswith(".parquet"))
+        if len(parts) < 2:
+            return
+        table = pq.read_table([os.path.join(directory, name) for name in parts], schema=schema())
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        os.close(fd)
+        pq.write_table(table.sort_by("id"), tmp_path)
+        # Takes the first part's name; the rest are removed once it is in place
+        os.replace(tmp_path, os.path.join(directory, parts[0]))
+        for name in parts[1:]:
+            os.remove(os.path.join(directory, name))
+
+    def compact_all(self):
+        today = date.today().isoformat()
+        for name in sorted(os.listdir(self.root)):
+            if name.startswith("date=") and name[5:] < today:
+                self.compact(name[5:])
+
+
+# Queries
+def load(root: str = config.ANALYTICS_DIR, since: Optional[date] = None, until: Optional[date] = None,
+         columns: Optional[List[str]] = None):
+    """Analyses created between ``since`` and ``until`` (inclusive) as an Arrow table.
+
+    Date bounds prune whole partitions; only ``columns`` are read from the rest.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    if not os.path.isdir(root) or not any(name.startswith("date=") for name in os.listdir(root)):
+        return schema().append(pa.field("date", pa.string())).empty_table()
+    dataset = ds.dataset(root, format="parquet", partitioning=partitioning(), schema=schema().append(
+        pa.field("date", pa.string())), exclude_invalid_files=False, ignore_prefixes=[".", "_"])
+    condition = None
+    if since is not None:
+        condition = ds.field("date") >= since.isoformat()
+    if until is not None:
+        bound = ds.field("date") <= until.isoformat()
+        condition = bound if condition is None else condition & bound
+    return dataset.to_table(columns=columns, filter=condition)
+
+
+def breakdown(table, by: Sequence[str]):
+    """Per group of ``by`` (any of month, diagnosis, eye): count, share of all rows,
+    detections, detection rate and mean confidence."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    by = list(by)
+    if "month" in by:
+        table = table.append_column("month", pc.utf8_slice_codeunits(table["date"], 0, 7))
+    for name in ("diagnosis", "eye"):
+        if name in by:
+            table = table.set_column(table.schema.get_field_index(name), name, pc.cast(table[name], pa.string()))
+    grouped = table.group_by(by).aggregate([("id", "count"), ("has_detection", "sum"), ("confidence", "mean")])
+    count = grouped["id_count"]
+    detections = pc.cast(grouped["has_detection_sum"], pa.int64())
+    result = pa.table({name: grouped[name] for name in by}).append_column("analyses", count)
+    result = result.append_column("share", pc.divide(pc.cast(count, pa.float64()), max(len(table), 1)))
+    result = result.append_column("detections", detections)
+    result = result.append_column("detection_rate", pc.divide(pc.cast(detections, pa.float64()), pc.cast(count, pa.float64())))
+    result = result.append_column("mean_confidence", grouped["confidence_mean"])
+    return result.sort_by([(name, "ascending") for name in by])
+
+
+def calibration(table, bin_width: int = CALIBRATION_BIN_WIDTH):
+    """Analyses per confidence bin, with the bin's mean confidence, detection rate and high-risk count.
+
+    There is no ground truth in the history, so this shows how confidence is
+    distributed and what the model calls at each level; compare against
+    reviewed cases to judge calibration.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    lower = pc.multiply(pc.cast(pc.floor(pc.divide(pc.cast(table["confidence"], pa.float64()), bin_width)),
+                                pa.int64()), bin_width)
+    lower = pc.min_element_wise(lower, 100 - bin_width)  # 100% belongs in the top bin
+    binned = pa.table({"bin": lower, "id": table["id"], "confidence": table["confidence"],
+                       "has_detection": table["has_detection"], "high_risk": table["high_risk"]})
+    grouped = binned.group_by("bin").aggregate([("id", "count"), ("confidence", "mean"),
+                                                ("has_detection", "sum"), ("high_risk", "sum")])
+    count = pc.cast(grouped["id_count"], pa.float64())
+    labels = pc.binary_join_element_wise(pc.cast(grouped["bin"], pa.string()),
+                                         pc.cast(pc.add(grouped["bin"], bin_width), pa.string()), "-")
+    return pa.table({
+        "bin": grouped["bin"],
+        "confidence_range": labels,
+        "analyses": grouped["id_count"],
+        "mean_confidence": grouped["confidence_mean"],
+        "detection_rate": pc.divide(pc.cast(grouped["has_detection_sum"], pa.float64()), count),
+        "high_risk": grouped["high_risk_sum"],
+    }).sort_by("bin")
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> AnalyticsExporter:
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            from storage import get_database
+
+            _exporter = AnalyticsExporter(get_database())
+        return _exporter
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export new analyses to the Parquet analytics dataset")
+    parser.add_argument("--compact", action="store_true", help="merge each past day's files into one")
+    args = parser.parse_args()
+    exporter = get_exporter()
+    print(f"Exported {exporter.export_new()} analyses to {exporter.root} (watermark {exporter.watermark()})")
+    if args.compact:
+        exporter.compact_all()
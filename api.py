@@ -0,0 +1,228 @@
+# Headless REST API over the same services as main_streamlit.py, for PACS and
+# other programmatic clients:
+#
+#     uvicorn api:app --workers 4
+#
+# Handlers are async; the blocking service calls (SQLite, content store writes,
+# bcrypt, inference, PDF rendering) run on the thread pool so one slow request
+# never stalls the event loop. Inference additionally goes through a semaphore,
+# so a burst of uploads queues here instead of piling onto the model.
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from datetime import date, datetime
+from typing import List, Optional
+
+from fastapi import Depends, FastAPI, File, Form, HTTPException, Query, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from pydantic import BaseModel, Field
+
+import config
+import services
+from auth import CredentialStore
+from image_store import CHUNK_SIZE
+from inference import ModelNotInstalled, get_engine
+from model_pool import get_model_pool
+from models import AnalysisResult, User
+from notifications import notify
+from search_index import DEFAULT_PAGE_SIZE, search_patients
+from storage import get_database
+from telemetry import span
+
+_credentials: Optional[CredentialStore] = None
+_inference_slots: Optional[asyncio.Semaphore] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _credentials, _inference_slots
+    os.makedirs(config.UPLOAD_DIR, exist_ok=True)
+    _credentials = await run_in_threadpool(CredentialStore, get_database())
+    # Models are loaded and warmed up before the first request is accepted
+    pool = await run_in_threadpool(get_model_pool)
+    if pool.default_version is None:
+        raise ModelNotInstalled(pool.missing)
+    _inference_slots = asyncio.Semaphore(config.API_MAX_CONCURRENT_ANALYSES or os.cpu_count())
+    yield
+
+
+app = FastAPI(title="RetinaView AI", lifespan=lifespan)
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
+
+# Request bodies
+class PatientIn(BaseModel):
+    patient_id: str
+    scan_date: date
+    eye: str
+
+
+class AnalysisIn(BaseModel):
+    patient_id: str
+    diagnosis: str
+    confidence: float = Field(ge=0, le=100)
+    details: Optional[str] = None
+    eye: Optional[str] = None
+
+
+class NotificationIn(BaseModel):
+    message: str
+
+
+# Auth
+async def current_user(token: str = Depends(oauth2_scheme)) -> User:
+    user = _credentials.user_from_token(token)
+    if user is None:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Invalid or expired token",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return user
+
+
+@app.post("/token")
+async def login(form: OAuth2PasswordRequestForm = Depends()):
+    user = await run_in_threadpool(_credentials.authenticate, form.username, form.password)
+    if user is None:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Invalid username or password",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return {"access_token": _credentials.issue_token(user), "token_type": "bearer",
+            "expires_in": config.SESSION_TOKEN_TTL}
+
+
+# Patients
+@app.post("/patients/", status_code=status.HTTP_201_CREATED)
+async def create_patient(body: PatientIn, user: User = Depends(current_user)):
+    try:
+        patient = await run_in_threadpool(services.create_patient, get_database(), body.patient_id,
+                                          datetime.combine(body.scan_date, datetime.min.time()), body.eye)
+    except ValueError as exc:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(exc))
+    if patient is None:
+        raise HTTPException(status.HTTP_409_CONFLICT, "Patient already exists")
+    return asdict(patient)
+
+
+@app.get("/patients/{patient_id}")
+async def get_patient(patient_id: str, user: User = Depends(current_user)):
+    patient = await run_in_threadpool(get_database().patients.get, patient_id)
+    if patient is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Patient not found")
+    return asdict(patient)
+
+
+# Uploads
+async def _analyze(db, patient_id: str, upload) -> AnalysisResult:
+    async with _inference_slots:
+        return await run_in_threadpool(services.analyze_upload, db, get_engine(), patient_id, upload)
+
+
+@app.post("/upload/")
+async def upload_files(patient_id: str = Form(...), files: List[UploadFile] = File(...),
+                       analyze: bool = Query(False), user: User = Depends(current_user)):
+    """Store scans for a patient; with ``?analyze=true`` each one is also classified and recorded.
+
+    A file that can't be decoded as a B-scan is still stored, and gets an ``error`` entry instead of an analysis.
+    """
+    db = get_database()
+    if not await run_in_threadpool(db.patients.exists, patient_id):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Patient not found")
+    saved = []
+    for upload in files:
+        # Spooled by the multipart parser; copied into the store in chunks off the event loop
+        with span("api.upload"):
+            saved.append(await run_in_threadpool(services.save_patient_upload, db, patient_id,
+                                                 upload.file, upload.filename or "upload"))
+        await upload.close()
+    response = {"files": [{"filename": s.filename, "digest": s.digest, "size": s.size,
+                           "deduplicated": s.deduplicated} for s in saved]}
+    if analyze:
+        outcomes = await asyncio.gather(*(_analyze(db, patient_id, s) for s in saved), return_exceptions=True)
+        response["analyses"] = []
+        for entry, outcome in zip(response["files"], outcomes):
+            # Pillow raises OSError for data it can't read, the engine ValueError for an image of the wrong shape
+            if isinstance(outcome, (OSError, ValueError)):
+                entry["error"] = f"{type(outcome).__name__}: {outcome}"
+            elif isinstance(outcome, BaseException):
+                raise outcome
+            else:
+                response["analyses"].append(asdict(outcome))
+    return response
+
+
+# Analyses
+@app.post("/analysis/", status_code=status.HTTP_201_CREATED)
+async def submit_analysis(body: AnalysisIn, user: User = Depends(current_user)):
+    analysis = AnalysisResult(patient_id=body.patient_id, diagnosis=body.diagnosis,
+                              confidence=body.confidence, details=body.details, eye=body.eye)
+    try:
+        await run_in_threadpool(services.record_analysis, get_database(), analysis)
+    except services.PatientNotFound as exc:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, str(exc))
+    except ValueError as exc:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(exc))
+    return asdict(analysis)
+
+
+@app.get("/analysis/{patient_id}")
+async def get_analyses(patient_id: str, user: User = Depends(current_user)):
+    analyses = await run_in_threadpool(get_database().analyses.for_patient, patient_id)
+    if not analyses:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Analysis not found")
+    return [asdict(analysis) for analysis in analyses]
+
+
+@app.get("/analysis/{patient_id}/trends")
+async def get_trends(patient_id: str, user: User = Depends(current_user)):
+    """Per-eye trend summaries: visit counts, the newest results and the latest changes."""
+    trends = await run_in_threadpool(get_database().trends.for_patient, patient_id)
+    return [dict(asdict(trend), confidence_delta=trend.confidence_delta, diagnosis_changed=trend.diagnosis_changed)
+            for trend in trends]
+
+
+# Search
+@app.get("/history/")
+async def search_history(patient_id: str = "", diagnosis: str = "", cursor: Optional[str] = None,
+                         page_size: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=500),
+                         user: User = Depends(current_user)):
+    page = await run_in_threadpool(search_patients, get_database(), patient_id, diagnosis, cursor, page_size)
+    return {"results": [asdict(patient) for patient in page.results], "total": page.total,
+            "next_cursor": page.next_cursor}
+
+
+# Notifications
+@app.get("/notifications/")
+async def get_notifications(since: int = 0, limit: int = Query(100, ge=1, le=1000),
+                            user: User = Depends(current_user)):
+    """Entries after seq ``since``, oldest first; pass the last seq back to poll for new ones."""
+    notifications = await run_in_threadpool(get_database().notifications.since, since, limit)
+    return [asdict(notification) for notification in notifications]
+
+
+@app.post("/notifications/", status_code=status.HTTP_201_CREATED)
+async def create_notification(body: NotificationIn, user: User = Depends(current_user)):
+    return asdict(await run_in_threadpool(notify, get_database(), body.message))
+
+
+# Reports
+def _iter_file(path: str):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+@app.get("/reports/{patient_id}")
+async def download_report(patient_id: str, user: User = Depends(current_user)):
+    try:
+        path = await run_in_threadpool(services.patient_report, get_database(), patient_id)
+    except services.PatientNotFound as exc:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, str(exc))
+    # Sync generator: Starlette reads it on the thread pool, one chunk at a time
+    return StreamingResponse(_iter_file(path), media_type="application/pdf",
+                             headers={"Content-Disposition": f'attachment; filename="report_{patient_id}.pdf"',
+                                      "Content-Length": str(os.path.getsize(path))})
@@ -0,0 +1,179 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Optional
+
+from passlib.context import CryptContext
+
+import config
+from models import User
+from storage import Database, Repository
+from telemetry import span
+
+# Password hashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Seed accounts, hashed ahead of time so no bcrypt work happens at startup
+DEFAULT_USERS = {
+    "doctor": "$2b$12$LcCBGnfzEbvMcvhullbbQePDIBEYKyFJN72Em0sBwOGSYa7o7UsEy",  # password123
+}
+
+# Verified against when the username is unknown, so both paths cost one bcrypt check
+_DUMMY_HASH = DEFAULT_USERS["doctor"]
+
+# Length of the generated token-signing key kept at config.SECRET_KEY_PATH
+SECRET_KEY_BYTES = 32
+
+
+class LatencyTracker:
+    """Percentiles over the most recent samples."""
+
+    def __init__(self, window: int = 1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            ordered = sorted(self._samples)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+class CredentialStore(Repository):
+    """Users with bcrypt hashes persisted in SQLite.
+
+    Passwords are checked on a small thread pool so the Streamlit script
+    thread is not the one burning CPU on bcrypt. A successful login hands out
+    an HMAC-signed token that later requests check instead of the password.
+    """
+
+    def __init__(self, db: Database, verify_workers: int = 2):
+        super().__init__(db.pool)
+        self._executor = ThreadPoolExecutor(max_workers=verify_workers, thread_name_prefix="bcrypt")
+        self._secret = _load_secret()
+        self.login_latency = LatencyTracker()
+        self._seed()
+        self._hashes = self._load_hashes()
+
+    def _seed(self):
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO users (username, hashed_password, created_at) VALUES (?, ?, ?)",
+                [(username, hashed, now) for username, hashed in DEFAULT_USERS.items()],
+            )
+
+    def _load_hashes(self) -> Dict[str, str]:
+        with self.reader() as conn:
+            rows = conn.execute("SELECT username, hashed_password FROM users").fetchall()
+        return {row["username"]: row["hashed_password"] for row in rows}
+
+    def set_password(self, username: str, password: str):
+        hashed = pwd_context.hash(password)
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO users (username, hashed_password, created_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (username) DO UPDATE SET hashed_password = excluded.hashed_password",
+                (username, hashed, datetime.now().isoformat()),
+            )
+        self._hashes[username] = hashed
+
+    def _verify(self, username: str, password: str) -> Optional[User]:
+        hashed = self._hashes.get(username)
+        valid, new_hash = pwd_context.verify_and_update(password, hashed or _DUMMY_HASH)
+        if not (hashed and valid):
+            return None
+        if new_hash:
+            # Hash used outdated parameters; store the upgraded one
+            with self.transaction() as conn:
+                conn.execute("UPDATE users SET hashed_password = ? WHERE username = ?", (new_hash, username))
+            self._hashes[username] = new_hash
+        return User(username=username)
+
+    def authenticate(self, username: str, password: str) -> Optional[User]:
+        started = time.perf_counter()
+        try:
+            with span("auth.login"):
+                return self._executor.submit(self._verify, username, password).result()
+        finally:
+            self.login_latency.record(time.perf_counter() - started)
+
+    # Session tokens
+    def issue_token(self, user: User, ttl: int = config.SESSION_TOKEN_TTL) -> str:
+        body = f"{user.username}|{int(time.time()) + ttl}".encode()
+        return f"{_b64(body)}.{_b64(self._sign(body))}"
+
+    def user_from_token(self, token: Optional[str]) -> Optional[User]:
+        """The user a token was issued to, or None if it is forged or expired."""
+        if not token or "." not in token:
+            return None
+        body_part, signature_part = token.split(".", 1)
+        try:
+            body, signature = _unb64(body_part), _unb64(signature_part)
+        except ValueError:
+            return None
+        if not hmac.compare_digest(signature, self._sign(body)):
+            return None
+        username, _, expires = body.decode().rpartition("|")
+        if int(expires) < time.time() or username not in self._hashes:
+            return None
+        return User(username=username)
+
+    def _sign(self, body: bytes) -> bytes:
+        return hmac.new(self._secret, body, hashlib.sha256).digest()
+
+
+def _load_secret() -> bytes:
+    if config.SECRET_KEY:
+        return config.SECRET_KEY.encode()
+    directory = os.path.dirname(config.SECRET_KEY_PATH) or "."
+    os.makedirs(directory, exist_ok=True)
+    # The key is written in full to a temp file, then linked into place. link() fails if the
+    # path exists, so when several worker processes start at once exactly one key wins, and
+    # no process can read it half-written
+    secret = secrets.token_bytes(SECRET_KEY_BYTES)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".secret-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(secret)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp_path, config.SECRET_KEY_PATH)
+        except FileExistsError:
+            with open(config.SECRET_KEY_PATH, "rb") as f:
+                secret = f.read()
+    finally:
+        os.remove(tmp_path)
+    if len(secret) < SECRET_KEY_BYTES:
+        # An empty or short key would let anyone sign session tokens
+        raise RuntimeError(f"{config.SECRET_KEY_PATH} holds a {len(secret)}-byte key; "
+                           f"delete it to generate a new one, or set RETINAVIEW_SECRET_KEY")
+    return secret
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(text: str) -> bytes:
+    try:
+        return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+    except Exception as exc:
+        raise ValueError("malformed token") from exc
@@ -0,0 +1,182 @@
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+import config
+from image_store import ImageStore
+from inference import InferenceEngine, Prediction
+from preprocessing import TensorCache, decode, preprocess_image
+from telemetry import traced
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+@dataclass
+class BatchItem:
+    name: str
+    data: Optional[bytes] = None
+    path: Optional[str] = None
+
+
+@dataclass
+class BatchResult:
+    name: str
+    image_ref: Optional[str] = None
+    prediction: Optional[Prediction] = None
+    error: Optional[str] = None
+
+
+# Sources
+def items_from_zip(fileobj) -> Iterator[BatchItem]:
+    """Members are decompressed one at a time as the batch consumes them."""
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in _zip_images(archive):
+            yield BatchItem(name=info.filename, data=archive.read(info))
+
+
+def items_from_store(sources: List[dict], store: ImageStore) -> Iterator[BatchItem]:
+    """Uploads already in the content store, as ``{'name', 'image_ref'}``; zip archives are expanded."""
+    for source in sources:
+        path = store.path(source['image_ref'])
+        if source['name'].lower().endswith('.zip'):
+            with open(path, 'rb') as f:
+                yield from items_from_zip(f)
+        else:
+            yield BatchItem(name=source['name'], path=path)
+
+
+def count_stored(sources: List[dict], store: ImageStore) -> int:
+    total = 0
+    for source in sources:
+        if source['name'].lower().endswith('.zip'):
+            with zipfile.ZipFile(store.path(source['image_ref'])) as archive:
+                total += len(_zip_images(archive))
+        else:
+            total += 1
+    return total
+
+
+def _zip_images(archive: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    return [info for info in archive.infolist()
+            if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+def items_from_directory(relative_dir: str, root: str = config.UPLOAD_DIR) -> Iterator[BatchItem]:
+    """Image files below a directory inside ``root``; paths escaping ``root`` are rejected."""
+    root = os.path.realpath(root)
+    directory = os.path.realpath(os.path.join(root, relative_dir))
+    if os.path.commonpath([root, directory]) != root:
+        raise ValueError(f"{relative_dir!r} is outside {config.UPLOAD_DIR}")
+    if not os.path.isdir(directory):
+        raise ValueError(f"{relative_dir!r} is not a directory")
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(dirpath, filename)
+                yield BatchItem(name=os.path.relpath(path, directory), path=path)
+
+
+# Worker side: runs in the process pool
+def _prepare(item: BatchItem, store_root: str, tensor_root: str):
+    try:
+        data = item.data
+        if data is None:
+            with open(item.path, 'rb') as f:
+                data = f.read()
+        image_ref = ImageStore(store_root).put(data)
+        tensor = TensorCache(tensor_root).get_or_compute(image_ref, lambda: preprocess_image(decode(data)))
+        return item.name, image_ref, np.asarray(tensor), None
+    except Exception as exc:
+        return item.name, None, None, f"{type(exc).__name__}: {exc}"
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """Shared preprocessing pool; spawned so workers don't inherit Streamlit's threads."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=config.BATCH_WORKERS or os.cpu_count(),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _pool
+
+
+@traced('analysis.batch')
+def run_batch(items: Iterable[BatchItem], engine: InferenceEngine,
+              on_result: Callable[[BatchResult], None],
+              store_root: str = config.IMAGE_STORE_DIR,
+              pool: Optional[ProcessPoolExecutor] = None,
+              tensor_root: str = config.TENSOR_CACHE_DIR) -> int:
+    """Decode/preprocess in the pool and classify in engine-sized batches.
+
+    ``on_result`` is called once per item, in completion order, as soon as its
+    batch is classified. At most a few batches of decoded tensors are held at once.
+    """
+    pool = pool or get_pool()
+    max_in_flight = engine.max_batch * 2
+    in_flight = set()
+    ready: List[tuple] = []
+    done_count = 0
+
+    def flush():
+        nonlocal done_count
+        futures = [engine.submit(tensor) for _, _, tensor in ready]
+        for (name, image_ref, _), future in zip(ready, futures):
+            try:
+                prediction = future.result()
+            except Exception as exc:
+                on_result(BatchResult(name=name, image_ref=image_ref, error=f"{type(exc).__name__}: {exc}"))
+            else:
+                on_result(BatchResult(name=name, image_ref=image_ref, prediction=prediction))
+            done_count += 1
+        ready.clear()
+
+    def collect():
+        nonlocal done_count
+        finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in finished:
+            in_flight.discard(future)
+            name, image_ref, tensor, error = future.result()
+            if error:
+                on_result(BatchResult(name=name, error=error))
+                done_count += 1
+            else:
+                ready.append((name, image_ref, tensor))
+        if len(ready) >= engine.max_batch:
+            flush()
+
+    for item in items:
+        while len(in_flight) >= max_in_flight:
+            collect()
+        in_flight.add(pool.submit(_prepare, item, store_root, tensor_root))
+    while in_flight:
+        collect()
+    if ready:
+        flush()
+    return done_count
+
+
+class Throughput:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+
+    def tick(self):
+        self.count += 1
+
+    @property
+    def per_second(self) -> float:
+        elapsed = time.perf_counter() - self.started
+        return self.count / elapsed if elapsed > 0 else 0.0
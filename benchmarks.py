@@ -0,0 +1,313 @@
+# Headless benchmarks for the analysis, upload, search and report paths.
+#
+# Everything runs against synthetic OCT B-scans and synthetic patient
+# registries in a throwaway data directory, never the app's own data:
+#
+#   python benchmarks.py --sizes 1000 10000 100000 --output results.json
+#   python benchmarks.py --output new.json --baseline results.json
+#
+# Each result records throughput, latency percentiles and the peak Python
+# heap (tracemalloc, which includes NumPy buffers) during the operation. With
+# --baseline, results are matched by name and size and any slowdown beyond
+# --tolerance makes the run exit non-zero.
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MEMORY_SAMPLES = 5
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    size: int
+    ops: int
+    seconds: float
+    throughput: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    peak_memory_mb: float
+    extra: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}@{self.size}"
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def measure(name: str, size: int, operation: Callable[[int], None], ops: int, warmup: int = 2) -> BenchmarkResult:
+    """Time ``operation(i)`` for i in range(ops), then sample its peak memory separately.
+
+    tracemalloc slows allocation-heavy code down, so latencies come from an
+    untraced pass and the peak from a few traced calls afterwards. Those calls
+    and the warm-up get indices past ``ops``, so an operation that caches per
+    index (uploads, reports) is not measured on its own cache hits.
+    """
+    for i in range(ops + MEMORY_SAMPLES, ops + MEMORY_SAMPLES + warmup):
+        operation(i)
+    latencies = []
+    started = time.perf_counter()
+    for i in range(ops):
+        op_started = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - op_started)
+    seconds = time.perf_counter() - started
+
+    tracemalloc.start()
+    peak = 0
+    for i in range(ops, ops + MEMORY_SAMPLES):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        operation(i)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    ordered = sorted(latencies)
+    return BenchmarkResult(
+        name=name, size=size, ops=ops, seconds=seconds, throughput=ops / seconds if seconds else 0.0,
+        p50_ms=statistics.median(ordered) * 1000, p95_ms=percentile(ordered, 95) * 1000,
+        p99_ms=percentile(ordered, 99) * 1000, max_ms=ordered[-1] * 1000, peak_memory_mb=peak / 2 ** 20,
+    )
+
+
+# Synthetic data
+def encode_png(pixels: np.ndarray) -> bytes:
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def build_registry(db, size: int, rng: np.random.Generator, image_ref: Optional[str] = None, analyses_per_patient: int = 1):
+    """``size`` patients, each with ``analyses_per_patient`` analyses, inserted in bulk."""
+    from inference import CLASSES
+
+    start = datetime(2024, 1, 1)
+    labels = rng.integers(0, len(CLASSES), size=size * analyses_per_patient)
+    confidences = rng.uniform(20, 99, size=size * analyses_per_patient)
+    with db.patients.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO patients (patient_id, scan_date, eye) VALUES (?, ?, ?)",
+            ((f"P{n:07d}", (start + timedelta(minutes=n)).isoformat(), "left" if n % 2 else "right")
+             for n in range(size)),
+        )
+        conn.executemany(
+            "INSERT INTO analyses (patient_id, diagnosis, confidence, details, scan_date, created_at, image_ref, eye) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((f"P{n // analyses_per_patient:07d}", CLASSES[labels[n]], float(confidences[n]),
+              f"Synthetic scan {n}", None, (start + timedelta(minutes=n)).isoformat(), image_ref,
+              "left" if (n // analyses_per_patient) % 2 else "right")
+             for n in range(size * analyses_per_patient)),
+        )
+    # Bulk inserts bypass AnalysisRepository.add, so the trend summaries are built in one pass
+    db.trends.rebuild()
+
+
+# Benchmarks
+def bench_analyze(scans: List[bytes]) -> List[BenchmarkResult]:
+    from inference import get_engine
+    from preprocessing import TensorCache
+
+    engine = get_engine()
+    tensors = TensorCache(os.path.join(os.environ["RETINAVIEW_DATA_DIR"], "bench_tensors"))
+    refs = [f"{n:064x}" for n in range(len(scans))]
+    results = [
+        measure("analyze", len(scans), lambda i: engine.run_pipeline(scans[i % len(scans)]), len(scans)),
+        # Warm-up covers every scan, so the timed pass only reads cached tensors
+        measure("analyze_tensor_cached", len(scans),
+                lambda i: engine.run_pipeline(scans[i % len(scans)], image_ref=refs[i % len(refs)], tensors=tensors),
+                len(scans), warmup=len(scans)),
+    ]
+    return results
+
+
+def bench_upload(scans: List[bytes], data_dir: str) -> List[BenchmarkResult]:
+    from image_store import ImageStore
+    from uploads import save_upload
+
+    mean_mb = sum(len(scan) for scan in scans) / len(scans) / 2 ** 20
+
+    def content(i):
+        # Trailing bytes after IEND keep the image valid but give every index its own hash
+        return BytesIO(scans[i % len(scans)] + i.to_bytes(4, "big"))
+
+    results = []
+    for name in ("upload", "upload_duplicate"):
+        # The second pass re-uploads identical content, which is hashed and linked, not stored
+        store = ImageStore(os.path.join(data_dir, "bench_images"))
+        folder = os.path.join(data_dir, "bench_uploads", name)
+        result = measure(name, len(scans),
+                         lambda i: save_upload(content(i), f"scan{i}.png", folder, store),
+                         len(scans), warmup=0)
+        result.extra["mb_per_s"] = result.throughput * mean_mb
+        results.append(result)
+    return results
+
+
+def bench_search(sizes: List[int], queries: int, data_dir: str, rng: np.random.Generator) -> List[BenchmarkResult]:
+    from search_index import search_patients
+    from storage import Database
+
+    results = []
+    for size in sizes:
+        db = Database(os.path.join(data_dir, f"bench_search_{size}.db"))
+        started = time.perf_counter()
+        build_registry(db, size, rng)
+        build_seconds = time.perf_counter() - started
+        ids = rng.integers(0, size, size=queries)
+        cases = {
+            "search_id_substring": lambda i: search_patients(db, f"{ids[i % queries]:07d}"[2:6]),
+            "search_diagnosis": lambda i: search_patients(db, diagnosis_query=("macular", "diabetic", "normal")[i % 3]),
+            "search_browse_page": lambda i: search_patients(db, cursor=f"P{ids[i % queries]:07d}"),
+        }
+        for name, operation in cases.items():
+            result = measure(name, size, operation, queries)
+            result.extra["registry_build_s"] = build_seconds
+            results.append(result)
+    return results
+
+
+def bench_report(reports: int, data_dir: str, scan: bytes, rng: np.random.Generator) -> List[BenchmarkResult]:
+    import reports as report_engine
+    from image_store import get_image_store
+    from storage import get_database
+
+    db = get_database()
+    image_ref = get_image_store().put(scan)
+    # One patient per timed, traced and warm-up call, so every render misses the report cache
+    patients = reports + MEMORY_SAMPLES + 2
+    build_registry(db, patients, rng, image_ref=image_ref, analyses_per_patient=5)
+    template = report_engine.load_template()
+    data = [report_engine.report_data(db, f"P{n:07d}") for n in range(patients)]
+    return [
+        measure("report_render", reports, lambda i: report_engine.render_report(data[i], template), reports),
+        measure("report_cached", reports, lambda i: report_engine.render_report(data[i % patients], template), reports),
+    ]
+
+
+# Comparison
+def compare(results: List[BenchmarkResult], baseline: dict, tolerance: float, min_delta_ms: float) -> List[str]:
+    """Human-readable regressions against a stored run; empty if none.
+
+    Latency changes smaller than ``min_delta_ms`` are ignored: sub-millisecond
+    queries jitter by more than any sensible tolerance.
+    """
+    previous = {f"{r['name']}@{r['size']}": r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(result.key)
+        if old is None:
+            continue
+        if result.p50_ms - old["p50_ms"] < min_delta_ms:
+            continue
+        if result.p50_ms > old["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{result.key}: p50 {old['p50_ms']:.2f} -> {result.p50_ms:.2f} ms")
+        if result.throughput < old["throughput"] * (1 - tolerance):
+            regressions.append(f"{result.key}: throughput {old['throughput']:.1f} -> {result.throughput:.1f} ops/s")
+    return regressions
+
+
+def print_table(results: List[BenchmarkResult], baseline: Optional[dict] = None):
+    previous = {f"{r['name']}@{r['size']}": r for r in baseline["results"]} if baseline else {}
+    print(f"{'benchmark':<32}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak MB':>10}"
+          + (f"{'vs base':>10}" if previous else ""))
+    for result in results:
+        line = (f"{result.key:<32}{result.throughput:>10.1f}{result.p50_ms:>10.2f}{result.p95_ms:>10.2f}"
+                f"{result.p99_ms:>10.2f}{result.peak_memory_mb:>10.2f}")
+        old = previous.get(result.key)
+        if old:
+            line += f"{(result.p50_ms / old['p50_ms'] - 1) * 100:>+9.0f}%"
+        print(line)
+
+
+def run(args) -> List[BenchmarkResult]:
+    from preprocessing import synthetic_scan
+
+    rng = np.random.default_rng(args.seed)
+    data_dir = os.environ["RETINAVIEW_DATA_DIR"]
+    scans = [encode_png(synthetic_scan(rng)) for _ in range(args.scans)]
+    results = []
+    if "analyze" in args.only:
+        results += bench_analyze(scans)
+    if "upload" in args.only:
+        results += bench_upload(scans, data_dir)
+    if "search" in args.only:
+        results += bench_search(args.sizes, args.queries, data_dir, rng)
+    if "report" in args.only:
+        results += bench_report(args.reports, data_dir, scans[0], rng)
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark RetinaView's analysis, upload, search and report paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="patient registry sizes for the search benchmarks (up to 1000000)")
+    parser.add_argument("--scans", type=int, default=32, help="synthetic B-scans to analyse and upload")
+    parser.add_argument("--queries", type=int, default=50, help="queries per search benchmark and registry size")
+    parser.add_argument("--reports", type=int, default=20, help="reports to render")
+    parser.add_argument("--only", nargs="+", choices=["analyze", "upload", "search", "report"],
+                        default=["analyze", "upload", "search", "report"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved earlier with --output")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against the baseline before failing (0.2 = 20%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=0.25,
+                        help="ignore p50 slowdowns smaller than this many milliseconds")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory(prefix="retinaview-bench-") as data_dir:
+        # Set before any project module reads config, so nothing touches the real data directory
+        os.environ["RETINAVIEW_DATA_DIR"] = data_dir
+        os.environ["RETINAVIEW_UPLOAD_DIR"] = os.path.join(data_dir, "uploads")
+        os.environ.setdefault("RETINAVIEW_REPORT_TEMPLATE", os.path.join(ROOT, "templates", "report.json"))
+        # Timings don't depend on the weights, so the untrained model serves when none are installed
+        os.environ.setdefault("RETINAVIEW_PLACEHOLDER_MODEL", "1")
+        sys.path.insert(0, ROOT)
+        results = run(args)
+
+    print_table(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "results": [asdict(result) for result in results],
+            }, f, indent=2)
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
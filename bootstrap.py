@@ -0,0 +1,272 @@
+# Process-level setup shared by both Streamlit apps.
+#
+# Streamlit re-executes the app script on every interaction, so anything
+# expensive lives behind a factory here: resources are built once per process
+# and heavy modules (NumPy, Pillow, reportlab, passlib) are imported the first
+# time a factory needs them rather than at script start.
+#
+# `python bootstrap.py main.py main_streamlit.py` prints a cold-start and
+# per-rerun timing report.
+import time
+
+_PROCESS_STARTED = time.perf_counter()
+
+import logging
+import os
+import statistics
+import threading
+from collections import deque
+from typing import Optional
+
+import streamlit as st
+
+import config
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+CSS_LINK = '<link rel="stylesheet" href="app/static/main.css">'
+
+
+# Resource factories
+@st.cache_resource
+def ensure_directories():
+    for directory in (config.DATA_DIR, config.UPLOAD_DIR):
+        os.makedirs(directory, exist_ok=True)
+
+
+def database():
+    from storage import get_database
+
+    return get_database()
+
+
+@st.cache_resource
+def credentials():
+    from auth import CredentialStore
+
+    return CredentialStore(database())
+
+
+def image_store():
+    from image_store import get_image_store
+
+    return get_image_store()
+
+
+def engine():
+    from inference import get_engine
+
+    return get_engine()
+
+
+def model_pool():
+    from model_pool import get_model_pool
+
+    return get_model_pool()
+
+
+def _warm_up():
+    pool = model_pool()
+    if pool.default_version is None:
+        # Nothing to warm; each analysis fails with the same message until weights are loaded
+        logger.warning("%s", pool.missing)
+
+
+@st.cache_resource
+def warm_models() -> threading.Thread:
+    """Load and warm up the models in the background as the process starts, once for all sessions."""
+    thread = threading.Thread(target=_warm_up, name="model-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def result_cache():
+    from result_cache import get_result_cache
+
+    return get_result_cache()
+
+
+def heatmap_store():
+    from heatmaps import get_heatmap_store
+
+    return get_heatmap_store()
+
+
+def analytics_exporter():
+    from analytics import get_exporter
+
+    return get_exporter()
+
+
+def tensor_cache():
+    from preprocessing import get_tensor_cache
+
+    return get_tensor_cache()
+
+
+def job_queue():
+    from tasks import get_job_queue
+
+    return get_job_queue()
+
+
+@st.cache_resource(max_entries=8)
+def load_volume(image_ref: str):
+    from volumes import OCTVolume
+
+    return OCTVolume(image_store().path(image_ref))
+
+
+@st.cache_resource
+def session_states():
+    """Every session's analysis history in this process, under one memory budget (see session_store.py)."""
+    from session_store import SessionStates
+
+    states = SessionStates()
+    states.start_sweeping()
+    return states
+
+
+@st.cache_resource
+def metrics_exporter():
+    return telemetry.start_dumping()
+
+
+def inject_css():
+    """Styles are served once from static/main.css; each rerun only sends the link tag."""
+    st.markdown(CSS_LINK, unsafe_allow_html=True)
+
+
+# Timing
+class RunTimings:
+    """Setup overhead of the first script run in this process and of later reruns."""
+
+    def __init__(self, window: int = 500):
+        self.cold_start = None
+        self.reruns = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, started: float):
+        now = time.perf_counter()
+        with self._lock:
+            if self.cold_start is None:
+                self.cold_start = now - _PROCESS_STARTED
+            else:
+                self.reruns.append(now - started)
+
+    def summary(self) -> dict:
+        with self._lock:
+            reruns = sorted(self.reruns)
+            cold_start = self.cold_start
+        return {
+            "cold_start_ms": cold_start * 1000 if cold_start is not None else None,
+            "reruns": len(reruns),
+            "rerun_p50_ms": statistics.median(reruns) * 1000 if reruns else None,
+            "rerun_max_ms": reruns[-1] * 1000 if reruns else None,
+        }
+
+
+@st.cache_resource
+def run_timings() -> RunTimings:
+    return RunTimings()
+
+
+def start_run() -> float:
+    metrics_exporter()
+    warm_models()
+    return time.perf_counter()
+
+
+def finish_setup(started: float):
+    """Call once the script's module-level setup is done, before page rendering."""
+    run_timings().record(started)
+
+
+def finish_run(started: float, app: str):
+    """Call at the end of the script; records the whole run as the ``render.<app>`` span."""
+    if config.TRACING:
+        telemetry.registry.histogram(f"render.{app}").observe(time.perf_counter() - started)
+
+
+# Performance panel
+def performance_panel(history_key: Optional[str] = None):
+    """Span histograms for this process, plus what the current session holds in memory."""
+    st.markdown("### Spans")
+    if not config.TRACING:
+        st.info("Tracing is off (RETINAVIEW_TRACING=0)")
+    spans = telemetry.registry.snapshot()
+    if spans:
+        st.dataframe(
+            [{"span": name, "count": s["count"], "mean ms": round(s["mean_ms"], 2),
+              "p50 ms": s["p50_ms"], "p95 ms": s["p95_ms"], "p99 ms": s["p99_ms"],
+              "max ms": round(s["max_ms"], 2)} for name, s in spans.items()],
+            use_container_width=True,
+        )
+        st.caption("Percentiles are histogram bucket bounds; counts cover this server process")
+    st.download_button("Download metrics (Prometheus text)", telemetry.registry.prometheus(),
+                       file_name="retinaview.prom", mime="text/plain")
+    if config.METRICS_PATH and config.METRICS_INTERVAL > 0 and config.TRACING:
+        st.caption(f"Also written to {config.METRICS_PATH} every {config.METRICS_INTERVAL:g} s")
+
+    st.markdown("### Memory")
+    sessions = telemetry.session_memory(st.session_state)
+    rss = telemetry.process_rss()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Process RSS", f"{rss / 2 ** 20:.0f} MB" if rss else "-")
+    col2.metric("This Session", f"{sum(entry['bytes'] for entry in sessions) / 1024:.0f} KB")
+    if history_key and history_key in st.session_state:
+        history = st.session_state[history_key]
+        col3.metric("Analysis History", f"{len(history)} entries",
+                    f"{telemetry.deep_sizeof(history) / 1024:.0f} KB", delta_color="off")
+    st.dataframe([{"session key": entry["key"], "KB": round(entry["bytes"] / 1024, 1)} for entry in sessions],
+                 use_container_width=True)
+
+
+# Timing report
+def _measure(app_path: str, reruns: int) -> dict:
+    from streamlit.testing.v1 import AppTest
+
+    started = time.perf_counter()
+    app = AppTest.from_file(os.path.abspath(app_path), default_timeout=60)
+    app.run()
+    cold = time.perf_counter() - started
+    samples = []
+    for _ in range(reruns):
+        started = time.perf_counter()
+        app.run()
+        samples.append(time.perf_counter() - started)
+    return {"app": app_path, "cold_start_ms": cold * 1000,
+            "rerun_p50_ms": statistics.median(samples) * 1000, "rerun_max_ms": max(samples) * 1000}
+
+
+def _report(app_paths, reruns: int):
+    import json
+    import subprocess
+    import sys
+
+    print(f"{'app':<24}{'cold start':>14}{'rerun p50':>14}{'rerun max':>14}")
+    for app_path in app_paths:
+        # A fresh interpreter per app, so the cold start includes every import
+        output = subprocess.run(
+            [sys.executable, __file__, "--measure", app_path, "--reruns", str(reruns)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        timings = json.loads(output.strip().splitlines()[-1])
+        print(f"{app_path:<24}{timings['cold_start_ms']:>11.1f} ms"
+              f"{timings['rerun_p50_ms']:>11.1f} ms{timings['rerun_max_ms']:>11.1f} ms")
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Cold-start and rerun timings of Streamlit apps, run headless")
+    parser.add_argument("apps", nargs="*", default=["main.py", "main_streamlit.py"])
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        print(json.dumps(_measure(args.measure, args.reruns)))
+    else:
+        _report(args.apps, args.reruns)
@@ -0,0 +1,93 @@
+import os
+
+# Filesystem locations shared by both Streamlit apps
+DATA_DIR = os.environ.get("RETINAVIEW_DATA_DIR", "data")
+MODEL_DIR = os.environ.get("RETINAVIEW_MODEL_DIR", "models")
+
+# Classifier weights: either an ONNX graph or a NumPy .npz archive
+MODEL_PATH = os.environ.get("RETINAVIEW_MODEL_PATH", os.path.join(MODEL_DIR, "oct_classifier.npz"))
+# Without weights the app refuses to analyse. RETINAVIEW_PLACEHOLDER_MODEL=1 loads an untrained
+# stand-in instead, for demos and benchmarks; its results are labelled as not a diagnosis
+PLACEHOLDER_MODEL = os.environ.get("RETINAVIEW_PLACEHOLDER_MODEL", "0") in ("1", "true", "yes")
+
+# Model pool (see model_pool.py): versions loaded at startup, comma-separated, the first being the default;
+# batcher threads per model, and inferences running at once across all models (0 means one per CPU)
+MODEL_PATHS = [path.strip() for path in os.environ.get("RETINAVIEW_MODEL_PATHS", MODEL_PATH).split(",") if path.strip()]
+INFERENCE_WORKERS = int(os.environ.get("RETINAVIEW_INFERENCE_WORKERS", "2"))
+MODEL_MAX_CONCURRENCY = int(os.environ.get("RETINAVIEW_MODEL_CONCURRENCY", "0"))
+
+# Micro-batching of inference requests
+INFERENCE_MAX_BATCH = int(os.environ.get("RETINAVIEW_MAX_BATCH", "16"))
+INFERENCE_MAX_WAIT_MS = float(os.environ.get("RETINAVIEW_MAX_WAIT_MS", "10"))
+
+# Content-addressed scan storage (see image_store.py)
+IMAGE_STORE_DIR = os.environ.get("RETINAVIEW_IMAGE_DIR", os.path.join(DATA_DIR, "images"))
+
+# Shared SQLite database for patients, analyses and notifications (see storage.py)
+DATABASE_PATH = os.environ.get("RETINAVIEW_DATABASE", os.path.join(DATA_DIR, "retinaview.db"))
+DATABASE_POOL_SIZE = int(os.environ.get("RETINAVIEW_DB_POOL_SIZE", "8"))
+
+# Raw uploads and batch analysis (see batch.py); 0 workers means one per CPU
+UPLOAD_DIR = os.environ.get("RETINAVIEW_UPLOAD_DIR", "uploads")
+BATCH_WORKERS = int(os.environ.get("RETINAVIEW_BATCH_WORKERS", "0"))
+
+# Analysis result cache (see result_cache.py)
+RESULT_CACHE_DIR = os.environ.get("RETINAVIEW_RESULT_CACHE_DIR", os.path.join(DATA_DIR, "result_cache"))
+RESULT_CACHE_MEMORY_BYTES = int(os.environ.get("RETINAVIEW_RESULT_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+# Quantized CAM heatmaps and their rendered overlays (see heatmaps.py)
+HEATMAP_DIR = os.environ.get("RETINAVIEW_HEATMAP_DIR", os.path.join(DATA_DIR, "heatmaps"))
+
+# Analysis history as a date-partitioned Parquet dataset (see analytics.py)
+ANALYTICS_DIR = os.environ.get("RETINAVIEW_ANALYTICS_DIR", os.path.join(DATA_DIR, "analytics"))
+
+# Preprocessed model inputs, memory-mapped .npy files keyed by image hash (see preprocessing.py)
+TENSOR_CACHE_DIR = os.environ.get("RETINAVIEW_TENSOR_CACHE_DIR", os.path.join(DATA_DIR, "tensor_cache"))
+
+# Background jobs (see jobs.py); running jobs with no progress for this long are requeued
+JOB_WORKERS = int(os.environ.get("RETINAVIEW_JOB_WORKERS", "2"))
+JOB_STALE_SECONDS = int(os.environ.get("RETINAVIEW_JOB_STALE_SECONDS", "600"))
+REPORT_DIR = os.environ.get("RETINAVIEW_REPORT_DIR", os.path.join(DATA_DIR, "reports"))
+
+# PDF reports (see reports.py); 0 workers means one per CPU
+REPORT_TEMPLATE_PATH = os.environ.get("RETINAVIEW_REPORT_TEMPLATE", os.path.join("templates", "report.json"))
+REPORT_WORKERS = int(os.environ.get("RETINAVIEW_REPORT_WORKERS", "0"))
+
+# Login sessions (see auth.py); without RETINAVIEW_SECRET_KEY a random key is kept in DATA_DIR
+SECRET_KEY = os.environ.get("RETINAVIEW_SECRET_KEY", "")
+SECRET_KEY_PATH = os.path.join(DATA_DIR, "secret.key")
+SESSION_TOKEN_TTL = int(os.environ.get("RETINAVIEW_SESSION_TTL", str(8 * 3600)))
+
+# Notifications (see notifications.py): live entries kept before archiving, and how often clients poll
+NOTIFICATION_KEEP = int(os.environ.get("RETINAVIEW_NOTIFICATION_KEEP", "1000"))
+NOTIFICATION_POLL_SECONDS = float(os.environ.get("RETINAVIEW_NOTIFICATION_POLL", "5"))
+
+# Users who see the Admin and Performance pages, comma-separated
+ADMIN_USERS = {name.strip() for name in os.environ.get("RETINAVIEW_ADMIN_USERS", "doctor").split(",") if name.strip()}
+
+# Tracing spans (see telemetry.py); RETINAVIEW_TRACING=0 turns every span into a no-op.
+# Histograms are also written in Prometheus text format to METRICS_PATH every METRICS_INTERVAL seconds
+TRACING = os.environ.get("RETINAVIEW_TRACING", "1") not in ("0", "false", "no")
+METRICS_PATH = os.environ.get("RETINAVIEW_METRICS_PATH", os.path.join(DATA_DIR, "metrics.prom"))
+METRICS_INTERVAL = float(os.environ.get("RETINAVIEW_METRICS_INTERVAL", "15"))
+
+# Analysis history (see history.py): cards rendered per page
+HISTORY_PAGE_SIZE = int(os.environ.get("RETINAVIEW_HISTORY_PAGE_SIZE", "20"))
+
+# Analysis history memory in main.py (see session_store.py): entries kept in memory per session and across
+# all sessions before the least recently viewed are spilled to disk. Sessions idle for SESSION_IDLE_SECONDS
+# are spilled whole; closed ones are then dropped, and any session idle for SESSION_STATE_TTL
+SESSION_SPILL_DIR = os.environ.get("RETINAVIEW_SESSION_SPILL_DIR", os.path.join(DATA_DIR, "session_spill"))
+SESSION_MEMORY_BYTES = int(os.environ.get("RETINAVIEW_SESSION_MEMORY_BYTES", str(2 * 1024 * 1024)))
+SESSION_MEMORY_TOTAL_BYTES = int(os.environ.get("RETINAVIEW_SESSION_MEMORY_TOTAL_BYTES", str(64 * 1024 * 1024)))
+SESSION_IDLE_SECONDS = float(os.environ.get("RETINAVIEW_SESSION_IDLE_SECONDS", "900"))
+SESSION_STATE_TTL = float(os.environ.get("RETINAVIEW_SESSION_STATE_TTL", str(SESSION_TOKEN_TTL)))
+SESSION_SWEEP_SECONDS = float(os.environ.get("RETINAVIEW_SESSION_SWEEP_SECONDS", "60"))
+
+# REST API (see api.py): scans classified at once across all requests; 0 means one per CPU
+API_MAX_CONCURRENT_ANALYSES = int(os.environ.get("RETINAVIEW_API_MAX_ANALYSES", "0"))
+
+# Per-patient trends (see trends.py): results kept per patient and eye for timelines and report charts,
+# and the confidence above which a detection counts as High Risk
+TREND_POINTS = int(os.environ.get("RETINAVIEW_TREND_POINTS", "50"))
+HIGH_RISK_CONFIDENCE = float(os.environ.get("RETINAVIEW_HIGH_RISK_CONFIDENCE", "85"))
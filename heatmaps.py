@@ -0,0 +1,139 @@
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Optional
+
+import numpy as np
+
+import config
+from image_store import atomic_write, get_image_store
+from preprocessing import PREPROCESS_PARAMS, SCAN, VOLUME, get_tensor_cache, preprocess_image, resize
+from result_cache import cache_key
+from telemetry import span
+
+OVERLAY_SIZE = 256
+OVERLAY_ALPHA = 0.55
+
+
+def quantize(cam: np.ndarray) -> np.ndarray:
+    """Class activation map -> uint8, 255 at its strongest point."""
+    peak = float(cam.max())
+    if peak <= 0:
+        return np.zeros(cam.shape, dtype=np.uint8)
+    return np.rint(np.clip(cam, 0, None) * (255.0 / peak)).astype(np.uint8)
+
+
+def heatmap_ref(image_ref: str, model_version: str, slice_index: Optional[int] = None) -> str:
+    """Same key as the cached result, so a cache hit finds the heatmap of the run that produced it."""
+    key = cache_key(image_ref, model_version, PREPROCESS_PARAMS)
+    return key if slice_index is None else f"{key}-{slice_index}"
+
+
+class HeatmapStore:
+    """Quantized CAMs (a few hundred bytes each) and the PNG overlays drawn from them.
+
+    Each ``.npz`` holds the uint8 map at feature-map resolution plus the scan
+    and slice it belongs to. Overlays are drawn on first view over the model's
+    input tensor, then served from disk and a small in-memory LRU.
+    """
+
+    def __init__(self, root: str = config.HEATMAP_DIR, overlay_cache_entries: int = 64):
+        self.root = root
+        self._overlays = OrderedDict()
+        self._overlay_cache_entries = overlay_cache_entries
+        self._lock = threading.Lock()
+
+    def _path(self, ref: str) -> str:
+        return os.path.join(self.root, ref[:2], f"{ref}.npz")
+
+    def overlay_path(self, ref: str) -> str:
+        return os.path.join(self.root, "overlays", ref[:2], f"{ref}.png")
+
+    def exists(self, ref: str) -> bool:
+        return os.path.exists(self._path(ref))
+
+    def put(self, cam: np.ndarray, image_ref: str, model_version: str, slice_index: Optional[int] = None) -> str:
+        ref = heatmap_ref(image_ref, model_version, slice_index)
+        if not self.exists(ref):
+            buffer = BytesIO()
+            np.savez_compressed(buffer, cam=np.asarray(cam, dtype=np.uint8), image_ref=np.array(image_ref),
+                                slice_index=np.array(-1 if slice_index is None else slice_index))
+            atomic_write(self._path(ref), buffer.getvalue())
+        return ref
+
+    def overlay(self, ref: Optional[str]) -> Optional[bytes]:
+        """PNG of the heatmap blended over the scan, or None if there is no heatmap."""
+        if not ref:
+            return None
+        with self._lock:
+            if ref in self._overlays:
+                self._overlays.move_to_end(ref)
+                return self._overlays[ref]
+
+        path = self.overlay_path(ref)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+        elif self.exists(ref):
+            with span("heatmap.render"):
+                data = self._render(ref)
+            atomic_write(path, data)
+        else:
+            return None
+
+        with self._lock:
+            self._overlays[ref] = data
+            if len(self._overlays) > self._overlay_cache_entries:
+                self._overlays.popitem(last=False)
+        return data
+
+    def _render(self, ref: str) -> bytes:
+        from PIL import Image
+
+        with np.load(self._path(ref), allow_pickle=False) as stored:
+            cam, image_ref, slice_index = stored["cam"], str(stored["image_ref"]), int(stored["slice_index"])
+        base = _model_input(image_ref, None if slice_index < 0 else slice_index)
+        low, high = float(base.min()), float(base.max())
+        gray = (base - low) / (high - low) if high > low else np.zeros_like(base)
+        heat = resize(cam[None].astype(np.float32) / 255.0, base.shape[0])[0]
+
+        # Grayscale scan, tinted from yellow to red where the map is strong
+        rgb = np.repeat(gray[:, :, None], 3, axis=2)
+        tint = np.stack([np.ones_like(heat), 1.0 - heat, np.zeros_like(heat)], axis=2)
+        alpha = (OVERLAY_ALPHA * heat)[:, :, None]
+        blended = np.rint((rgb * (1 - alpha) + tint * alpha) * 255).astype(np.uint8)
+        image = Image.fromarray(blended, "RGB").resize((OVERLAY_SIZE, OVERLAY_SIZE), Image.BILINEAR)
+        buffer = BytesIO()
+        image.save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue()
+
+
+def _model_input(image_ref: str, slice_index: Optional[int]) -> np.ndarray:
+    """The preprocessed (H, W) tensor the model saw, from the tensor cache when it is there."""
+    if slice_index is None:
+        tensor = get_tensor_cache().get(image_ref, SCAN)
+    else:
+        stack = get_tensor_cache().get(image_ref, VOLUME)
+        tensor = stack[slice_index] if stack is not None and slice_index < len(stack) else None
+    if tensor is not None:
+        return np.asarray(tensor, dtype=np.float32)
+    from volumes import OCTVolume
+
+    volume = OCTVolume(get_image_store().path(image_ref))
+    try:
+        return preprocess_image(volume.get_slice(slice_index or 0))
+    finally:
+        volume.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_heatmap_store() -> HeatmapStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = HeatmapStore()
+        return _store
@@ -0,0 +1,73 @@
+import bisect
+from datetime import date, datetime, time
+from typing import List, Optional
+
+# Orderings the history page offers, each answered from one sorted key list
+NEWEST_FIRST = 'newest'
+OLDEST_FIRST = 'oldest'
+HIGHEST_CONFIDENCE = 'confidence'
+
+
+class HistoryIndex:
+    """A session's analysis results, kept sorted by timestamp and by confidence.
+
+    One ascending list of ``(key, id)`` pairs is kept per filter (all results,
+    detections only, normal only) and per sort key, so a page of history is a
+    slice of a list rather than a filter and sort over every result.
+    """
+
+    def __init__(self, entries=None):
+        # Any mapping of id -> result; session_store.SpillingEntries keeps only some of them in memory
+        self._entries = entries if entries is not None else {}
+        self._keys = {(flag, field): [] for flag in (None, True, False) for field in ('timestamp', 'confidence')}
+
+    def add(self, result: dict):
+        self._entries[result['id']] = result
+        for flag in (None, bool(result.get('has_detection'))):
+            # Results mostly arrive newest last, so the timestamp insert is an append
+            bisect.insort(self._keys[flag, 'timestamp'], (result['timestamp'], result['id']))
+            bisect.insort(self._keys[flag, 'confidence'], (result.get('confidence', 0.0), result['id']))
+
+    def clear(self):
+        self.__init__(self._entries)
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, entry_id: Optional[str]) -> Optional[dict]:
+        return self._entries[entry_id] if entry_id in self._entries else None
+
+    def count(self, has_detection: Optional[bool] = None) -> int:
+        return len(self._keys[has_detection, 'timestamp'])
+
+    def page(self, has_detection: Optional[bool] = None, order: str = NEWEST_FIRST,
+             offset: int = 0, limit: int = 20) -> List[dict]:
+        """Results ``offset`` to ``offset + limit`` of the filtered, ordered history."""
+        keys = self._keys[has_detection, 'confidence' if order == HIGHEST_CONFIDENCE else 'timestamp']
+        if order == OLDEST_FIRST:
+            window = keys[offset:offset + limit]
+        else:
+            # Descending orders walk the ascending list from the end
+            end = max(len(keys) - offset, 0)
+            window = reversed(keys[max(end - limit, 0):end])
+        return [self._entries[entry_id] for _, entry_id in window]
+
+    def recent(self, limit: int = 5) -> List[dict]:
+        return self.page(offset=0, limit=limit)
+
+    def position_of_date(self, day: date, has_detection: Optional[bool] = None,
+                         order: str = NEWEST_FIRST) -> int:
+        """Offset of the first result on ``day`` (or the nearest earlier day when
+        newest first, later day when oldest first) in a time-ordered page sequence."""
+        keys = self._keys[has_detection, 'timestamp']
+        if order == OLDEST_FIRST:
+            return bisect.bisect_left(keys, (datetime.combine(day, time.min), ''))
+        # Ids are hex uuids, so '~' sorts after every id with the same timestamp
+        return len(keys) - bisect.bisect_right(keys, (datetime.combine(day, time.max), '~'))
+
+    def date_range(self):
+        keys = self._keys[None, 'timestamp']
+        if not keys:
+            return None
+        return keys[0][0].date(), keys[-1][0].date()
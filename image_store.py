@@ -0,0 +1,135 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Optional, Tuple
+
+import config
+
+THUMBNAIL_SIZE = 256
+CHUNK_SIZE = 1024 * 1024
+
+
+class ImageStore:
+    """Content-addressed image files on disk, keyed by SHA-256 of the raw bytes."""
+
+    def __init__(self, root: str = config.IMAGE_STORE_DIR, thumbnail_cache_entries: int = 256):
+        self.root = root
+        self._thumb_cache = OrderedDict()
+        self._thumb_cache_entries = thumbnail_cache_entries
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def thumbnail_path(self, digest: str, size: int) -> str:
+        return os.path.join(self.root, "thumbs", str(size), digest[:2], f"{digest}.png")
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        if not self.exists(digest):
+            atomic_write(self.path(digest), data)
+        return digest
+
+    def put_stream(self, fileobj, chunk_size: int = CHUNK_SIZE) -> Tuple[str, int, bool]:
+        """Copy ``fileobj`` in chunks, hashing as it goes.
+
+        Returns (digest, size, is_new); if the content was already stored the
+        temporary copy is discarded.
+        """
+        objects_dir = os.path.join(self.root, "objects")
+        fd, tmp_path = tempfile.mkstemp(dir=objects_dir, prefix=".tmp-")
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = fileobj.read(chunk_size)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            digest = sha256.hexdigest()
+            if self.exists(digest):
+                os.remove(tmp_path)
+                return digest, size, False
+            os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+            os.replace(tmp_path, self.path(digest))
+            return digest, size, True
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path(digest), "rb") as f:
+            return f.read()
+
+    def thumbnail(self, digest: str, size: int = THUMBNAIL_SIZE) -> Optional[bytes]:
+        """PNG thumbnail, rendered on first request and then served from disk/memory."""
+        key = (digest, size)
+        with self._lock:
+            if key in self._thumb_cache:
+                self._thumb_cache.move_to_end(key)
+                return self._thumb_cache[key]
+
+        thumb_path = self.thumbnail_path(digest, size)
+        if os.path.exists(thumb_path):
+            with open(thumb_path, "rb") as f:
+                data = f.read()
+        elif self.exists(digest):
+            data = _render_thumbnail(self.path(digest), size)
+            atomic_write(thumb_path, data)
+        else:
+            return None
+
+        with self._lock:
+            self._thumb_cache[key] = data
+            if len(self._thumb_cache) > self._thumb_cache_entries:
+                self._thumb_cache.popitem(last=False)
+        return data
+
+
+def _render_thumbnail(path: str, size: int) -> bytes:
+    from PIL import Image
+
+    with Image.open(path) as img:
+        img.draft("L", (size, size))
+        thumb = img.convert("L")
+        thumb.thumbnail((size, size))
+    buffer = BytesIO()
+    thumb.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def atomic_write(path: str, data: bytes):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_image_store() -> ImageStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ImageStore()
+        return _store
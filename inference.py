@@ -0,0 +1,359 @@
+import hashlib
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Callable, List, Optional
+
+import numpy as np
+
+import config
+from heatmaps import quantize
+from image_store import atomic_write
+from preprocessing import PREPROCESS_PARAMS, decode, preprocess_image
+from result_cache import cache_key
+from telemetry import span
+
+DISEASES = [
+    'Choroidal Neovascularization (CNV)',
+    'Diabetic Macular Edema',
+    'Age-related Macular Degeneration',
+    'Macular Hole',
+    'Epiretinal Membrane'
+]
+CLASSES = ['Normal'] + DISEASES
+
+KERNEL_SIZE = 7
+POOL_SIZE = 4
+NUM_FILTERS = 16
+
+STAGES = ['decode', 'preprocess', 'infer']
+
+WEIGHT_NAMES = ('conv_w', 'conv_b', 'fc_w', 'fc_b', 'classes', 'version')
+
+# Version of the untrained stand-in loaded when RETINAVIEW_PLACEHOLDER_MODEL is set
+PLACEHOLDER_VERSION = 'placeholder-untrained-1'
+
+# Put on an engine's queue, once per batcher thread, when the engine is retired
+_STOP = object()
+
+
+@dataclass
+class Prediction:
+    label: str
+    confidence: float
+    probabilities: dict
+    model_version: str
+    heatmap_ref: Optional[str] = None
+    # Quantized class activation map from the same forward pass; stored by ref, never serialized
+    heatmap: Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+    has_detection: bool = field(init=False)
+
+    def __post_init__(self):
+        self.has_detection = self.label != 'Normal'
+
+    def to_dict(self) -> dict:
+        return {'label': self.label, 'confidence': self.confidence,
+                'probabilities': self.probabilities, 'model_version': self.model_version,
+                'heatmap_ref': self.heatmap_ref}
+
+
+def risk_level_for(has_detection: bool, confidence: float) -> str:
+    if has_detection and confidence > config.HIGH_RISK_CONFIDENCE:
+        return 'High Risk'
+    return 'Medium Risk' if has_detection else 'Low Risk'
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+# Models
+class NumpyClassifier:
+    """Conv features -> global average pooling -> linear head, on the CPU."""
+
+    def __init__(self, conv_w, conv_b, fc_w, fc_b, classes, version):
+        self.conv_w = np.asarray(conv_w, dtype=np.float32)
+        self.conv_b = np.asarray(conv_b, dtype=np.float32)
+        self.fc_w = np.asarray(fc_w, dtype=np.float32)
+        self.fc_b = np.asarray(fc_b, dtype=np.float32)
+        self.classes = list(classes)
+        self.version = version
+
+    @classmethod
+    def from_npz(cls, path: str) -> 'NumpyClassifier':
+        with np.load(path, allow_pickle=False) as weights:
+            return cls(
+                weights['conv_w'], weights['conv_b'], weights['fc_w'], weights['fc_b'],
+                [str(c) for c in weights['classes']], str(weights['version'])
+            )
+
+    @classmethod
+    def mapped(cls, path: str) -> 'NumpyClassifier':
+        """Weights memory-mapped read-only, so every process serving the model shares one copy in the page cache.
+
+        ``.npz`` archives can't be mapped, so each is unpacked once into a
+        directory of ``.npy`` files named after the archive's hash.
+        """
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        unpacked = os.path.join(os.path.dirname(path) or '.', '.mapped', digest)
+        if not os.path.exists(os.path.join(unpacked, 'version.npy')):
+            with np.load(path, allow_pickle=False) as weights:
+                # version.npy is written last; its presence marks a complete directory
+                for name in WEIGHT_NAMES:
+                    array = weights[name]
+                    if array.dtype.kind == 'f':
+                        array = array.astype(np.float32)
+                    buffer = BytesIO()
+                    np.save(buffer, array, allow_pickle=False)
+                    atomic_write(os.path.join(unpacked, f"{name}.npy"), buffer.getvalue())
+        weights = {name: np.load(os.path.join(unpacked, f"{name}.npy"), mmap_mode='r', allow_pickle=False)
+                   for name in WEIGHT_NAMES}
+        return cls(weights['conv_w'], weights['conv_b'], weights['fc_w'], weights['fc_b'],
+                   [str(c) for c in weights['classes']], str(weights['version']))
+
+    @classmethod
+    def placeholder(cls) -> 'NumpyClassifier':
+        """Deterministic untrained weights, for demos and benchmarks; the predictions mean nothing."""
+        rng = np.random.default_rng(20240729)
+        conv_w = rng.standard_normal((NUM_FILTERS, KERNEL_SIZE, KERNEL_SIZE)).astype(np.float32)
+        conv_w -= conv_w.mean(axis=(1, 2), keepdims=True)
+        conv_w /= np.linalg.norm(conv_w, axis=(1, 2), keepdims=True)
+        conv_b = np.zeros(NUM_FILTERS, dtype=np.float32)
+        fc_w = rng.standard_normal((len(CLASSES), NUM_FILTERS)).astype(np.float32) * 0.5
+        fc_b = np.zeros(len(CLASSES), dtype=np.float32)
+        fc_b[0] = 1.0
+        return cls(conv_w, conv_b, fc_w, fc_b, CLASSES, PLACEHOLDER_VERSION)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez(
+            path, conv_w=self.conv_w, conv_b=self.conv_b, fc_w=self.fc_w, fc_b=self.fc_b,
+            classes=np.array(self.classes), version=np.array(self.version)
+        )
+
+    def features(self, batch: np.ndarray) -> np.ndarray:
+        """(N, H, W) -> (N, C, H', W') rectified, pooled feature maps."""
+        windows = np.lib.stride_tricks.sliding_window_view(batch, (KERNEL_SIZE, KERNEL_SIZE), axis=(1, 2))
+        fmap = np.einsum('nhwij,cij->nchw', windows, self.conv_w, optimize=True)
+        fmap += self.conv_b[None, :, None, None]
+        np.maximum(fmap, 0, out=fmap)
+        n, c, h, w = fmap.shape
+        h, w = h - h % POOL_SIZE, w - w % POOL_SIZE
+        fmap = fmap[:, :, :h, :w].reshape(n, c, h // POOL_SIZE, POOL_SIZE, w // POOL_SIZE, POOL_SIZE)
+        return fmap.mean(axis=(3, 5))
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        pooled = self.features(batch).mean(axis=(2, 3))
+        return _softmax(pooled @ self.fc_w.T + self.fc_b)
+
+    def predict_with_cam(self, batch: np.ndarray):
+        """Probabilities plus, per image, the class activation map of its top class.
+
+        The CAM weights the same pooled feature maps by the top class's head
+        weights, so it costs one small einsum on top of ``predict``.
+        """
+        fmap = self.features(batch)
+        probs = _softmax(fmap.mean(axis=(2, 3)) @ self.fc_w.T + self.fc_b)
+        cams = np.einsum('nchw,nc->nhw', fmap, self.fc_w[probs.argmax(axis=1)], optimize=True)
+        return probs, cams
+
+
+class OnnxClassifier:
+    """Wraps an ONNX graph taking (N, 1, H, W) float32 and returning class logits."""
+
+    def __init__(self, path: str, classes: Optional[List[str]] = None):
+        import onnxruntime as ort
+
+        self.session = ort.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.classes = list(classes or CLASSES)
+        meta = self.session.get_modelmeta()
+        self.version = meta.custom_metadata_map.get('version') or f"onnx-{meta.version}"
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        logits = self.session.run(None, {self.input_name: batch[:, None, :, :].astype(np.float32)})[0]
+        return _softmax(np.asarray(logits, dtype=np.float32))
+
+
+class ModelNotInstalled(RuntimeError):
+    pass
+
+
+def is_placeholder(model_version: Optional[str]) -> bool:
+    return model_version == PLACEHOLDER_VERSION
+
+
+def load_model(path: str = config.MODEL_PATH):
+    if path.endswith('.onnx') and os.path.exists(path):
+        return OnnxClassifier(path)
+    if os.path.exists(path):
+        return NumpyClassifier.mapped(path)
+    if config.PLACEHOLDER_MODEL:
+        return NumpyClassifier.placeholder()
+    raise ModelNotInstalled(f"No model weights at {path}. Install a trained model there (or set "
+                            f"RETINAVIEW_MODEL_PATH); RETINAVIEW_PLACEHOLDER_MODEL=1 runs an untrained demo model")
+
+
+# Micro-batching engine
+class InferenceEngine:
+    """Runs one model on background threads, grouping requests that arrive together.
+
+    ``slots`` is shared by every engine in the process (see model_pool.py), so
+    the number of batches running at once stays capped however many models
+    and batcher threads there are.
+    """
+
+    def __init__(self, model, max_batch: int = config.INFERENCE_MAX_BATCH,
+                 max_wait_ms: float = config.INFERENCE_MAX_WAIT_MS, workers: int = 1,
+                 slots: Optional[threading.Semaphore] = None):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._requests = queue.Queue()
+        self._slots = slots
+        self._lock = threading.Lock()
+        self._successor: Optional['InferenceEngine'] = None
+        self._workers = [threading.Thread(target=self._run, name=f'inference-batcher-{number}', daemon=True)
+                         for number in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def model_version(self) -> str:
+        return self.model.version
+
+    @property
+    def retired(self) -> bool:
+        return self._successor is not None
+
+    def submit(self, tensor: np.ndarray) -> Future:
+        if np.ndim(tensor) != 2:
+            # Fail this request alone rather than the batch it would land in
+            future = Future()
+            future.set_exception(ValueError(f"Expected one (H, W) B-scan tensor, got shape {np.shape(tensor)}"))
+            return future
+        with self._lock:
+            if self._successor is not None:
+                # Callers still holding a swapped-out engine are served by its replacement
+                return self._successor.submit(tensor)
+            future = Future()
+            self._requests.put((tensor, future))
+            return future
+
+    def retire(self, successor: 'InferenceEngine'):
+        """Finish what is queued, then stop; later requests go to ``successor``."""
+        with self._lock:
+            self._successor = successor
+            for _ in self._workers:
+                self._requests.put(_STOP)
+
+    def predict(self, tensor: np.ndarray) -> Prediction:
+        return self.submit(tensor).result()
+
+    def predict_many(self, tensors: List[np.ndarray]) -> List[Prediction]:
+        futures = [self.submit(t) for t in tensors]
+        return [f.result() for f in futures]
+
+    def _collect(self):
+        first = self._requests.get()
+        if first is _STOP:
+            return None
+        pending = [first]
+        try:
+            while len(pending) < self.max_batch:
+                request = self._requests.get(timeout=self.max_wait)
+                if request is _STOP:
+                    # Everything queued before the stop is already in hand; leave it for the next loop
+                    self._requests.put(_STOP)
+                    break
+                pending.append(request)
+        except queue.Empty:
+            pass
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            if pending is None:
+                return
+            # Anything that goes wrong fails this batch's futures; the worker itself keeps serving
+            try:
+                batch = np.stack([tensor for tensor, _ in pending])
+                with self._slots if self._slots is not None else nullcontext():
+                    if hasattr(self.model, 'predict_with_cam'):
+                        probs, cams = self.model.predict_with_cam(batch)
+                    else:
+                        probs, cams = self.model.predict(batch), [None] * len(pending)
+                predictions = [self._to_prediction(row, cam) for row, cam in zip(probs, cams)]
+            except Exception as exc:
+                for _, future in pending:
+                    future.set_exception(exc)
+                continue
+            for prediction, (_, future) in zip(predictions, pending):
+                future.set_result(prediction)
+
+    def _to_prediction(self, row: np.ndarray, cam: Optional[np.ndarray] = None) -> Prediction:
+        top = int(row.argmax())
+        return Prediction(
+            label=self.model.classes[top],
+            confidence=float(row[top]) * 100,
+            probabilities={c: float(p) for c, p in zip(self.model.classes, row)},
+            model_version=self.model.version,
+            heatmap=quantize(cam) if cam is not None else None,
+        )
+
+    def run_pipeline(self, image_bytes: bytes, on_stage: Optional[Callable[[str], None]] = None,
+                     image_ref: Optional[str] = None, tensors=None) -> Prediction:
+        """Decode, preprocess and classify one scan, reporting each stage as it starts.
+
+        Given a tensor cache and the image hash, a cached tensor skips decode and preprocess.
+        """
+        tensor = tensors.get(image_ref) if tensors is not None and image_ref else None
+        if tensor is None:
+            if on_stage:
+                on_stage('decode')
+            with span('analysis.decode'):
+                pixels = decode(image_bytes)
+            if on_stage:
+                on_stage('preprocess')
+            with span('analysis.preprocess'):
+                tensor = preprocess_image(pixels)
+            if tensors is not None and image_ref:
+                tensors.put(image_ref, tensor)
+        if on_stage:
+            on_stage('infer')
+        with span('analysis.infer'):
+            return self.predict(tensor)
+
+    def analyze(self, image_bytes: bytes, image_ref: Optional[str] = None, cache=None,
+                on_stage: Optional[Callable[[str], None]] = None, tensors=None, heatmaps=None) -> Prediction:
+        """``run_pipeline`` behind the result cache when the image hash is known.
+
+        Given a heatmap store, the prediction's CAM is saved there before the
+        result is cached, so cache hits carry the ref of a heatmap that exists.
+        """
+        if cache is None or image_ref is None:
+            return self.run_pipeline(image_bytes, on_stage, image_ref, tensors)
+        key = cache_key(image_ref, self.model_version, PREPROCESS_PARAMS)
+        cached = cache.get(key)
+        if cached is not None:
+            return Prediction(**cached)
+        prediction = self.run_pipeline(image_bytes, on_stage, image_ref, tensors)
+        if heatmaps is not None and prediction.heatmap is not None:
+            prediction.heatmap_ref = heatmaps.put(prediction.heatmap, image_ref, prediction.model_version)
+        cache.put(key, prediction.to_dict())
+        return prediction
+
+
+def get_engine(version: Optional[str] = None) -> InferenceEngine:
+    """The process's engine for ``version`` (default: the pool's default model)."""
+    from model_pool import get_model_pool
+
+    return get_model_pool().engine(version)
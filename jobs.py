@@ -0,0 +1,162 @@
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
+
+import config
+from models import Job
+from storage import Database, Repository
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+# handler(payload, report) -> result; report(progress in [0, 1], message) records progress
+Handler = Callable[[dict, Callable[[float, str], None]], dict]
+
+
+class JobQueue(Repository):
+    """Jobs persisted in SQLite and run by a pool of worker threads.
+
+    Any process sharing the database can submit or poll; whichever process has
+    workers running picks queued jobs up, so work survives page switches and
+    session ends.
+    """
+
+    def __init__(self, db: Database, workers: int = config.JOB_WORKERS, poll_interval: float = 1.0):
+        super().__init__(db.pool)
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._handlers: Dict[str, Handler] = {}
+        self._wakeup = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def register(self, kind: str, handler: Handler):
+        self._handlers[kind] = handler
+
+    def start(self):
+        if self._threads:
+            return
+        self.requeue_stale()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Submitting and polling
+    def submit(self, kind: str, payload: dict, owner: Optional[str] = None) -> str:
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind {kind!r}")
+        job_id = uuid4().hex
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, owner, status, payload, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, owner, json.dumps(payload), now, now),
+            )
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.reader() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job(row) if row else None
+
+    def get_many(self, job_ids: List[str]) -> List[Job]:
+        if not job_ids:
+            return []
+        placeholders = ", ".join("?" for _ in job_ids)
+        with self.reader() as conn:
+            rows = conn.execute(f"SELECT * FROM jobs WHERE id IN ({placeholders})", job_ids).fetchall()
+        return [_job(row) for row in rows]
+
+    def recent(self, owner: Optional[str], limit: int = 10) -> List[Job]:
+        with self.reader() as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE owner IS ? ORDER BY created_at DESC LIMIT ?", (owner, limit)
+            ).fetchall()
+        return [_job(row) for row in rows]
+
+    # Worker side
+    def requeue_stale(self):
+        """Put back jobs whose worker stopped reporting, e.g. after a server restart."""
+        cutoff = (datetime.now() - timedelta(seconds=config.JOB_STALE_SECONDS)).isoformat()
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', progress = 0, message = 'requeued' "
+                "WHERE status = 'running' AND updated_at < ?", (cutoff,)
+            )
+
+    def _claim(self) -> Optional[Job]:
+        now = datetime.now().isoformat()
+        kinds = list(self._handlers)
+        placeholders = ", ".join("?" for _ in kinds)
+        with self.transaction() as conn:
+            row = conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, updated_at = ? "
+                f"WHERE id = (SELECT id FROM jobs WHERE status = 'queued' AND kind IN ({placeholders}) "
+                "ORDER BY created_at LIMIT 1) RETURNING *",
+                [now, now] + kinds,
+            ).fetchone()
+        return _job(row) if row else None
+
+    def _update(self, job_id: str, **fields):
+        fields["updated_at"] = datetime.now().isoformat()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self.transaction() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", list(fields.values()) + [job_id])
+
+    def _run(self, job: Job):
+        def report(progress: float, message: str = ""):
+            self._update(job.id, progress=progress, message=message)
+
+        try:
+            with span(f"job.{job.kind}"):
+                result = json.dumps(self._handlers[job.kind](job.payload, report))
+        except Exception as exc:
+            logger.exception("Job %s (%s) failed", job.id, job.kind)
+            self._fail(job, exc)
+        else:
+            self._update(job.id, status="succeeded", result=result, progress=1.0,
+                         finished_at=datetime.now().isoformat())
+
+    def _fail(self, job: Job, exc: Exception):
+        self._update(job.id, status="failed", error=f"{type(exc).__name__}: {exc}",
+                     finished_at=datetime.now().isoformat())
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception:
+                logger.exception("Could not claim a job")
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            try:
+                self._run(job)
+            except Exception as exc:
+                # Recording the outcome failed (the database was busy, say); retry as a failure so the
+                # job doesn't stay 'running' and this worker keeps serving the queue
+                logger.exception("Could not record the outcome of job %s", job.id)
+                try:
+                    self._fail(job, exc)
+                except Exception:
+                    logger.exception("Could not mark job %s failed", job.id)
+
+
+def _job(row) -> Job:
+    def parse(value):
+        return datetime.fromisoformat(value) if value else None
+
+    return Job(
+        id=row["id"], kind=row["kind"], owner=row["owner"], status=row["status"],
+        payload=json.loads(row["payload"]), result=json.loads(row["result"]) if row["result"] else None,
+        error=row["error"], progress=row["progress"], message=row["message"],
+        created_at=parse(row["created_at"]), started_at=parse(row["started_at"]),
+        finished_at=parse(row["finished_at"]),
+    )
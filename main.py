@@ -1,9 +1,18 @@
 import streamlit as st
-import base64
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import uuid
 
+import bootstrap
+import config
+from aggregates import AnalysisStats
+from history import HIGHEST_CONFIDENCE, NEWEST_FIRST, OLDEST_FIRST
+from models import PLACEHOLDER_NOTE
+from session_store import current_session_id
+from telemetry import span
+
+_run_started = bootstrap.start_run()
+
 # Page config
 st.set_page_config(
     page_title="OCT Analysis System",
@@ -13,45 +22,23 @@ st.set_page_config(
 )
 
 # Custom CSS
-st.markdown("""
-<style>
-    .main-header {
-        background: linear-gradient(135deg, #3b82f6, #8b5cf6);
-        padding: 1rem;
-        border-radius: 10px;
-        color: white;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    .upload-area {
-        border: 2px dashed #3b82f6;
-        border-radius: 10px;
-        padding: 2rem;
-        text-align: center;
-        background: #f8fafc;
-    }
-    .result-card {
-        background: white;
-        padding: 1.5rem;
-        border-radius: 10px;
-        box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        margin: 1rem 0;
-    }
-    .confidence-high { color: #10b981; }
-    .confidence-medium { color: #f59e0b; }
-    .confidence-low { color: #ef4444; }
-    .cnv-detected { background: #fef2f2; border-left: 4px solid #ef4444; }
-    .normal-result { background: #f0fdf4; border-left: 4px solid #10b981; }
-</style>
-""", unsafe_allow_html=True)
+bootstrap.inject_css()
 
 # Initialize session state
 if 'logged_in' not in st.session_state:
     st.session_state.logged_in = False
-if 'analysis_history' not in st.session_state:
-    st.session_state.analysis_history = []
-if 'current_analysis' not in st.session_state:
-    st.session_state.current_analysis = None
+# History entries live in a process-wide store that spills them to disk past its memory budget;
+# the current analysis is one of them, kept here by id
+_history = bootstrap.session_states().history(current_session_id())
+if st.session_state.get('analysis_history') is not _history:
+    # First run of this session, or its history expired while the tab sat idle
+    st.session_state.analysis_history = _history
+    st.session_state.analysis_stats = AnalysisStats()
+    st.session_state.current_analysis_id = None
+if 'pending_jobs' not in st.session_state:
+    st.session_state.pending_jobs = []
+
+bootstrap.finish_setup(_run_started)
 
 def login_page():
     st.markdown("""
@@ -70,54 +57,91 @@ def login_page():
         if st.button("เข้าสู่ระบบ", use_container_width=True):
             if username == "doctor" and password == "123456":
                 st.session_state.logged_in = True
+                st.session_state.username = username
                 st.rerun()
             else:
                 st.error("Invalid credentials. Use username: doctor, password: 123456")
         
         st.info("Demo: username: **doctor**, password: **123456**")
 
-def analyze_image(image_data):
-    """Simulate AI analysis"""
-    import random
-    import time
-    
-    # Simulate processing time
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    for i in range(100):
-        progress_bar.progress(i + 1)
-        status_text.text(f'Analyzing... {i+1}%')
-        time.sleep(0.02)
-    
-    # Generate random results
-    confidence = 70 + random.random() * 30
-    has_detection = random.random() > 0.3
-    
-    diseases = [
-        'Choroidal Neovascularization (CNV)',
-        'Diabetic Macular Edema',
-        'Age-related Macular Degeneration',
-        'Macular Hole',
-        'Epiretinal Membrane'
-    ]
-    
-    detected_disease = diseases[random.randint(0, len(diseases)-1)] if has_detection else None
-    
-    result = {
+def build_result(job):
+    """Turn a finished analysis job into a history entry"""
+    from inference import risk_level_for
+    
+    prediction = job.result['prediction']
+    has_detection = prediction['label'] != 'Normal'
+    return {
         'id': str(uuid.uuid4()),
-        'timestamp': datetime.now(),
+        'job_id': job.id,
+        'timestamp': job.finished_at or datetime.now(),
         'has_detection': has_detection,
-        'confidence': confidence,
-        'detected_disease': detected_disease,
-        'risk_level': 'High Risk' if (has_detection and confidence > 85) else 'Medium Risk' if has_detection else 'Low Risk',
-        'image_data': image_data
+        'confidence': prediction['confidence'],
+        'detected_disease': prediction['label'] if has_detection else None,
+        'risk_level': risk_level_for(has_detection, prediction['confidence']),
+        'probabilities': prediction['probabilities'],
+        'model_version': prediction['model_version'],
+        'image_ref': job.payload['image_ref'],
+        # Stored once by the job; the overlay is only drawn when someone looks at it
+        'heatmap_ref': prediction.get('heatmap_ref'),
+        # Volumes are shown by their most suspicious B-scan
+        'thumbnail_ref': job.result.get('thumbnail_ref'),
+        'volume': job.result.get('volume')
     }
+
+def placeholder_tag(analysis):
+    """Card line marking a result of the untrained placeholder model"""
+    from inference import is_placeholder
     
-    progress_bar.empty()
-    status_text.empty()
-    
-    return result
+    if not is_placeholder(analysis.get('model_version')):
+        return ''
+    return f"<br><small><strong>🧪 {PLACEHOLDER_NOTE}</strong></small>"
+
+def collect_finished_jobs():
+    """Move finished background analyses into this session's history"""
+    if not st.session_state.pending_jobs:
+        return
+    for job in bootstrap.job_queue().get_many(st.session_state.pending_jobs):
+        if not job.done:
+            continue
+        st.session_state.pending_jobs.remove(job.id)
+        if job.status == 'failed':
+            st.toast(f"Analysis failed: {job.error}", icon="❌")
+            continue
+        result = build_result(job)
+        st.session_state.analysis_history.add(result)
+        st.session_state.analysis_stats.add(result)
+        if job.id == st.session_state.get('result_job'):
+            st.session_state.current_analysis_id = result['id']
+
+@st.fragment(run_every=2)
+def job_status_panel():
+    """Poll this session's queued analyses without rerunning the whole page"""
+    jobs = bootstrap.job_queue().get_many(st.session_state.pending_jobs)
+    if any(job.done for job in jobs):
+        st.rerun()
+    for job in jobs:
+        st.progress(job.progress, text=f"Analysis {job.id[:8]}: {job.message or job.status}")
+
+def store_upload(uploaded_file):
+    """Hash and store an upload once, not on every rerun"""
+    refs = st.session_state.setdefault('upload_refs', {})
+    if uploaded_file.file_id not in refs:
+        uploaded_file.seek(0)
+        with span('upload.write'):
+            refs[uploaded_file.file_id], _, _ = bootstrap.image_store().put_stream(uploaded_file)
+        uploaded_file.seek(0)
+    return refs[uploaded_file.file_id]
+
+def show_thumbnail(analysis, heatmap=False):
+    if heatmap:
+        overlay = bootstrap.heatmap_store().overlay(analysis.get('heatmap_ref'))
+        if overlay:
+            st.image(overlay, use_column_width=True)
+            return
+    thumbnail_ref = analysis.get('thumbnail_ref') or analysis.get('image_ref')
+    thumbnail = bootstrap.image_store().thumbnail(thumbnail_ref) if thumbnail_ref else None
+    if thumbnail:
+        st.image(thumbnail, use_column_width=True)
 
 def dashboard_page():
     st.markdown("""
@@ -128,33 +152,64 @@ def dashboard_page():
     """, unsafe_allow_html=True)
     
     # Stats
-    total_analyses = len(st.session_state.analysis_history)
-    cnv_detected = sum(1 for a in st.session_state.analysis_history if a.get('has_detection', False))
-    normal_results = total_analyses - cnv_detected
-    avg_confidence = sum(a.get('confidence', 0) for a in st.session_state.analysis_history) / max(total_analyses, 1)
+    stats = st.session_state.analysis_stats
     
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        st.metric("Total Analyses", total_analyses, delta=None)
+        st.metric("Total Analyses", stats.total, delta=None)
     with col2:
-        st.metric("CNV Detected", cnv_detected, delta=None)
+        st.metric("CNV Detected", stats.detections, delta=None)
     with col3:
-        st.metric("Normal Results", normal_results, delta=None)
+        st.metric("Normal Results", stats.normal, delta=None)
     with col4:
-        st.metric("Avg Confidence", f"{avg_confidence:.1f}%", delta=None)
+        st.metric("Avg Confidence", f"{stats.mean_confidence:.1f}%", delta=None,
+                  help=f"Standard deviation {stats.std_confidence:.1f}")
+    
+    # Rolling windows
+    last_day = stats.window(timedelta(hours=24))
+    last_week = stats.window(timedelta(days=7))
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Analyses (24h)", last_day.total)
+    with col2:
+        st.metric("Detections (24h)", last_day.detections)
+    with col3:
+        st.metric("Analyses (7d)", last_week.total)
+    with col4:
+        st.metric("Avg Confidence (7d)", f"{last_week.mean_confidence:.1f}%")
+    
+    if stats.total:
+        col1, col2 = st.columns(2)
+        with col1:
+            st.markdown("#### By Result")
+            st.bar_chart({"Analyses": dict(stats.by_disease)})
+        with col2:
+            st.markdown("#### By Risk Level")
+            st.bar_chart({"Analyses": dict(stats.by_risk)})
+    
+    # Background jobs, including ones started from other sessions
+    jobs = bootstrap.job_queue().recent(st.session_state.get('username'), limit=5)
+    if jobs:
+        st.markdown("### Background Jobs")
+        for job in jobs:
+            finished = job.finished_at.strftime('%H:%M:%S') if job.finished_at else '-'
+            st.write(f"`{job.id[:8]}` {job.kind} — **{job.status}** ({job.progress * 100:.0f}%), finished {finished}")
     
     # Recent analyses
     st.markdown("### Recent Analyses")
     if st.session_state.analysis_history:
-        for analysis in st.session_state.analysis_history[:5]:
+        for analysis in st.session_state.analysis_history.recent(5):
             result_class = "cnv-detected" if analysis.get('has_detection') else "normal-result"
-            st.markdown(f"""
+            thumb_col, card_col = st.columns([1, 6])
+            with thumb_col:
+                show_thumbnail(analysis)
+            card_col.markdown(f"""
             <div class="result-card {result_class}">
                 <div style="display: flex; justify-content: space-between; align-items: center;">
                     <div>
                         <strong>Analysis {analysis['id'][:8]}</strong><br>
-                        <small>{analysis['timestamp'].strftime('%Y-%m-%d %H:%M')}</small>
+                        <small>{analysis['timestamp'].strftime('%Y-%m-%d %H:%M')}</small>{placeholder_tag(analysis)}
                     </div>
                     <div style="text-align: right;">
                         <span style="font-weight: bold;">
@@ -178,40 +233,58 @@ def upload_page():
     
     uploaded_file = st.file_uploader(
         "Choose an OCT image file",
-        type=['png', 'jpg', 'jpeg', 'bmp', 'tiff'],
-        help="Upload OCT B-Scan images in common formats"
+        type=['png', 'jpg', 'jpeg', 'bmp', 'tif', 'tiff', 'dcm'],
+        help="Upload OCT B-Scan images in common formats, or a multi-page TIFF / DICOM volume"
     )
     
     if uploaded_file is not None:
+        # Keep the scan on disk; history only holds its hash
+        image_ref = store_upload(uploaded_file)
+        volume = bootstrap.load_volume(image_ref)
+        is_volume = len(volume) > 1 or volume.format == 'dicom'
+        
         # Display image
         col1, col2 = st.columns([2, 1])
         
         with col1:
-            st.image(uploaded_file, caption="Uploaded OCT Image", use_column_width=True)
+            if is_volume:
+                # Only the slice on screen is decoded
+                slice_index = st.slider("B-scan", 1, len(volume), (len(volume) + 1) // 2) - 1 if len(volume) > 1 else 0
+                st.image(volume.get_slice(slice_index), caption=f"B-scan {slice_index + 1} of {len(volume)}",
+                         use_column_width=True)
+            else:
+                st.image(uploaded_file, caption="Uploaded OCT Image", use_column_width=True)
         
         with col2:
             st.markdown("### Image Information")
             st.write(f"**Filename:** {uploaded_file.name}")
             st.write(f"**Size:** {uploaded_file.size} bytes")
             st.write(f"**Type:** {uploaded_file.type}")
+            if is_volume:
+                st.write(f"**B-scans:** {len(volume)}")
         
         if st.button("🔍 Start Analysis", use_container_width=True, type="primary"):
-            # Convert image to base64 for storage
-            image_data = base64.b64encode(uploaded_file.read()).decode()
-            
-            # Analyze image
-            with st.spinner("Analyzing image..."):
-                result = analyze_image(image_data)
-                st.session_state.current_analysis = result
-                st.session_state.analysis_history.insert(0, result)
-            
+            # Analysis runs in the background and keeps going if the user navigates away
+            job_id = bootstrap.job_queue().submit(
+                'analyze', {'image_ref': image_ref, 'volume': is_volume}, owner=st.session_state.get('username')
+            )
+            st.session_state.pending_jobs.append(job_id)
+            st.session_state.result_job = job_id
+        
+        result = st.session_state.analysis_history.get(st.session_state.current_analysis_id)
+        if result and result.get('job_id') == st.session_state.get('result_job') and result['image_ref'] == image_ref:
             # Show results
             show_results(result)
 
 def show_results(result):
+    from inference import is_placeholder
+    
     st.markdown("---")
     st.markdown("## 📊 Analysis Results")
     
+    if is_placeholder(result.get('model_version')):
+        st.error(f"🧪 {PLACEHOLDER_NOTE} No trained model is installed; these results are for demonstration only.")
+    
     # Main result
     if result['has_detection']:
         st.markdown(f"""
@@ -232,6 +305,23 @@ def show_results(result):
         </div>
         """, unsafe_allow_html=True)
     
+    if result.get('heatmap_ref'):
+        with st.expander("🔥 Where the model looked", expanded=result['has_detection']):
+            overlay = bootstrap.heatmap_store().overlay(result['heatmap_ref'])
+            if overlay:
+                caption = "Class activation map over the flattened B-scan the model analysed"
+                if result.get('volume'):
+                    caption += f" (B-scan {result['volume']['worst_slice'] + 1})"
+                st.image(overlay, caption=caption, width=384)
+            else:
+                st.info("Heatmap not available")
+    
+    if result.get('volume'):
+        volume = result['volume']
+        st.markdown(f"**Volume:** {volume['abnormal_slices']} of {volume['num_slices']} B-scans flagged, "
+                    f"most suspicious is B-scan {volume['worst_slice'] + 1}")
+        st.line_chart({"Confidence per B-scan": volume['slice_confidences']})
+    
     # Confidence visualization
     col1, col2 = st.columns(2)
     
@@ -254,40 +344,52 @@ def show_results(result):
             st.success("✅ Continue routine eye examinations")
     
     # Download report button
-    if st.button("📄 Download Report", use_container_width=True):
-        report_data = generate_report(result)
-        st.download_button(
-            label="Download Analysis Report",
-            data=report_data,
-            file_name=f"OCT_Analysis_Report_{result['id'][:8]}_{datetime.now().strftime('%Y%m%d')}.txt",
-            mime="text/plain"
-        )
+    st.download_button(
+        label="📄 Download Report",
+        data=generate_report(result),
+        file_name=f"OCT_Analysis_Report_{result['id'][:8]}_{result['timestamp'].strftime('%Y%m%d')}.pdf",
+        mime="application/pdf",
+        use_container_width=True
+    )
 
 def generate_report(result):
-    report = f"""
-OCT ANALYSIS REPORT
-==================
-
-Analysis ID: {result['id']}
-Analysis Date: {result['timestamp'].strftime('%Y-%m-%d')}
-Analysis Time: {result['timestamp'].strftime('%H:%M:%S')}
-
-ANALYSIS RESULTS:
-- Status: {'CNV DETECTED' if result['has_detection'] else 'NORMAL'}
-- Confidence: {result['confidence']:.1f}%
-- Risk Level: {result['risk_level']}
-{f"- Detected Disease: {result['detected_disease']}" if result.get('detected_disease') else ''}
+    """PDF report for one session analysis; rendered once, then read from the report cache"""
+    from inference import is_placeholder
+    from models import AnalysisResult
+    from reports import ReportData, render_report
+    
+    if result['has_detection']:
+        recommendation = 'Urgent referral to retina specialist' if result['confidence'] > 85 else 'Further evaluation recommended'
+    else:
+        recommendation = 'Continue routine examinations'
+    details = f"Risk level {result['risk_level']}. {recommendation}."
+    if is_placeholder(result.get('model_version')):
+        details = f"{PLACEHOLDER_NOTE} {details}"
+    analysis = AnalysisResult(
+        patient_id=result['id'][:8],
+        diagnosis=result['detected_disease'] or 'Normal',
+        confidence=result['confidence'],
+        details=details,
+        created_at=result['timestamp'],
+        image_ref=result.get('thumbnail_ref') or result['image_ref'],
+        probabilities=result.get('probabilities'),
+        heatmap_ref=result.get('heatmap_ref')
+    )
+    path = render_report(ReportData(patient_id=result['id'][:8], analyses=[analysis]))
+    with open(path, 'rb') as f:
+        return f.read()
 
-SUMMARY:
-{result['detected_disease'] + ' detected' if result['has_detection'] else 'No abnormalities detected'} with {result['confidence']:.1f}% confidence.
+HISTORY_FILTERS = {"All Results": None, "CNV Detected": True, "Normal": False}
+HISTORY_SORTS = {"Newest First": NEWEST_FIRST, "Oldest First": OLDEST_FIRST, "Highest Confidence": HIGHEST_CONFIDENCE}
+HISTORY_PAGE_SIZES = sorted({10, 20, 50, 100, config.HISTORY_PAGE_SIZE})
 
-RECOMMENDATIONS:
-{('- Urgent referral to retina specialist' if result['confidence'] > 85 else '- Further evaluation recommended') if result['has_detection'] else '- Continue routine examinations'}
+def reset_history_page():
+    st.session_state.history_page = 1
 
-Generated by OCT Analysis System
-    """.strip()
-    
-    return report
+def jump_to_date(history, has_detection, order, page_size, pages):
+    """Open the page holding the first result on (or nearest to) the chosen day"""
+    offset = history.position_of_date(st.session_state.history_jump_date, has_detection, order)
+    st.session_state.history_page = min(offset // page_size + 1, pages)
 
 def history_page():
     st.markdown("""
@@ -301,50 +403,86 @@ def history_page():
         st.info("No analysis history found. Start analyzing OCT images to see history here.")
         return
     
+    history = st.session_state.analysis_history
+    
     # Filters
-    col1, col2, col3 = st.columns([2, 2, 1])
+    col1, col2, col3, col4, col5 = st.columns([2, 2, 1, 1, 1])
     
     with col1:
         filter_option = st.selectbox(
             "Filter by Result",
-            ["All Results", "CNV Detected", "Normal"]
+            list(HISTORY_FILTERS),
+            key="history_filter",
+            on_change=reset_history_page
         )
     
     with col2:
         sort_option = st.selectbox(
             "Sort by",
-            ["Newest First", "Oldest First", "Highest Confidence"]
+            list(HISTORY_SORTS),
+            key="history_sort",
+            on_change=reset_history_page
         )
     
     with col3:
+        page_size = st.selectbox(
+            "Per page",
+            HISTORY_PAGE_SIZES,
+            index=HISTORY_PAGE_SIZES.index(config.HISTORY_PAGE_SIZE),
+            key="history_page_size",
+            on_change=reset_history_page
+        )
+    
+    with col4:
+        show_heatmaps = st.toggle("Heatmaps", key="history_heatmaps",
+                                  help="Show where the model looked instead of the scan thumbnail")
+    
+    with col5:
         if st.button("🗑️ Clear History"):
-            st.session_state.analysis_history = []
+            history.clear()
+            st.session_state.analysis_stats.clear()
+            reset_history_page()
             st.rerun()
     
-    # Apply filters
-    filtered_history = st.session_state.analysis_history.copy()
-    
-    if filter_option == "CNV Detected":
-        filtered_history = [a for a in filtered_history if a.get('has_detection', False)]
-    elif filter_option == "Normal":
-        filtered_history = [a for a in filtered_history if not a.get('has_detection', False)]
+    has_detection = HISTORY_FILTERS[filter_option]
+    order = HISTORY_SORTS[sort_option]
+    total = history.count(has_detection)
+    if not total:
+        st.info("No analyses match this filter.")
+        return
+    pages = (total + page_size - 1) // page_size
+    st.session_state.history_page = min(st.session_state.get('history_page', 1), pages)
     
-    # Apply sorting
-    if sort_option == "Oldest First":
-        filtered_history.reverse()
-    elif sort_option == "Highest Confidence":
-        filtered_history.sort(key=lambda x: x.get('confidence', 0), reverse=True)
+    # Paging and jump-to-date
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, step=1, key="history_page")
+    with col2:
+        if order != HIGHEST_CONFIDENCE:
+            first_day, last_day = history.date_range()
+            day_col, go_col = st.columns([3, 1])
+            day_col.date_input("Jump to date", value=last_day, min_value=first_day,
+                                     max_value=last_day, key="history_jump_date")
+            go_col.button("Go", on_click=jump_to_date,
+                          args=(history, has_detection, order, page_size, pages))
+    
+    offset = (page - 1) * page_size
+    filtered_history = history.page(has_detection, order, offset, page_size)
+    st.caption(f"Showing {offset + 1}-{offset + len(filtered_history)} of {total}")
     
     # Display history
     for analysis in filtered_history:
         result_class = "cnv-detected" if analysis.get('has_detection') else "normal-result"
-        st.markdown(f"""
+        thumb_col, card_col = st.columns([1, 6])
+        with thumb_col:
+            show_thumbnail(analysis, heatmap=show_heatmaps)
+        card_col.markdown(f"""
         <div class="result-card {result_class}">
             <div style="display: flex; justify-content: space-between; align-items: center;">
                 <div>
                     <strong>Analysis {analysis['id'][:8]}</strong><br>
                     <small>{analysis['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}</small><br>
-                    {f"<small><strong>Disease:</strong> {analysis.get('detected_disease', 'N/A')}</small>" if analysis.get('has_detection') else ''}
+                    {f"<small><strong>Disease:</strong> {analysis.get('detected_disease', 'N/A')}</small>" if analysis.get('has_detection') else ''}{placeholder_tag(analysis)}
                 </div>
                 <div style="text-align: right;">
                     <span style="font-weight: bold;">
@@ -357,30 +495,149 @@ def history_page():
         </div>
         """, unsafe_allow_html=True)
 
+def performance_page():
+    st.markdown("""
+    <div class="main-header">
+        <h1>📈 Performance</h1>
+        <p>Where time and memory go in this server process</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    bootstrap.performance_panel(history_key='analysis_history')
+    
+    st.markdown("### Session State")
+    states = bootstrap.session_states()
+    sessions = states.status()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Sessions", len(sessions))
+    col2.metric("History in Memory", f"{states.resident_bytes / 1024:.0f} KB",
+                f"budget {states.total_bytes / 2 ** 20:.0f} MB", delta_color="off")
+    col3.metric("Spilled to Disk", f"{sum(s['entries'] - s['in_memory'] for s in sessions)} entries")
+    st.dataframe([{"session": s['session'][:8], "entries": s['entries'], "in memory": s['in_memory'],
+                   "KB": round(s['bytes'] / 1024, 1), "idle s": round(s['idle_s'])} for s in sessions],
+                 use_container_width=True)
+    st.caption(f"Each session keeps up to {states.session_bytes / 1024:.0f} KB of history in memory; "
+               f"sessions idle for {states.idle_seconds / 60:.0f} min are spilled whole")
+
+def admin_page():
+    st.markdown("""
+    <div class="main-header">
+        <h1>⚙️ Admin</h1>
+        <p>Model and cache status</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    st.markdown("### Models")
+    pool = bootstrap.model_pool()
+    if pool.default_version is None:
+        st.warning(f"No model loaded, so analyses will fail. {pool.missing or ''}")
+    st.dataframe([{"version": m['version'], "default": m['default'], "path": m['path'],
+                   "loaded": m['loaded_at'].strftime('%Y-%m-%d %H:%M:%S'),
+                   "load ms": round(m['load_ms'], 1), "warm-up ms": round(m['warmup_ms'], 1)}
+                  for m in pool.status()], use_container_width=True)
+    st.caption(f"Shared by every session in this process; at most {pool.max_concurrency} inferences run at once")
+    col1, col2 = st.columns(2)
+    with col1:
+        versions = [m['version'] for m in pool.status()]
+        if versions:
+            default = st.selectbox("Default model", versions, index=versions.index(pool.default_version))
+            if default != pool.default_version and st.button("Make Default"):
+                pool.set_default(default)
+                st.rerun()
+    with col2:
+        model_path = st.text_input("Load model from path", placeholder=config.MODEL_PATH)
+        if st.button("Load / Hot-swap") and model_path:
+            # Analyses already running finish on the old weights; new ones use these once loaded
+            try:
+                loaded = pool.load(model_path)
+            except Exception as exc:
+                st.error(f"Could not load {model_path}: {exc}")
+            else:
+                st.success(f"Loaded {loaded.version} (warm-up {loaded.warmup_seconds * 1000:.0f} ms)")
+    
+    st.markdown("### Result Cache")
+    cache = bootstrap.result_cache()
+    stats = cache.stats()
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Memory Hits", stats['memory_hits'])
+    with col2:
+        st.metric("Disk Hits", stats['disk_hits'])
+    with col3:
+        st.metric("Misses", stats['misses'])
+    with col4:
+        st.metric("Hit Rate", f"{stats['hit_rate'] * 100:.1f}%")
+    st.caption(f"{stats['memory_entries']} entries in memory, "
+               f"{stats['memory_bytes'] / 1024:.1f} KiB of {stats['memory_budget'] / 1024 / 1024:.0f} MiB budget")
+    if st.button("Clear In-Memory Cache"):
+        cache.clear_memory()
+        st.rerun()
+    
+    st.markdown("### Tensor Cache")
+    tensor_stats = bootstrap.tensor_cache().stats()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Hits", tensor_stats['hits'])
+    with col2:
+        st.metric("Misses", tensor_stats['misses'])
+    with col3:
+        st.metric("Hit Rate", f"{tensor_stats['hit_rate'] * 100:.1f}%")
+    st.caption("Counts cover analyses run by this process's job workers")
+    
+    st.markdown("### Script Runs")
+    timings = bootstrap.run_timings().summary()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Cold Start", f"{timings['cold_start_ms']:.0f} ms" if timings['cold_start_ms'] is not None else "-")
+    with col2:
+        st.metric("Rerun Setup p50", f"{timings['rerun_p50_ms']:.1f} ms" if timings['rerun_p50_ms'] is not None else "-")
+    with col3:
+        st.metric("Rerun Setup Max", f"{timings['rerun_max_ms']:.1f} ms" if timings['rerun_max_ms'] is not None else "-")
+    st.caption(f"Over the last {timings['reruns']} reruns in this process")
+
 def main():
     if not st.session_state.logged_in:
         login_page()
         return
     
+    collect_finished_jobs()
+    
     # Sidebar navigation
+    pages = ["📊 Dashboard", "📁 Upload", "📋 History"]
+    if st.session_state.get('username') in config.ADMIN_USERS:
+        pages += ["⚙️ Admin", "📈 Performance"]
+    
     with st.sidebar:
         st.markdown("### Navigation")
         page = st.radio(
             "Choose a page:",
-            ["📊 Dashboard", "📁 Upload", "📋 History", "🚪 Logout"]
+            pages + ["🚪 Logout"]
         )
         
         if page == "🚪 Logout":
             st.session_state.logged_in = False
             st.rerun()
     
+    if st.session_state.pending_jobs:
+        with st.sidebar:
+            job_status_panel()
+    
     # Main content
-    if page == "📊 Dashboard":
-        dashboard_page()
-    elif page == "📁 Upload":
-        upload_page()
-    elif page == "📋 History":
-        history_page()
+    with span(f"render.page.{PAGE_SPANS[page]}"):
+        if page == "📊 Dashboard":
+            dashboard_page()
+        elif page == "📁 Upload":
+            upload_page()
+        elif page == "📋 History":
+            history_page()
+        elif page == "⚙️ Admin":
+            admin_page()
+        elif page == "📈 Performance":
+            performance_page()
+
+PAGE_SPANS = {"📊 Dashboard": "dashboard", "📁 Upload": "upload", "📋 History": "history",
+              "⚙️ Admin": "admin", "📈 Performance": "performance"}
 
 if __name__ == "__main__":
     main()
+    bootstrap.finish_run(_run_started, "main")
@@ -1,89 +1,149 @@
 import streamlit as st
-from datetime import datetime
-from uuid import uuid4
-import shutil
-import os
-from io import BytesIO
-from reportlab.pdfgen import canvas
-from passlib.context import CryptContext
-from dataclasses import dataclass, asdict, field
-from typing import Optional, List
-
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-# In-memory "database" for demo purposes
-users_db = {
-    "doctor": {
-        "username": "doctor",
-        "hashed_password": pwd_context.hash("password123"),
-    }
-}
-
-patients_db = {}
-analyses_db = {}
-notifications_db = {}
-
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-# Dataclasses for models
-@dataclass
-class User:
-    username: str
-
-@dataclass
-class Patient:
-    patient_id: str
-    scan_date: datetime
-    eye: str
-
-@dataclass
-class AnalysisResult:
-    patient_id: str
-    diagnosis: str
-    confidence: float
-    details: Optional[str] = None
-
-@dataclass
-class Notification:
-    id: str
-    message: str
-    timestamp: datetime
+import time
+from datetime import date, datetime, timedelta
+from dataclasses import asdict
+from typing import Optional
+
+import analytics
+import bootstrap
+import config
+import services
+from models import AnalysisResult, User
+from notifications import ALERT, NotificationFeed, notify
+from search_index import search_patients
+
+_run_started = bootstrap.start_run()
+
+# Credentials are loaded once per process, not on every rerun
+credentials = bootstrap.credentials()
+
+# Patients, analyses and notifications live in the shared SQLite database; changes go
+# through services.py, which the REST API (api.py) uses as well
+db = bootstrap.database()
+
+UPLOAD_DIR = config.UPLOAD_DIR
+TIMELINE_PAGE_SIZE = 25
+bootstrap.ensure_directories()
 
 # Utility functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-def authenticate_user(username: str, password: str):
-    user = users_db.get(username)
-    if not user:
-        return None
-    if not verify_password(password, user["hashed_password"]):
-        return None
-    return User(username=username)
-
-def generate_report_pdf(patient_id: str, analysis: Optional[AnalysisResult]) -> BytesIO:
-    buffer = BytesIO()
-    p = canvas.Canvas(buffer)
-    p.drawString(100, 750, f"RetinaView AI Report for Patient {patient_id}")
-    if analysis:
-        p.drawString(100, 720, f"Diagnosis: {analysis.diagnosis}")
-        p.drawString(100, 700, f"Confidence: {analysis.confidence}%")
-        if analysis.details:
-            p.drawString(100, 680, f"Details: {analysis.details}")
+def authenticate_user(username: str, password: str) -> Optional[User]:
+    return credentials.authenticate(username, password)
+
+@st.fragment(run_every=2)
+def job_status(job_id: str, label: str = "Report"):
+    """Progress of a background job, polled without rerunning the page; reruns it once the job is done."""
+    job = bootstrap.job_queue().get(job_id)
+    if job.done:
+        st.rerun()
+    st.progress(job.progress, text=f"{label} {job.id[:8]}: {job.message or job.status}")
+
+def show_report_job(session_key: str, label: str):
+    """Progress while the job in ``st.session_state[session_key]`` runs, then its download."""
+    job_id = st.session_state.get(session_key)
+    if not job_id:
+        return
+    job = bootstrap.job_queue().get(job_id)
+    if job is None or job.status == "failed":
+        st.error(f"Report generation failed: {job.error if job else 'job not found'}")
+    elif not job.done:
+        job_status(job_id)
+    elif job.result.get("path") is None:
+        st.info("No analyses on that day")
+    else:
+        with open(job.result["path"], "rb") as f:
+            st.download_button(
+                label=label,
+                data=f,
+                file_name=job.result["filename"],
+                mime=job.result.get("mime", "application/pdf"),
+                key=f"{session_key}_download",
+            )
+
+def show_batch_job():
+    """Progress of this session's batch while it runs, then its per-scan results."""
+    job_id = st.session_state.get("batch_job")
+    if not job_id:
+        return
+    job = bootstrap.job_queue().get(job_id)
+    if job is None or job.status == "failed":
+        st.error(f"Batch failed: {job.error if job else 'job not found'}")
+    elif not job.done:
+        job_status(job_id, "Batch")
     else:
-        p.drawString(100, 720, "No analysis available.")
-    p.showPage()
-    p.save()
-    buffer.seek(0)
-    return buffer
+        result = job.result
+        st.success(f"Analysed {result['analysed']} scans ({result['failed']} failed) "
+                   f"at {result['scans_per_second']:.1f} scans/s")
+        st.dataframe(result["rows"], use_container_width=True)
+
+def show_timeline(trend):
+    """One eye's trend summary and chart, then its visits a page at a time (newest first)."""
+    st.subheader(f"{trend.eye.capitalize()} eye")
+    latest = trend.latest
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Visits", trend.count, f"{trend.detections} with detections", delta_color="off")
+    col2.metric("Latest Diagnosis", latest.diagnosis,
+                f"was {trend.previous.diagnosis}" if trend.diagnosis_changed else None, delta_color="off")
+    col3.metric("Latest Confidence", f"{latest.confidence:.1f}%",
+                f"{trend.confidence_delta:+.1f}" if trend.confidence_delta is not None else None, delta_color="off")
+    since = trend.since_high_risk()
+    col4.metric("Since High Risk", f"{since.days} days" if since is not None else "never")
+    if len(trend.points) > 1:
+        st.line_chart({"Confidence": {point.created_at: point.confidence for point in trend.points}})
+
+    key = f"timeline_{trend.patient_id}_{trend.eye}"
+    cursors = st.session_state.setdefault(key, [None])
+    visits = db.analyses.timeline(trend.patient_id, trend.eye, before=cursors[-1], limit=TIMELINE_PAGE_SIZE)
+    st.dataframe([{"date": analysis.created_at, "diagnosis": analysis.diagnosis,
+                   "confidence": round(analysis.confidence, 1), "details": analysis.details} for analysis in visits],
+                 use_container_width=True)
+    newer_col, older_col = st.columns(2)
+    if newer_col.button("Newer", key=f"{key}_newer", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    if older_col.button("Older", key=f"{key}_older", disabled=len(visits) < TIMELINE_PAGE_SIZE):
+        cursors.append((visits[-1].created_at, visits[-1].id))
+        st.rerun()
+
+def notification_feed() -> NotificationFeed:
+    if "notification_feed" not in st.session_state:
+        st.session_state.notification_feed = NotificationFeed(db)
+    return st.session_state.notification_feed
+
+def deliver_notifications():
+    """Fetch entries posted since the last poll; alerts pop up as toasts on whatever page is open."""
+    for notification in notification_feed().poll(db):
+        if notification.level == ALERT:
+            st.toast(notification.message, icon="🚨")
+
+@st.fragment(run_every=config.NOTIFICATION_POLL_SECONDS)
+def notification_badge(username: str):
+    deliver_notifications()
+    unread = db.notifications.unread_count(username)
+    st.caption(f"🔔 {unread} unread notification{'' if unread == 1 else 's'}")
+
+@st.fragment(run_every=config.NOTIFICATION_POLL_SECONDS)
+def notification_list(username: str):
+    deliver_notifications()
+    feed = notification_feed()
+    read_up_to = db.notifications.read_cursor(username)
+    if st.button("Mark all as read", disabled=feed.seq <= read_up_to):
+        db.notifications.mark_read(username, feed.seq)
+        read_up_to = feed.seq
+    if not feed.entries:
+        st.info("No notifications yet")
+    for notification in feed.entries:
+        icon = "🚨" if notification.level == ALERT else "🔔"
+        message = f"**{notification.message}**" if notification.seq > read_up_to else notification.message
+        st.markdown(f"{icon} {message}")
+        st.caption(notification.timestamp.astimezone().strftime("%Y-%m-%d %H:%M:%S"))
 
 # Streamlit app
 st.title("RetinaView AI")
 
-if "user" not in st.session_state:
-    st.session_state.user = None
+# A signed token stands in for the password after login, so reruns skip bcrypt
+st.session_state.user = credentials.user_from_token(st.session_state.get("token"))
+
+bootstrap.finish_setup(_run_started)
 
 def login():
     st.subheader("Login")
@@ -93,18 +153,32 @@ def login():
         user = authenticate_user(username, password)
         if user:
             st.session_state.user = user
+            st.session_state.token = credentials.issue_token(user)
             st.success(f"Logged in as {username}")
         else:
             st.error("Invalid username or password")
 
 def logout():
     st.session_state.user = None
+    st.session_state.token = None
     st.success("Logged out")
 
 if st.session_state.user is None:
     login()
 else:
     st.sidebar.write(f"Logged in as: {st.session_state.user.username}")
+    if len(credentials.login_latency):
+        st.sidebar.caption(
+            f"Login latency p50 {credentials.login_latency.percentile(50) * 1000:.0f} ms, "
+            f"p99 {credentials.login_latency.percentile(99) * 1000:.0f} ms"
+        )
+    timings = bootstrap.run_timings().summary()
+    if timings["rerun_p50_ms"] is not None:
+        st.sidebar.caption(
+            f"Cold start {timings['cold_start_ms']:.0f} ms, rerun setup p50 {timings['rerun_p50_ms']:.1f} ms"
+        )
+    with st.sidebar:
+        notification_badge(st.session_state.user.username)
     if st.sidebar.button("Logout"):
         logout()
 
@@ -112,12 +186,15 @@ else:
         "Create Patient",
         "View Patient",
         "Upload Files",
+        "Batch Analysis",
         "Submit Analysis",
         "View Analysis",
+        "Patient Timeline",
         "Search History",
+        "Analytics",
         "Notifications",
         "Download Report"
-    ])
+    ] + (["Performance"] if st.session_state.user.username in config.ADMIN_USERS else []))
 
     if menu == "Create Patient":
         st.header("Create Patient")
@@ -127,18 +204,21 @@ else:
             eye = st.selectbox("Eye", ["left", "right"])
             submitted = st.form_submit_button("Create")
             if submitted:
-                if patient_id in patients_db:
-                    st.error("Patient already exists")
+                try:
+                    patient = services.create_patient(db, patient_id, datetime.combine(scan_date, datetime.min.time()), eye)
+                except ValueError as exc:
+                    st.error(str(exc))
                 else:
-                    patient = Patient(patient_id=patient_id, scan_date=datetime.combine(scan_date, datetime.min.time()), eye=eye)
-                    patients_db[patient_id] = patient
-                    st.success(f"Patient {patient_id} created")
+                    if patient is None:
+                        st.error("Patient already exists")
+                    else:
+                        st.success(f"Patient {patient_id} created")
 
     elif menu == "View Patient":
         st.header("View Patient")
         patient_id = st.text_input("Enter Patient ID")
         if st.button("Get Patient"):
-            patient = patients_db.get(patient_id)
+            patient = db.patients.get(patient_id)
             if patient:
                 st.json(asdict(patient))
             else:
@@ -149,90 +229,189 @@ else:
         patient_id = st.text_input("Patient ID for Upload")
         uploaded_files = st.file_uploader("Choose files", accept_multiple_files=True)
         if st.button("Upload"):
-            if patient_id not in patients_db:
+            if not db.patients.exists(patient_id):
                 st.error("Patient not found")
             elif not uploaded_files:
                 st.error("No files selected")
             else:
-                patient_folder = os.path.join(UPLOAD_DIR, patient_id)
-                os.makedirs(patient_folder, exist_ok=True)
-                saved_files = []
-                for file in uploaded_files:
-                    filename = f"{uuid4().hex}_{file.name}"
-                    file_path = os.path.join(patient_folder, filename)
-                    with open(file_path, "wb") as f:
-                        f.write(file.getbuffer())
-                    saved_files.append(filename)
+                saved = services.save_patient_uploads(db, patient_id, [(file, file.name) for file in uploaded_files])
+                saved_files = [upload.filename for upload in saved]
+                duplicates = [upload.filename for upload in saved if upload.deduplicated]
                 st.success(f"Uploaded files: {saved_files}")
+                if duplicates:
+                    st.info(f"Already stored, linked instead of copied: {duplicates}")
+
+    elif menu == "Batch Analysis":
+        st.header("Batch Analysis")
+        patient_id = st.text_input("Patient ID for Batch")
+        source = st.radio("Source", ["Upload files or zip", "Server directory"], horizontal=True)
+        if source == "Upload files or zip":
+            batch_files = st.file_uploader(
+                "Choose scans or a device export (.zip)", accept_multiple_files=True,
+                type=["png", "jpg", "jpeg", "bmp", "tif", "tiff", "zip"],
+            )
+        else:
+            server_dir = st.text_input(f"Directory under {UPLOAD_DIR}/")
+        if st.button("Run Batch"):
+            if not db.patients.exists(patient_id):
+                st.error("Patient not found")
+            elif source == "Upload files or zip" and not batch_files:
+                st.error("No files selected")
+            else:
+                from batch import items_from_directory
+
+                # Runs as a background job, so a large batch neither blocks this session nor stops
+                # halfway when the user navigates away; uploads are stored here and decoded by the job
+                try:
+                    if source == "Upload files or zip":
+                        sources = []
+                        for uploaded in batch_files:
+                            uploaded.seek(0)
+                            digest, _, _ = bootstrap.image_store().put_stream(uploaded)
+                            sources.append({"name": uploaded.name, "image_ref": digest})
+                        payload = {"patient_id": patient_id, "sources": sources}
+                    else:
+                        next(items_from_directory(server_dir), None)  # Rejects paths outside the upload folder
+                        payload = {"patient_id": patient_id, "directory": server_dir}
+                except ValueError as exc:
+                    st.error(str(exc))
+                else:
+                    st.session_state.batch_job = bootstrap.job_queue().submit(
+                        "batch", payload, owner=st.session_state.user.username
+                    )
+        show_batch_job()
 
     elif menu == "Submit Analysis":
         st.header("Submit Analysis")
         with st.form("submit_analysis_form"):
             patient_id = st.text_input("Patient ID")
+            eye = st.selectbox("Eye", ["As registered"] + list(services.EYES))
             diagnosis = st.text_input("Diagnosis")
             confidence = st.number_input("Confidence", min_value=0.0, max_value=100.0, step=0.1)
             details = st.text_area("Details (optional)")
             submitted = st.form_submit_button("Submit")
             if submitted:
-                if patient_id not in patients_db:
+                if not db.patients.exists(patient_id):
                     st.error("Patient not found")
                 else:
-                    analysis = AnalysisResult(patient_id=patient_id, diagnosis=diagnosis, confidence=confidence, details=details)
-                    analyses_db[patient_id] = analysis
+                    analysis = AnalysisResult(patient_id=patient_id, diagnosis=diagnosis, confidence=confidence, details=details,
+                                              eye=eye if eye in services.EYES else None)
+                    services.record_analysis(db, analysis)
                     st.success(f"Analysis for patient {patient_id} submitted")
 
     elif menu == "View Analysis":
         st.header("View Analysis")
         patient_id = st.text_input("Enter Patient ID")
         if st.button("Get Analysis"):
-            analysis = analyses_db.get(patient_id)
-            if analysis:
-                st.json(asdict(analysis))
+            analyses = db.analyses.for_patient(patient_id)
+            if analyses:
+                overlay = bootstrap.heatmap_store().overlay(analyses[0].heatmap_ref)
+                if overlay:
+                    st.image(overlay, caption="Latest analysis: where the model looked", width=320)
+                st.json([asdict(analysis) for analysis in analyses])
             else:
                 st.error("Analysis not found")
 
+    elif menu == "Patient Timeline":
+        st.header("Patient Timeline")
+        patient_id = st.text_input("Patient ID", key="timeline_patient_id")
+        if patient_id:
+            # Summaries are kept up to date on every insert, so nothing here scans the patient's analyses
+            trends = db.trends.for_patient(patient_id)
+            if not trends:
+                st.info("No analyses for this patient yet")
+            for trend in trends:
+                show_timeline(trend)
+
     elif menu == "Search History":
         st.header("Search History")
         patient_id_query = st.text_input("Patient ID contains (optional)")
         diagnosis_query = st.text_input("Diagnosis contains (optional)")
+        page_size = st.selectbox("Results per page", [10, 25, 50, 100], index=1)
         if st.button("Search"):
-            results = []
-            for pid, patient in patients_db.items():
-                if patient_id_query and patient_id_query.lower() not in pid.lower():
-                    continue
-                if diagnosis_query:
-                    analysis = analyses_db.get(pid)
-                    if not analysis or diagnosis_query.lower() not in analysis.diagnosis.lower():
-                        continue
-                results.append(asdict(patient))
-            st.json(results)
+            # Cursor stack: one entry per page visited, so "Previous" can step back
+            st.session_state.search = {"query": (patient_id_query, diagnosis_query), "cursors": [None]}
+        search = st.session_state.get("search")
+        if search:
+            cursors = search["cursors"]
+            page = search_patients(db, *search["query"], cursor=cursors[-1], page_size=page_size)
+            first = (len(cursors) - 1) * page_size
+            st.caption(f"Showing {first + 1 if page.results else 0}-{first + len(page.results)} of {page.total}")
+            st.dataframe([asdict(patient) for patient in page.results], use_container_width=True)
+            prev_col, next_col = st.columns(2)
+            if prev_col.button("Previous", disabled=len(cursors) == 1):
+                cursors.pop()
+                st.rerun()
+            if next_col.button("Next", disabled=page.next_cursor is None):
+                cursors.append(page.next_cursor)
+                st.rerun()
+
+    elif menu == "Analytics":
+        st.header("Analytics")
+        # Appends whatever was analysed since the last visit; the first export backfills the whole history
+        with st.spinner("Exporting new analyses..."):
+            bootstrap.analytics_exporter().export_new()
+        since_col, until_col = st.columns(2)
+        since = since_col.date_input("From", date.today() - timedelta(days=365), key="analytics_since")
+        until = until_col.date_input("To", date.today(), key="analytics_until")
+        by = st.multiselect("Break down by", list(analytics.DIMENSIONS), default=["month"], key="analytics_by")
+
+        started = time.perf_counter()
+        table = analytics.load(since=since, until=until, columns=[
+            "id", "diagnosis", "eye", "confidence", "has_detection", "high_risk", "date"])
+        if not len(table):
+            st.info("No analyses in this period")
+        else:
+            groups = analytics.breakdown(table, by) if by else None
+            bins = analytics.calibration(table)
+            st.caption(f"{len(table):,} analyses aggregated in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+            if groups is not None:
+                st.subheader("Detection Rate")
+                if by == ["month"]:
+                    st.bar_chart(groups, x="month", y="detection_rate")
+                st.dataframe(groups, use_container_width=True)
+            st.subheader("Confidence Bins")
+            st.bar_chart(bins, x="confidence_range", y="analyses")
+            st.dataframe(bins, use_container_width=True)
 
     elif menu == "Notifications":
         st.header("Notifications")
-        if st.button("Refresh"):
-            notifs = [asdict(notif) for notif in notifications_db.values()]
-            st.json(notifs)
+        # Refreshes itself; new entries appear without reloading the page
+        notification_list(st.session_state.user.username)
         with st.form("create_notification_form"):
             message = st.text_input("New Notification Message")
             submitted = st.form_submit_button("Create Notification")
             if submitted:
-                notif_id = uuid4().hex
-                notification = Notification(id=notif_id, message=message, timestamp=datetime.utcnow())
-                notifications_db[notif_id] = notification
+                notify(db, message)
                 st.success("Notification created")
 
     elif menu == "Download Report":
         st.header("Download Report")
         patient_id = st.text_input("Patient ID")
         if st.button("Generate Report"):
-            if patient_id not in patients_db:
+            if not db.patients.exists(patient_id):
                 st.error("Patient not found")
             else:
-                analysis = analyses_db.get(patient_id)
-                pdf_buffer = generate_report_pdf(patient_id, analysis)
-                st.download_button(
-                    label="Download PDF Report",
-                    data=pdf_buffer,
-                    file_name=f"report_{patient_id}.pdf",
-                    mime="application/pdf"
+                # Rendered by a background worker; the job outlives this page
+                st.session_state.report_job = bootstrap.job_queue().submit(
+                    "report", {"patient_id": patient_id}, owner=st.session_state.user.username
                 )
+        show_report_job("report_job", "Download PDF Report")
+
+        st.subheader("Clinic Day Export")
+        export_day = st.date_input("Analyses on", key="export_day")
+        export_format = st.radio("Format", ["Zip of PDFs", "Single PDF"], horizontal=True)
+        if st.button("Export Reports"):
+            st.session_state.export_job = bootstrap.job_queue().submit(
+                "report_export",
+                {"day": export_day.isoformat(), "format": "zip" if export_format == "Zip of PDFs" else "pdf"},
+                owner=st.session_state.user.username,
+            )
+        show_report_job("export_job", "Download Export")
+
+    elif menu == "Performance":
+        st.header("Performance")
+        bootstrap.performance_panel()
+
+bootstrap.finish_run(_run_started, "main_streamlit")
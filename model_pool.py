@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import config
+from inference import InferenceEngine, ModelNotInstalled, load_model
+from preprocessing import preprocess_image, synthetic_scan
+from telemetry import span
+
+
+@dataclass
+class ResidentModel:
+    version: str
+    path: str
+    engine: InferenceEngine
+    loaded_at: datetime
+    load_seconds: float
+    warmup_seconds: float
+
+
+class ModelPool:
+    """Every model version this process serves, loaded once and shared by all sessions.
+
+    Weights are memory-mapped (see ``NumpyClassifier.mapped``), so server
+    processes on one box share a single copy. All engines draw on one
+    semaphore, capping inferences running at once at ``max_concurrency``.
+    Loading a version that is already resident swaps it in: the old engine
+    finishes what it has queued and forwards anything sent to it afterwards,
+    so sessions mid-analysis are not interrupted.
+    """
+
+    def __init__(self, max_concurrency: int = config.MODEL_MAX_CONCURRENCY or os.cpu_count() or 1,
+                 workers: int = config.INFERENCE_WORKERS):
+        self.max_concurrency = max_concurrency
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._models: Dict[str, ResidentModel] = {}
+        self._default: Optional[str] = None
+        # Why nothing is loaded, when a configured path has no weights; reported by ``engine``
+        self.missing: Optional[str] = None
+        self._lock = threading.Lock()
+        # Serializes loads, so two admins swapping at once can't both replace the same version
+        self._load_lock = threading.Lock()
+
+    def load(self, path: str, make_default: bool = False) -> ResidentModel:
+        """Load and warm up the model at ``path``; requests keep going to the old models meanwhile."""
+        with self._load_lock:
+            started = time.perf_counter()
+            with span("model.load"):
+                model = load_model(path)
+            loaded = time.perf_counter()
+            engine = InferenceEngine(model, workers=self.workers, slots=self._slots)
+            warm_up(engine)
+            resident = ResidentModel(version=model.version, path=path, engine=engine, loaded_at=datetime.now(),
+                                     load_seconds=loaded - started, warmup_seconds=time.perf_counter() - loaded)
+            with self._lock:
+                previous = self._models.get(resident.version)
+                self._models[resident.version] = resident
+                if make_default or self._default is None:
+                    self._default = resident.version
+            if previous is not None:
+                previous.engine.retire(engine)
+            return resident
+
+    def unload(self, version: str):
+        """Drop a version; anything still sent to it is served by the default model."""
+        with self._lock:
+            if version == self._default:
+                raise ValueError("Can't unload the default model; make another version the default first")
+            resident = self._models.pop(version)
+            default = self._models[self._default].engine
+        resident.engine.retire(default)
+
+    def set_default(self, version: str):
+        with self._lock:
+            if version not in self._models:
+                raise KeyError(f"Model version {version!r} is not loaded")
+            self._default = version
+
+    def engine(self, version: Optional[str] = None) -> InferenceEngine:
+        """The engine for ``version``, or the default one when it is None or not resident."""
+        with self._lock:
+            if self._default is None:
+                raise ModelNotInstalled(self.missing or "No model is loaded")
+            resident = self._models.get(version) if version else None
+            return (resident or self._models[self._default]).engine
+
+    @property
+    def default_version(self) -> Optional[str]:
+        return self._default
+
+    def status(self) -> List[dict]:
+        with self._lock:
+            return [{"version": r.version, "path": r.path, "default": r.version == self._default,
+                     "loaded_at": r.loaded_at, "load_ms": r.load_seconds * 1000,
+                     "warmup_ms": r.warmup_seconds * 1000} for r in self._models.values()]
+
+
+def warm_up(engine: InferenceEngine, batches: int = 2):
+    """Run full and single-item batches of a synthetic B-scan, so the first real request isn't the slowest."""
+    tensor = preprocess_image(synthetic_scan(np.random.default_rng(0)))
+    with span("model.warmup"):
+        for _ in range(batches):
+            engine.predict_many([tensor] * engine.max_batch)
+        engine.predict(tensor)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_model_pool() -> ModelPool:
+    """Process-wide pool with every configured model loaded; the first path is the default."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            pool = ModelPool()
+            for path in config.MODEL_PATHS:
+                try:
+                    pool.load(path)
+                except ModelNotInstalled as exc:
+                    # The pool still starts, empty, so weights can be loaded into it later by path
+                    pool.missing = str(exc)
+            _pool = pool
+        return _pool
@@ -0,0 +1,62 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Optional
+
+# Marks analyses made by the untrained placeholder model (see inference.py)
+PLACEHOLDER_NOTE = "PLACEHOLDER MODEL (untrained weights): not a diagnosis."
+
+# Dataclasses for models
+@dataclass
+class User:
+    username: str
+
+@dataclass
+class Patient:
+    patient_id: str
+    scan_date: datetime
+    eye: str
+
+@dataclass
+class AnalysisResult:
+    patient_id: str
+    diagnosis: str
+    confidence: float
+    details: Optional[str] = None
+    id: Optional[int] = None
+    created_at: Optional[datetime] = None
+    image_ref: Optional[str] = None
+    probabilities: Optional[Dict[str, float]] = None
+    eye: Optional[str] = None
+    heatmap_ref: Optional[str] = None
+
+    @property
+    def is_placeholder(self) -> bool:
+        return bool(self.details) and self.details.startswith(PLACEHOLDER_NOTE)
+
+@dataclass
+class Notification:
+    id: str
+    message: str
+    timestamp: datetime
+    level: str = "info"
+    patient_id: Optional[str] = None
+    seq: Optional[int] = None
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    owner: Optional[str]
+    status: str
+    payload: dict
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    progress: float = 0.0
+    message: Optional[str] = None
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
@@ -0,0 +1,52 @@
+from collections import deque
+from datetime import datetime, timezone
+from typing import List, Optional
+from uuid import uuid4
+
+from models import PLACEHOLDER_NOTE, Notification
+from storage import Database
+
+INFO = "info"
+ALERT = "alert"
+
+
+def notify(db: Database, message: str, level: str = INFO, patient_id: Optional[str] = None) -> Notification:
+    notification = Notification(id=uuid4().hex, message=message, timestamp=datetime.now(timezone.utc),
+                                level=level, patient_id=patient_id)
+    return db.notifications.add(notification)
+
+
+def alert_if_high_risk(db: Database, label: str, confidence: float, patient_id: Optional[str] = None,
+                       source: str = "scan", placeholder: bool = False) -> Optional[Notification]:
+    """Post an alert when a finished analysis rates as High Risk; ``placeholder`` marks one made by
+    the untrained placeholder model."""
+    from inference import risk_level_for
+
+    if risk_level_for(label.lower() != "normal", confidence) != "High Risk":
+        return None
+    subject = f"patient {patient_id}" if patient_id else source
+    message = f"High-risk result for {subject}: {label} ({confidence:.1f}% confidence)"
+    if placeholder:
+        message = f"{PLACEHOLDER_NOTE} {message}"
+    return notify(db, message, ALERT, patient_id)
+
+
+class NotificationFeed:
+    """What one client has been sent: the newest ``size`` entries and the seq it has seen up to.
+
+    ``poll`` only asks the database for entries after that seq, so a quiet log
+    costs one indexed lookup per poll however long it is.
+    """
+
+    def __init__(self, db: Database, size: int = 50):
+        self.entries = deque(db.notifications.recent(size), maxlen=size)  # newest first
+        self.seq = self.entries[0].seq if self.entries else db.notifications.latest_seq()
+
+    def poll(self, db: Database) -> List[Notification]:
+        """New entries since the last poll, oldest first."""
+        new = db.notifications.since(self.seq, limit=self.entries.maxlen)
+        for notification in new:
+            self.entries.appendleft(notification)
+        if new:
+            self.seq = new[-1].seq
+        return new
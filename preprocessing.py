@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import threading
+from io import BytesIO
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+import config
+from image_store import atomic_write
+
+INPUT_SIZE = 128
+
+# Fraction of the flattened B-scan kept around the RPE line: above it (retina) and below it (choroid)
+CROP_ABOVE = 0.45
+CROP_BELOW = 0.15
+
+# Anything that changes the tensor fed to the model belongs here; it is part of both cache keys
+PREPROCESS_PARAMS = {
+    'version': 3,
+    'size': INPUT_SIZE,
+    'grayscale': 'bt601',
+    'denoise': 'median3',
+    'flatten': {'fit': 'poly2', 'above': CROP_ABOVE, 'below': CROP_BELOW},
+    'resample': 'bilinear',
+    'normalize': 'zscore',
+}
+
+# Compare-exchange pairs whose result leaves the median of nine values in position 4
+MEDIAN9_NETWORK = [(1, 2), (4, 5), (7, 8), (0, 1), (3, 4), (6, 7), (1, 2), (4, 5), (7, 8), (0, 3),
+                   (5, 8), (4, 7), (3, 6), (1, 4), (2, 5), (4, 7), (4, 2), (6, 4), (4, 2)]
+
+# ITU-R BT.601 luma, as Pillow's convert('L') uses
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+# Steps: each takes and returns a stack of images, (N, H, W) or (N, H, W, C) for grayscale
+def decode(image_bytes: bytes) -> np.ndarray:
+    """Encoded image -> array, (H, W) or (H, W, C).
+
+    8-bit images come back as uint8; 16-bit and float scans keep their own
+    dtype and range (converting them to 'L' would clip at 255), and
+    ``to_grayscale`` scales them by their maximum.
+    """
+    from PIL import Image
+
+    with Image.open(BytesIO(image_bytes)) as img:
+        if img.mode.startswith('I') or img.mode == 'F':
+            return np.asarray(img)
+        if img.mode not in ('L', 'RGB', 'RGBA', 'LA'):
+            img = img.convert('RGB' if img.mode in ('P', 'CMYK', 'YCbCr') else 'L')
+        return np.asarray(img)
+
+
+def to_grayscale(batch: np.ndarray) -> np.ndarray:
+    """(N, H, W[, C]) -> (N, H, W) float32 in [0, 1]."""
+    if batch.ndim == 4:
+        if batch.shape[3] in (1, 2):  # L or LA; alpha is dropped
+            batch = batch[..., 0]
+        else:
+            batch = batch[..., :3] @ LUMA_WEIGHTS
+    if batch.dtype == np.uint8:
+        return batch.astype(np.float32) * (1.0 / 255.0)
+    # Wider scans are scaled per image by their own peak
+    batch = np.clip(batch.astype(np.float32), 0, None)
+    return batch / np.maximum(batch.max(axis=(1, 2), keepdims=True), 1e-6)
+
+
+def denoise(batch: np.ndarray) -> np.ndarray:
+    """3x3 median filter, which removes speckle while keeping layer edges."""
+    padded = np.pad(batch, ((0, 0), (1, 1), (1, 1)), mode='edge')
+    h, w = batch.shape[1:]
+    p = [padded[:, dy:dy + h, dx:dx + w] for dy in range(3) for dx in range(3)]
+    # Median-of-9 exchange network (Paeth): elementwise min/max over shifted views,
+    # so no (N, H, W, 9) window array is materialised
+    for i, j in MEDIAN9_NETWORK:
+        p[i], p[j] = np.minimum(p[i], p[j]), np.maximum(p[i], p[j])
+    return p[4]
+
+
+def flatten_layers(batch: np.ndarray, above: float = CROP_ABOVE, below: float = CROP_BELOW) -> np.ndarray:
+    """Straighten the retina and crop to a band around it.
+
+    The brightest row of each column approximates the RPE. A quadratic fitted
+    through those rows (one least-squares solve for the whole batch) gives the
+    curvature. Each column is shifted so the curve becomes a horizontal line,
+    and rows ``above`` and ``below`` it (as fractions of the height) are kept.
+    """
+    n, h, w = batch.shape
+    # Column profiles smoothed vertically so single bright speckles don't win
+    kernel = 5
+    cumulative = np.cumsum(np.pad(batch, ((0, 0), (kernel // 2 + 1, kernel // 2), (0, 0)), mode='edge'), axis=1)
+    smoothed = cumulative[:, kernel:] - cumulative[:, :-kernel]
+    rpe = smoothed.argmax(axis=1).astype(np.float32)  # (N, W)
+
+    columns = np.linspace(-1.0, 1.0, w, dtype=np.float32)
+    vandermonde = np.stack([np.ones_like(columns), columns, columns ** 2], axis=1)  # (W, 3)
+    coefficients, *_ = np.linalg.lstsq(vandermonde, rpe.T, rcond=None)  # (3, N)
+    curve = (vandermonde @ coefficients).T  # (N, W)
+
+    top = int(round(above * h))
+    band = top + int(round(below * h))
+    # Row r of the output column c is row curve[c] - top + r of the input
+    rows = np.arange(band, dtype=np.float32)[None, :, None] + (curve - top)[:, None, :]
+    rows = np.clip(np.rint(rows), 0, h - 1).astype(np.intp)
+    return np.take_along_axis(batch, rows, axis=1)
+
+
+def resize(batch: np.ndarray, size: int = INPUT_SIZE) -> np.ndarray:
+    """Bilinear resize of (N, H, W) to (N, size, size), sampling at pixel centres.
+
+    Large downscales are box-averaged by a whole factor first, so speckle does
+    not alias into the output.
+    """
+    n, h, w = batch.shape
+    fy, fx = max(h // size, 1), max(w // size, 1)
+    if fy > 1 or fx > 1:
+        h, w = h // fy, w // fx
+        batch = batch[:, :h * fy, :w * fx].reshape(n, h, fy, w, fx).mean(axis=(2, 4))
+
+    def axis(length):
+        coords = np.clip((np.arange(size, dtype=np.float32) + 0.5) * length / size - 0.5, 0, length - 1)
+        low = np.floor(coords).astype(np.intp)
+        high = np.minimum(low + 1, length - 1)
+        return low, high, (coords - low)
+
+    y0, y1, wy = axis(h)
+    x0, x1, wx = axis(w)
+    top = batch[:, y0][:, :, x0] * (1 - wx) + batch[:, y0][:, :, x1] * wx
+    bottom = batch[:, y1][:, :, x0] * (1 - wx) + batch[:, y1][:, :, x1] * wx
+    return (top * (1 - wy)[None, :, None] + bottom * wy[None, :, None]).astype(np.float32)
+
+
+def normalize(batch: np.ndarray) -> np.ndarray:
+    """Per-image z-score."""
+    mean = batch.mean(axis=(1, 2), keepdims=True)
+    std = batch.std(axis=(1, 2), keepdims=True)
+    return (batch - mean) / np.where(std > 1e-6, std, 1.0)
+
+
+def preprocess_batch(batch: np.ndarray) -> np.ndarray:
+    """(N, H, W[, C]) same-sized images -> (N, INPUT_SIZE, INPUT_SIZE) model input."""
+    return normalize(resize(flatten_layers(denoise(to_grayscale(batch)))))
+
+
+def preprocess_many(images: Sequence[np.ndarray]) -> List[np.ndarray]:
+    """Preprocess differently sized images, one vectorized pass per distinct shape and dtype."""
+    groups: Dict[tuple, List[int]] = {}
+    for index, image in enumerate(images):
+        groups.setdefault((image.shape, image.dtype.str), []).append(index)
+    tensors: List[Optional[np.ndarray]] = [None] * len(images)
+    for indices in groups.values():
+        for index, tensor in zip(indices, preprocess_batch(np.stack([images[i] for i in indices]))):
+            tensors[index] = tensor
+    return tensors
+
+
+def preprocess_image(pixels: np.ndarray) -> np.ndarray:
+    return preprocess_batch(pixels[None])[0]
+
+
+# Synthetic input, for warm-up and benchmarks
+SYNTHETIC_SCAN_SHAPE = (496, 512)
+
+
+def synthetic_scan(rng: np.random.Generator, shape=SYNTHETIC_SCAN_SHAPE) -> np.ndarray:
+    """A B-scan-like image: a few curved bright layers under multiplicative speckle."""
+    h, w = shape
+    rows, columns = np.mgrid[0:h, 0:w].astype(np.float32)
+    tilt = rng.uniform(-0.1, 0.1) * h
+    curve = h * rng.uniform(0.5, 0.65) + tilt * (columns / w - 0.5) + h * 0.12 * ((columns - w / 2) / (w / 2)) ** 2
+    image = np.zeros(shape, dtype=np.float32)
+    for offset, brightness, thickness in ((0, 220, 5), (-0.08 * h, 120, 12), (-0.2 * h, 80, 20)):
+        image += brightness * np.exp(-((rows - curve - offset) / thickness) ** 2)
+    image *= rng.gamma(4.0, 0.25, size=shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+# Tensor cache
+def params_digest(params: dict = PREPROCESS_PARAMS) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+# What a cached tensor holds: one B-scan (H, W), or a volume's stack of them (slices, H, W).
+# A multi-page TIFF can be analysed either way, so the kind is part of the key.
+SCAN = 'scan'
+VOLUME = 'volume'
+TENSOR_NDIM = {SCAN: 2, VOLUME: 3}
+
+
+class TensorCache:
+    """Preprocessed tensors as ``.npy`` files keyed by image hash and kind, read back memory-mapped.
+
+    Model versions share entries, so re-analysis and A/B runs skip decoding and
+    preprocessing; changing PREPROCESS_PARAMS starts a fresh namespace.
+    """
+
+    def __init__(self, root: str = config.TENSOR_CACHE_DIR, params: dict = PREPROCESS_PARAMS):
+        self.root = os.path.join(root, params_digest(params))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, image_ref: str, kind: str) -> str:
+        return os.path.join(self.root, image_ref[:2], f"{image_ref}.{kind}.npy")
+
+    def get(self, image_ref: str, kind: str = SCAN) -> Optional[np.ndarray]:
+        try:
+            tensor = np.load(self._path(image_ref, kind), mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            tensor = None
+        if tensor is not None and tensor.ndim != TENSOR_NDIM[kind]:
+            tensor = None
+        with self._lock:
+            if tensor is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return tensor
+
+    def put(self, image_ref: str, tensor: np.ndarray, kind: str = SCAN):
+        if tensor.ndim != TENSOR_NDIM[kind]:
+            raise ValueError(f"A {kind} tensor has {TENSOR_NDIM[kind]} dimensions, got shape {tensor.shape}")
+        buffer = BytesIO()
+        np.save(buffer, np.ascontiguousarray(tensor, dtype=np.float32), allow_pickle=False)
+        atomic_write(self._path(image_ref, kind), buffer.getvalue())
+
+    def get_or_compute(self, image_ref: str, compute, kind: str = SCAN) -> np.ndarray:
+        tensor = self.get(image_ref, kind)
+        if tensor is None:
+            tensor = compute()
+            self.put(image_ref, tensor, kind)
+        return tensor
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_tensor_cache() -> TensorCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TensorCache()
+        return _cache
@@ -0,0 +1,373 @@
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from io import BytesIO
+from typing import BinaryIO, Iterable, Iterator, List, Optional
+
+import config
+from image_store import atomic_write, get_image_store
+from models import PLACEHOLDER_NOTE, AnalysisResult, Patient
+from telemetry import span
+from trends import TrendSummary
+
+THUMBNAIL_SIZE = 256
+
+
+@dataclass
+class Template:
+    """A parsed report template with its fonts registered and logo decoded."""
+
+    title: str
+    footer: str
+    page_size: tuple
+    margin: float
+    fonts: dict
+    colors: dict
+    history_rows: int
+    logo: object = None
+    digest: str = ""
+
+
+@functools.lru_cache(maxsize=4)
+def _load_template(path: str, mtime: float) -> Template:
+    from reportlab.lib import pagesizes
+    from reportlab.lib.colors import HexColor
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    with open(path, "rb") as f:
+        raw = f.read()
+    spec = json.loads(raw)
+    base = os.path.dirname(path)
+    for name, font_path in spec.get("font_files", {}).items():
+        pdfmetrics.registerFont(TTFont(name, os.path.join(base, font_path)))
+    logo = ImageReader(os.path.join(base, spec["logo"])) if spec.get("logo") else None
+    return Template(
+        title=spec["title"],
+        footer=spec.get("footer", ""),
+        page_size=getattr(pagesizes, spec.get("page_size", "A4")),
+        margin=spec.get("margin", 48),
+        fonts=spec.get("fonts", {"regular": "Helvetica", "bold": "Helvetica-Bold"}),
+        colors={name: HexColor(value) for name, value in spec.get("colors", {}).items()},
+        history_rows=spec.get("history_rows", 8),
+        logo=logo,
+        digest=hashlib.sha256(raw).hexdigest(),
+    )
+
+
+def load_template(path: str = config.REPORT_TEMPLATE_PATH) -> Template:
+    """Parsed once per process; editing the file picks up a fresh copy."""
+    return _load_template(os.path.abspath(path), os.path.getmtime(path))
+
+
+@dataclass
+class ReportData:
+    patient_id: str
+    patient: Optional[Patient] = None
+    analyses: List[AnalysisResult] = field(default_factory=list)  # newest first
+    trends: List[TrendSummary] = field(default_factory=list)  # one per eye
+
+    @property
+    def latest(self) -> Optional[AnalysisResult]:
+        return self.analyses[0] if self.analyses else None
+
+    @property
+    def total(self) -> int:
+        return sum(trend.count for trend in self.trends) if self.trends else len(self.analyses)
+
+    def fingerprint(self, template: Template) -> str:
+        """Changes whenever anything drawn on the report does."""
+        content = json.dumps({"patient_id": self.patient_id, "patient": self.patient and asdict(self.patient),
+                              "analyses": [asdict(a) for a in self.analyses],
+                              "trends": [asdict(t) for t in self.trends],
+                              "template": template.digest}, default=str, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+
+def report_data(db, patient_id: str, history_rows: Optional[int] = None) -> ReportData:
+    """The newest analyses for the history table; trend charts come from the precomputed summaries."""
+    history_rows = history_rows if history_rows is not None else load_template().history_rows
+    return ReportData(patient_id=patient_id, patient=db.patients.get(patient_id),
+                      analyses=db.analyses.for_patient(patient_id, limit=max(history_rows, 1)),
+                      trends=db.trends.for_patient(patient_id))
+
+
+# Drawing
+def draw_report(canvas, data: ReportData, template: Template):
+    """Draw one patient's report as a single page on ``canvas``."""
+    width, height = template.page_size
+    margin = template.margin
+    regular, bold = template.fonts["regular"], template.fonts["bold"]
+    colors = template.colors
+    y = height - margin
+
+    if template.logo is not None:
+        canvas.drawImage(template.logo, width - margin - 96, y - 40, width=96, height=40,
+                         preserveAspectRatio=True, mask="auto")
+    canvas.setFillColor(colors["accent"])
+    canvas.setFont(bold, 18)
+    canvas.drawString(margin, y - 18, template.title)
+    canvas.setFillColor(colors["muted"])
+    canvas.setFont(regular, 10)
+    patient_line = f"Patient {data.patient_id}"
+    if data.patient:
+        patient_line += f"  |  {data.patient.eye} eye  |  scanned {data.patient.scan_date:%Y-%m-%d}"
+    canvas.drawString(margin, y - 36, patient_line)
+    if any(analysis.is_placeholder for analysis in data.analyses):
+        canvas.setFillColor(colors["detection"])
+        canvas.setFont(bold, 10)
+        canvas.drawString(margin, y - 52, PLACEHOLDER_NOTE + " Do not use these results clinically.")
+    y -= 64
+
+    latest = data.latest
+    canvas.setFillColor(colors["muted"])
+    if latest is None:
+        canvas.setFont(regular, 12)
+        canvas.drawString(margin, y, "No analysis available.")
+        _draw_footer(canvas, template)
+        return
+
+    # Latest result, with the scan thumbnail (and its heatmap, if any) beside it
+    text_x = margin
+    thumbnail = _thumbnail_path(latest.image_ref)
+    overlay = _overlay_path(latest.heatmap_ref)
+    # Two images share the width one would take, so the text keeps room beside them
+    image_size = 120 if thumbnail and overlay else 160
+    for image in (thumbnail, overlay):
+        if image:
+            canvas.drawImage(image, text_x, y - image_size, width=image_size, height=image_size,
+                             preserveAspectRatio=True)
+            text_x += image_size + 8
+    if overlay:
+        canvas.setFont(regular, 7)
+        canvas.drawString(text_x - image_size - 8, y - image_size - 10, "Model attention (flattened B-scan)")
+    if text_x > margin:
+        text_x += 8
+    detected = latest.diagnosis.lower() != "normal"
+    canvas.setFillColor(colors["detection"] if detected else colors["normal"])
+    canvas.setFont(bold, 14)
+    canvas.drawString(text_x, y - 14, f"Diagnosis: {latest.diagnosis}")
+    canvas.setFillColor(colors["muted"])
+    canvas.setFont(regular, 11)
+    canvas.drawString(text_x, y - 32, f"Confidence: {latest.confidence:.1f}%")
+    if latest.created_at:
+        canvas.drawString(text_x, y - 48, f"Analysed: {latest.created_at:%Y-%m-%d %H:%M}")
+    if latest.details:
+        canvas.drawString(text_x, y - 64, f"Details: {latest.details[:90]}")
+
+    if latest.probabilities:
+        # Per-class probabilities (0-1) as horizontal bars
+        bar_y = y - 88
+        bar_width = width - margin - text_x - 120
+        for label, probability in sorted(latest.probabilities.items(), key=lambda item: -item[1]):
+            canvas.setFont(regular, 9)
+            canvas.drawString(text_x, bar_y, label)
+            canvas.setFillColor(colors["accent"])
+            canvas.rect(text_x + 70, bar_y - 1, bar_width * probability, 8, stroke=0, fill=1)
+            canvas.setFillColor(colors["muted"])
+            canvas.drawString(text_x + 76 + bar_width, bar_y, f"{probability * 100:.1f}%")
+            bar_y -= 14
+    y -= 184
+
+    for trend in data.trends:
+        if len(trend.points) > 1:
+            y = _draw_trend(canvas, trend, template, y)
+    _draw_history(canvas, data.analyses, data.total, template, y)
+    _draw_footer(canvas, template)
+
+
+def _draw_trend(canvas, trend: TrendSummary, template: Template, y: float) -> float:
+    """Confidence over time for one eye, oldest on the left; detections are marked in red."""
+    width, _ = template.page_size
+    margin = template.margin
+    colors = template.colors
+    chart_width, chart_height = width - 2 * margin, 90
+    points = trend.points
+    step = chart_width / max(len(points) - 1, 1)
+
+    title = f"Confidence trend, {trend.eye} eye"
+    if trend.confidence_delta is not None:
+        title += f" ({trend.confidence_delta:+.1f} since previous visit)"
+    canvas.setFont(template.fonts["bold"], 11)
+    canvas.setFillColor(colors["muted"])
+    canvas.drawString(margin, y, title)
+    top = y - 12
+    canvas.setStrokeColor(colors["muted"])
+    canvas.rect(margin, top - chart_height, chart_width, chart_height, stroke=1, fill=0)
+    coordinates = [(margin + i * step, top - chart_height + chart_height * a.confidence / 100)
+                   for i, a in enumerate(points)]
+    canvas.setStrokeColor(colors["accent"])
+    path = canvas.beginPath()
+    path.moveTo(*coordinates[0])
+    for x, point_y in coordinates[1:]:
+        path.lineTo(x, point_y)
+    canvas.drawPath(path, stroke=1, fill=0)
+    for (x, point_y), point in zip(coordinates, points):
+        canvas.setFillColor(colors["detection"] if point.has_detection else colors["normal"])
+        canvas.circle(x, point_y, 2.5, stroke=0, fill=1)
+    return top - chart_height - 28
+
+
+def _draw_history(canvas, analyses: List[AnalysisResult], total: int, template: Template, y: float):
+    margin = template.margin
+    canvas.setFillColor(template.colors["muted"])
+    canvas.setFont(template.fonts["bold"], 11)
+    canvas.drawString(margin, y, f"History ({total} analyses)")
+    canvas.setFont(template.fonts["regular"], 9)
+    for analysis in analyses[:template.history_rows]:
+        y -= 14
+        when = f"{analysis.created_at:%Y-%m-%d %H:%M}" if analysis.created_at else ""
+        canvas.drawString(margin, y, when)
+        canvas.drawString(margin + 100, y, analysis.diagnosis)
+        canvas.drawString(margin + 260, y, f"{analysis.confidence:.1f}%")
+
+
+def _draw_footer(canvas, template: Template):
+    canvas.setFillColor(template.colors["muted"])
+    canvas.setFont(template.fonts["regular"], 8)
+    canvas.drawString(template.margin, template.margin / 2, template.footer)
+    canvas.showPage()
+
+
+def _thumbnail_path(image_ref: Optional[str]) -> Optional[str]:
+    if not image_ref:
+        return None
+    store = get_image_store()
+    if store.thumbnail(image_ref, THUMBNAIL_SIZE) is None:
+        return None
+    return store.thumbnail_path(image_ref, THUMBNAIL_SIZE)
+
+
+def _overlay_path(heatmap_ref: Optional[str]) -> Optional[str]:
+    if not heatmap_ref:
+        return None
+    from heatmaps import get_heatmap_store
+
+    store = get_heatmap_store()
+    if store.overlay(heatmap_ref) is None:
+        return None
+    return store.overlay_path(heatmap_ref)
+
+
+# Rendering and caching
+def report_path(data: ReportData, template: Template) -> str:
+    # Patient IDs are free text; only safe characters reach the file name, and the
+    # fingerprint (which covers the full ID) keeps IDs that sanitise alike apart
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", data.patient_id).lstrip(".")[:64] or "patient"
+    return os.path.join(config.REPORT_DIR, "patients", f"{name}-{data.fingerprint(template)[:16]}.pdf")
+
+
+def render_report(data: ReportData, template: Optional[Template] = None) -> str:
+    """Path of the patient's report, rendered only if its analyses or the template changed."""
+    from reportlab.pdfgen import canvas
+
+    template = template or load_template()
+    path = report_path(data, template)
+    if os.path.exists(path):
+        return path
+    with span("report.render"):
+        buffer = BytesIO()
+        pdf = canvas.Canvas(buffer, pagesize=template.page_size, pageCompression=1)
+        draw_report(pdf, data, template)
+        pdf.save()
+        atomic_write(path, buffer.getvalue())
+    return path
+
+
+def _render_patient(patient_id: str) -> str:
+    # Runs in a pool worker: each worker process keeps its own template and connection pool
+    from storage import get_database
+
+    return render_report(report_data(get_database(), patient_id))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """Report rendering pool; spawned so workers don't inherit Streamlit's threads."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=config.REPORT_WORKERS or os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def render_many(patient_ids: List[str], pool: Optional[ProcessPoolExecutor] = None) -> Iterator[str]:
+    """Report paths in ``patient_ids`` order, rendered in parallel across the pool."""
+    pool = pool or get_pool()
+    # map() keeps order and yields each path as soon as it and its predecessors are done
+    return pool.map(_render_patient, patient_ids)
+
+
+# Export
+class _ChunkSink:
+    """A write-only, unseekable file that hands its bytes to a generator."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> Iterator[bytes]:
+        chunks, self.chunks = self.chunks, []
+        return iter(chunks)
+
+
+def iter_zip(paths: Iterable[str], chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    """Zip archive of ``paths`` as a stream of chunks; at most one chunk is buffered."""
+    sink = _ChunkSink()
+    # PDF pages are already compressed, so entries are stored rather than deflated again
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        for path in paths:
+            with open(path, "rb") as source, archive.open(_export_name(path), "w", force_zip64=True) as entry:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def write_zip(paths: Iterable[str], fileobj: BinaryIO):
+    for chunk in iter_zip(paths):
+        fileobj.write(chunk)
+
+
+def write_combined_pdf(db, patient_ids: Iterable[str], fileobj: BinaryIO):
+    """One PDF with a page per patient, written to ``fileobj``.
+
+    reportlab keeps the compressed page streams until ``save()``, so memory
+    grows with the page count but not with the thumbnails' pixel data.
+    """
+    from reportlab.pdfgen import canvas
+
+    template = load_template()
+    pdf = canvas.Canvas(fileobj, pagesize=template.page_size, pageCompression=1)
+    for patient_id in patient_ids:
+        draw_report(pdf, report_data(db, patient_id), template)
+    pdf.save()
+
+
+def _export_name(path: str) -> str:
+    patient_id = os.path.basename(path).rsplit("-", 1)[0]
+    return f"report_{patient_id}.pdf"
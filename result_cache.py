@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import config
+from image_store import atomic_write
+
+
+def cache_key(image_digest: str, model_version: str, preprocess_params: dict) -> str:
+    params = json.dumps(preprocess_params, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{image_digest}|{model_version}|{params}".encode()).hexdigest()
+
+
+class ResultCache:
+    """Two-tier cache of analysis outputs: an in-process LRU bounded by bytes, backed by JSON files."""
+
+    def __init__(self, root: str = config.RESULT_CACHE_DIR,
+                 memory_budget: int = config.RESULT_CACHE_MEMORY_BYTES):
+        self.root = root
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(payload)
+        try:
+            with open(self._path(key), "rb") as f:
+                payload = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, payload)
+        return json.loads(payload)
+
+    def put(self, key: str, value: dict):
+        payload = json.dumps(value).encode()
+        atomic_write(self._path(key), payload)
+        with self._lock:
+            self._remember(key, payload)
+
+    def clear_memory(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+
+    def _remember(self, key: str, payload: bytes):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        if len(payload) > self.memory_budget:
+            return
+        self._entries[key] = payload
+        self._memory_bytes += len(payload)
+        while self._memory_bytes > self.memory_budget:
+            _, evicted = self._entries.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._entries),
+                "memory_bytes": self._memory_bytes,
+                "memory_budget": self.memory_budget,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
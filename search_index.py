@@ -0,0 +1,72 @@
+import re
+from dataclasses import dataclass
+from typing import List, Optional
+
+from models import Patient
+from storage import Database, patient_from_row
+
+DEFAULT_PAGE_SIZE = 25
+TRIGRAM = 3
+
+
+@dataclass
+class SearchPage:
+    results: List[Patient]
+    total: int
+    next_cursor: Optional[str] = None
+
+
+def search_patients(db: Database, patient_id_query: str = "", diagnosis_query: str = "",
+                    cursor: Optional[str] = None, page_size: int = DEFAULT_PAGE_SIZE) -> SearchPage:
+    """One page of patients, ordered by ID, starting after ``cursor``.
+
+    The patient ID filter is a substring match answered by the trigram index;
+    the diagnosis filter is a word-prefix match over analysis diagnosis and details.
+    """
+    clauses, params = [], []
+    patient_id_query = patient_id_query.strip()
+    if patient_id_query:
+        if len(patient_id_query) >= TRIGRAM:
+            clauses.append("p.rowid IN (SELECT rowid FROM patient_id_trigrams WHERE patient_id_trigrams MATCH ?)")
+            params.append(_phrase(patient_id_query))
+        else:
+            # Too short for a trigram lookup; short queries match most IDs anyway
+            clauses.append("p.patient_id LIKE ? ESCAPE '\\'")
+            params.append(_contains(patient_id_query))
+    terms = _prefix_terms(diagnosis_query)
+    if terms:
+        clauses.append(
+            "p.patient_id IN (SELECT a.patient_id FROM analysis_text "
+            "JOIN analyses a ON a.id = analysis_text.rowid WHERE analysis_text MATCH ?)"
+        )
+        params.append(terms)
+
+    where = " AND ".join(clauses) or "1"
+    with db.patients.reader() as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM patients p WHERE {where}", params).fetchone()[0]
+        page_where, page_params = where, list(params)
+        if cursor is not None:
+            page_where += " AND p.patient_id > ?"
+            page_params.append(cursor)
+        rows = conn.execute(
+            f"SELECT p.* FROM patients p WHERE {page_where} ORDER BY p.patient_id LIMIT ?",
+            page_params + [page_size + 1],
+        ).fetchall()
+
+    results = [patient_from_row(row) for row in rows[:page_size]]
+    next_cursor = results[-1].patient_id if len(rows) > page_size else None
+    return SearchPage(results=results, total=total, next_cursor=next_cursor)
+
+
+def _phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _prefix_terms(text: str) -> str:
+    words = re.findall(r"\w+", text)
+    return " AND ".join(f"{_phrase(word)}*" for word in words)
+
+
+def _contains(text: str) -> str:
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
@@ -0,0 +1,110 @@
+# Operations shared by the Streamlit app (main_streamlit.py) and the REST API (api.py).
+#
+# Both front-ends call these instead of touching the repositories directly, so
+# validation, alerts and result bookkeeping behave the same whichever one a
+# scan arrived through. Everything here is synchronous; the API runs it on a
+# thread pool.
+import os
+from datetime import datetime
+from typing import BinaryIO, Iterable, List, Optional, Tuple
+
+import config
+from models import PLACEHOLDER_NOTE, AnalysisResult, Patient
+from notifications import alert_if_high_risk
+from storage import Database
+from uploads import SavedUpload, save_upload
+
+EYES = ("left", "right")
+
+
+class PatientNotFound(LookupError):
+    def __init__(self, patient_id: str):
+        super().__init__(f"Patient {patient_id} not found")
+        self.patient_id = patient_id
+
+
+def require_patient(db: Database, patient_id: str):
+    if not db.patients.exists(patient_id):
+        raise PatientNotFound(patient_id)
+
+
+# Patients
+def create_patient(db: Database, patient_id: str, scan_date: datetime, eye: str) -> Optional[Patient]:
+    """The new patient, or None if the ID is already taken."""
+    if not patient_id:
+        raise ValueError("Patient ID is required")
+    if eye not in EYES:
+        raise ValueError(f"Eye must be one of {', '.join(EYES)}")
+    patient = Patient(patient_id=patient_id, scan_date=scan_date, eye=eye)
+    return patient if db.patients.create(patient) else None
+
+
+# Uploads
+def patient_folder(patient_id: str) -> str:
+    return os.path.join(config.UPLOAD_DIR, patient_id)
+
+
+def save_patient_upload(db: Database, patient_id: str, fileobj: BinaryIO, filename: str) -> SavedUpload:
+    """Stream one file into the content store and link it into the patient's upload folder."""
+    require_patient(db, patient_id)
+    return save_upload(fileobj, filename, patient_folder(patient_id))
+
+
+def save_patient_uploads(db: Database, patient_id: str,
+                         files: Iterable[Tuple[BinaryIO, str]]) -> List[SavedUpload]:
+    require_patient(db, patient_id)
+    return [save_upload(fileobj, filename, patient_folder(patient_id)) for fileobj, filename in files]
+
+
+# Analyses
+def record_analysis(db: Database, analysis: AnalysisResult) -> AnalysisResult:
+    """Store an analysis and raise an alert if it rates as High Risk.
+
+    Without an explicit ``eye`` the analysis is filed under the patient's registered eye.
+    """
+    require_patient(db, analysis.patient_id)
+    if analysis.eye is not None and analysis.eye not in EYES:
+        raise ValueError(f"Eye must be one of {', '.join(EYES)}")
+    db.analyses.add(analysis)
+    alert_if_high_risk(db, analysis.diagnosis, analysis.confidence, patient_id=analysis.patient_id,
+                       placeholder=analysis.is_placeholder)
+    return analysis
+
+
+def record_prediction(db: Database, patient_id: str, name: str, image_ref: str, prediction) -> AnalysisResult:
+    """Store a model prediction for a scan as the patient's latest analysis, with its heatmap."""
+    from heatmaps import get_heatmap_store
+    from inference import is_placeholder
+
+    heatmap_ref = prediction.heatmap_ref
+    if heatmap_ref is None and prediction.heatmap is not None:
+        heatmap_ref = get_heatmap_store().put(prediction.heatmap, image_ref, prediction.model_version)
+    details = f"Scan {name} (image {image_ref[:12]}, model {prediction.model_version})"
+    if is_placeholder(prediction.model_version):
+        details = f"{PLACEHOLDER_NOTE} {details}"
+    return record_analysis(db, AnalysisResult(
+        patient_id=patient_id, diagnosis=prediction.label, confidence=prediction.confidence,
+        details=details,
+        image_ref=image_ref, probabilities=prediction.probabilities, heatmap_ref=heatmap_ref,
+    ))
+
+
+def analyze_upload(db: Database, engine, patient_id: str, upload: SavedUpload) -> AnalysisResult:
+    """Classify a stored upload (through the result and tensor caches) and record the result."""
+    from heatmaps import get_heatmap_store
+    from image_store import get_image_store
+    from preprocessing import get_tensor_cache
+    from result_cache import get_result_cache
+
+    prediction = engine.analyze(get_image_store().get(upload.digest), upload.digest, cache=get_result_cache(),
+                                tensors=get_tensor_cache(), heatmaps=get_heatmap_store())
+    return record_prediction(db, patient_id, upload.filename, upload.digest, prediction)
+
+
+# Reports
+def patient_report(db: Database, patient_id: str) -> str:
+    """Path of the patient's PDF report, rendered only if it changed since last time."""
+    from reports import render_report, report_data
+
+    require_patient(db, patient_id)
+    return render_report(report_data(db, patient_id))
@@ -0,0 +1,238 @@
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import config
+from history import HistoryIndex
+from image_store import atomic_write
+from telemetry import deep_sizeof, span
+
+
+class SpillingEntries:
+    """History entries by id, the most recently used in memory and the rest pickled under ``root``.
+
+    Looking up a spilled entry loads it back, so a history page reads the same
+    whether or not its entries were spilled. Entries don't change once added,
+    so a reloaded entry keeps its file and spilling it again costs nothing.
+    """
+
+    def __init__(self, root: str, on_grow: Optional[Callable[[], None]] = None):
+        self.root = root
+        self.bytes = 0
+        self._resident: "OrderedDict[str, dict]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._ids = set()
+        self._on_disk = set()
+        self._on_grow = on_grow
+        self._lock = threading.RLock()
+
+    def _path(self, entry_id: str) -> str:
+        return os.path.join(self.root, f"{entry_id}.pkl")
+
+    def _keep(self, entry_id: str, entry: dict):
+        size = deep_sizeof(entry)
+        self._resident[entry_id] = entry
+        self._sizes[entry_id] = size
+        self.bytes += size
+
+    def __setitem__(self, entry_id: str, entry: dict):
+        with self._lock:
+            if entry_id in self._resident:
+                del self._resident[entry_id]
+                self.bytes -= self._sizes.pop(entry_id)
+            if entry_id in self._on_disk:
+                self._on_disk.discard(entry_id)
+                os.remove(self._path(entry_id))
+            self._ids.add(entry_id)
+            self._keep(entry_id, entry)
+        if self._on_grow is not None:
+            self._on_grow()
+
+    def __getitem__(self, entry_id: str) -> dict:
+        with self._lock:
+            entry = self._resident.get(entry_id)
+            if entry is not None:
+                self._resident.move_to_end(entry_id)
+                return entry
+            if entry_id not in self._on_disk:
+                raise KeyError(entry_id)
+            with span("session.reload"):
+                with open(self._path(entry_id), "rb") as f:
+                    entry = pickle.load(f)
+            self._keep(entry_id, entry)
+        if self._on_grow is not None:
+            self._on_grow()
+        return entry
+
+    def __contains__(self, entry_id) -> bool:
+        return entry_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def resident(self) -> int:
+        return len(self._resident)
+
+    def spill(self, nbytes: Optional[int] = None) -> int:
+        """Move least recently used entries to disk until ``nbytes`` are freed (all of them
+        when None); returns the bytes freed."""
+        freed = 0
+        with self._lock, span("session.spill"):
+            while self._resident and (nbytes is None or freed < nbytes):
+                entry_id, entry = self._resident.popitem(last=False)
+                if entry_id not in self._on_disk:
+                    # Written and read only by this process, for sessions it serves
+                    atomic_write(self._path(entry_id), pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+                    self._on_disk.add(entry_id)
+                size = self._sizes.pop(entry_id)
+                self.bytes -= size
+                freed += size
+        return freed
+
+    def clear(self):
+        with self._lock:
+            self._resident.clear()
+            self._sizes.clear()
+            self._ids.clear()
+            self._on_disk.clear()
+            self.bytes = 0
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+@dataclass
+class SessionState:
+    session_id: str
+    history: HistoryIndex
+    entries: SpillingEntries
+    last_seen: float
+
+
+class SessionStates:
+    """The analysis history of every session this process serves, held to a memory budget.
+
+    A session keeps at most ``session_bytes`` of history entries in memory, and
+    all sessions together at most ``total_bytes``; past either, the least
+    recently viewed entries are spilled to disk, from the sessions idle longest
+    first when it is the total that is over. ``sweep`` spills sessions idle for
+    ``idle_seconds`` whole and drops, files and all, those Streamlit has closed
+    or that have been idle for ``ttl``. Only the sort keys of the history
+    (a timestamp, a confidence and an id per entry) always stay in memory.
+    """
+
+    def __init__(self, root: str = config.SESSION_SPILL_DIR, session_bytes: int = config.SESSION_MEMORY_BYTES,
+                 total_bytes: int = config.SESSION_MEMORY_TOTAL_BYTES,
+                 idle_seconds: float = config.SESSION_IDLE_SECONDS, ttl: float = config.SESSION_STATE_TTL):
+        # One directory per server process; whatever an earlier process left is of no use to this one
+        self.root = os.path.join(root, str(os.getpid()))
+        self.session_bytes = session_bytes
+        self.total_bytes = total_bytes
+        self.idle_seconds = idle_seconds
+        self.ttl = ttl
+        self._sessions: Dict[str, SessionState] = {}
+        self._lock = threading.Lock()
+        _remove_stale(root)
+
+    def history(self, session_id: str) -> HistoryIndex:
+        """The session's history, created on its first run (or after it expired); marks it as seen."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                entries = SpillingEntries(os.path.join(self.root, session_id),
+                                          on_grow=lambda: self._enforce(session_id))
+                session = self._sessions[session_id] = SessionState(
+                    session_id, HistoryIndex(entries), entries, time.time())
+            session.last_seen = time.time()
+            return session.history
+
+    @property
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(session.entries.bytes for session in self._sessions.values())
+
+    def _enforce(self, session_id: str):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            by_idleness = sorted(self._sessions.values(), key=lambda s: s.last_seen)
+        if session is not None and session.entries.bytes > self.session_bytes:
+            session.entries.spill(session.entries.bytes - self.session_bytes)
+        excess = sum(s.entries.bytes for s in by_idleness) - self.total_bytes
+        for other in by_idleness:
+            if excess <= 0:
+                break
+            excess -= other.entries.spill(excess)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Spill idle sessions and drop expired ones; returns how many were dropped."""
+        now = now or time.time()
+        with self._lock:
+            expired = [session_id for session_id, session in self._sessions.items()
+                       if now - session.last_seen > self.ttl
+                       or (now - session.last_seen > self.idle_seconds and not _is_open(session_id))]
+            dropped = [self._sessions.pop(session_id) for session_id in expired]
+            idle = [session for session in self._sessions.values() if now - session.last_seen > self.idle_seconds]
+        for session in dropped:
+            session.history.clear()
+        for session in idle:
+            session.entries.spill()
+        return len(dropped)
+
+    def start_sweeping(self, interval: float = config.SESSION_SWEEP_SECONDS) -> Optional[threading.Thread]:
+        if interval <= 0:
+            return None
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.sweep()
+
+        thread = threading.Thread(target=loop, name="session-sweep", daemon=True)
+        thread.start()
+        return thread
+
+    def status(self) -> List[dict]:
+        now = time.time()
+        with self._lock:
+            return [{"session": session.session_id, "entries": len(session.entries),
+                     "in_memory": session.entries.resident, "bytes": session.entries.bytes,
+                     "idle_s": now - session.last_seen} for session in self._sessions.values()]
+
+
+def current_session_id() -> str:
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "bare"
+
+
+def _is_open(session_id: str) -> bool:
+    """False once Streamlit has closed the session; True when there is no runtime to ask (bare mode, tests)."""
+    from streamlit import runtime
+
+    if not runtime.exists():
+        return True
+    return runtime.get_instance().is_active_session(session_id)
+
+
+def _remove_stale(root: str):
+    """Delete the spill directories of server processes that are gone, and any this PID left before."""
+    if not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        if name.isdigit() and (int(name) == os.getpid() or not _pid_alive(int(name))):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
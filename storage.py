@@ -0,0 +1,503 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, time
+from typing import List, Optional
+
+import config
+from models import AnalysisResult, Notification, Patient
+from trends import TrendSummary, points_from_json
+
+# Each entry is one schema version; statements run in a single transaction
+MIGRATIONS = [
+    [
+        """CREATE TABLE IF NOT EXISTS patients (
+            patient_id TEXT PRIMARY KEY,
+            scan_date TEXT NOT NULL,
+            eye TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_patients_scan_date ON patients (scan_date)",
+        """CREATE TABLE IF NOT EXISTS analyses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id TEXT NOT NULL,
+            diagnosis TEXT NOT NULL,
+            confidence REAL NOT NULL,
+            details TEXT,
+            scan_date TEXT,
+            created_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_analyses_patient ON analyses (patient_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_analyses_diagnosis ON analyses (diagnosis COLLATE NOCASE)",
+        "CREATE INDEX IF NOT EXISTS idx_analyses_scan_date ON analyses (scan_date)",
+        """CREATE TABLE IF NOT EXISTS notifications (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            message TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        )""",
+    ],
+    [
+        # Search indexes (see search_index.py), kept in sync by triggers
+        "CREATE VIRTUAL TABLE IF NOT EXISTS patient_id_trigrams USING fts5("
+        "patient_id, content='patients', content_rowid='rowid', tokenize='trigram')",
+        """CREATE TRIGGER IF NOT EXISTS patients_ai AFTER INSERT ON patients BEGIN
+            INSERT INTO patient_id_trigrams (rowid, patient_id) VALUES (new.rowid, new.patient_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS patients_ad AFTER DELETE ON patients BEGIN
+            INSERT INTO patient_id_trigrams (patient_id_trigrams, rowid, patient_id)
+            VALUES ('delete', old.rowid, old.patient_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS patients_au AFTER UPDATE OF patient_id ON patients BEGIN
+            INSERT INTO patient_id_trigrams (patient_id_trigrams, rowid, patient_id)
+            VALUES ('delete', old.rowid, old.patient_id);
+            INSERT INTO patient_id_trigrams (rowid, patient_id) VALUES (new.rowid, new.patient_id);
+        END""",
+        "INSERT INTO patient_id_trigrams (patient_id_trigrams) VALUES ('rebuild')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS analysis_text USING fts5("
+        "diagnosis, details, content='analyses', content_rowid='id')",
+        """CREATE TRIGGER IF NOT EXISTS analyses_ai AFTER INSERT ON analyses BEGIN
+            INSERT INTO analysis_text (rowid, diagnosis, details) VALUES (new.id, new.diagnosis, new.details);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS analyses_ad AFTER DELETE ON analyses BEGIN
+            INSERT INTO analysis_text (analysis_text, rowid, diagnosis, details)
+            VALUES ('delete', old.id, old.diagnosis, old.details);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS analyses_au AFTER UPDATE OF diagnosis, details ON analyses BEGIN
+            INSERT INTO analysis_text (analysis_text, rowid, diagnosis, details)
+            VALUES ('delete', old.id, old.diagnosis, old.details);
+            INSERT INTO analysis_text (rowid, diagnosis, details) VALUES (new.id, new.diagnosis, new.details);
+        END""",
+        "INSERT INTO analysis_text (analysis_text) VALUES ('rebuild')",
+    ],
+    [
+        # Background job queue (see jobs.py)
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            owner TEXT,
+            status TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            updated_at TEXT NOT NULL,
+            finished_at TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_owner ON jobs (owner, created_at)",
+    ],
+    [
+        # Accounts (see auth.py)
+        """CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            hashed_password TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )""",
+    ],
+    [
+        # Scan and per-class scores behind an analysis, for reports (see reports.py)
+        "ALTER TABLE analyses ADD COLUMN image_ref TEXT",
+        "ALTER TABLE analyses ADD COLUMN probabilities TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_analyses_created ON analyses (created_at)",
+    ],
+    [
+        # Notification log: append-only by seq, per-user read cursors, old entries moved to an archive
+        "ALTER TABLE notifications ADD COLUMN level TEXT NOT NULL DEFAULT 'info'",
+        "ALTER TABLE notifications ADD COLUMN patient_id TEXT",
+        """CREATE TABLE IF NOT EXISTS notifications_archive (
+            seq INTEGER PRIMARY KEY,
+            id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            level TEXT NOT NULL,
+            patient_id TEXT,
+            archived_at TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS notification_cursors (
+            username TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL
+        )""",
+    ],
+    [
+        # Which eye an analysis is of, and per patient/eye trend summaries updated on every insert
+        "ALTER TABLE analyses ADD COLUMN eye TEXT",
+        "UPDATE analyses SET eye = (SELECT eye FROM patients WHERE patients.patient_id = analyses.patient_id)",
+        "CREATE INDEX IF NOT EXISTS idx_analyses_patient_eye ON analyses (patient_id, eye, created_at)",
+        """CREATE TABLE IF NOT EXISTS patient_trends (
+            patient_id TEXT NOT NULL,
+            eye TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            detections INTEGER NOT NULL,
+            first_at TEXT NOT NULL,
+            last_at TEXT NOT NULL,
+            last_high_risk_at TEXT,
+            points TEXT NOT NULL,
+            PRIMARY KEY (patient_id, eye)
+        )""",
+    ],
+    [
+        # Explainability heatmap of the analysis (see heatmaps.py)
+        "ALTER TABLE analyses ADD COLUMN heatmap_ref TEXT",
+    ],
+    [
+        # How far the Parquet analytics export has got (see analytics.py)
+        """CREATE TABLE IF NOT EXISTS export_watermarks (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )""",
+    ],
+]
+
+# Schema version that introduced patient_trends; databases upgraded past it get their trends rebuilt
+TRENDS_VERSION = 7
+
+
+class ConnectionPool:
+    """A fixed number of SQLite connections handed out one thread at a time."""
+
+    def __init__(self, path: str, size: int = 8):
+        self.path = path
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+
+class Repository:
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE so concurrent writers queue up instead of losing updates."""
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    @contextmanager
+    def reader(self):
+        with self.pool.connection() as conn:
+            yield conn
+
+
+class PatientRepository(Repository):
+    def create(self, patient: Patient) -> bool:
+        """Insert a patient; returns False if the ID is already taken."""
+        try:
+            with self.transaction() as conn:
+                conn.execute(
+                    "INSERT INTO patients (patient_id, scan_date, eye) VALUES (?, ?, ?)",
+                    (patient.patient_id, patient.scan_date.isoformat(), patient.eye),
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def get(self, patient_id: str) -> Optional[Patient]:
+        with self.reader() as conn:
+            row = conn.execute("SELECT * FROM patients WHERE patient_id = ?", (patient_id,)).fetchone()
+        return patient_from_row(row) if row else None
+
+    def exists(self, patient_id: str) -> bool:
+        with self.reader() as conn:
+            row = conn.execute("SELECT 1 FROM patients WHERE patient_id = ?", (patient_id,)).fetchone()
+        return row is not None
+
+
+class AnalysisRepository(Repository):
+    def add(self, analysis: AnalysisResult) -> AnalysisResult:
+        """Append an analysis; earlier analyses for the patient are kept.
+
+        The patient's trend summary for that eye is updated in the same transaction.
+        """
+        analysis.created_at = analysis.created_at or datetime.now()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT scan_date, eye FROM patients WHERE patient_id = ?",
+                               (analysis.patient_id,)).fetchone()
+            analysis.eye = analysis.eye or (row["eye"] if row else None)
+            cursor = conn.execute(
+                "INSERT INTO analyses (patient_id, diagnosis, confidence, details, scan_date, created_at, "
+                "image_ref, probabilities, eye, heatmap_ref) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (analysis.patient_id, analysis.diagnosis, analysis.confidence, analysis.details,
+                 row["scan_date"] if row else None, analysis.created_at.isoformat(), analysis.image_ref,
+                 json.dumps(analysis.probabilities) if analysis.probabilities is not None else None, analysis.eye,
+                 analysis.heatmap_ref),
+            )
+            analysis.id = cursor.lastrowid
+            if analysis.eye:
+                update_trend(conn, analysis)
+        return analysis
+
+    def for_patient(self, patient_id: str, limit: Optional[int] = None) -> List[AnalysisResult]:
+        """Analyses for a patient, newest first; all of them unless ``limit`` is given."""
+        with self.reader() as conn:
+            rows = conn.execute(
+                "SELECT * FROM analyses WHERE patient_id = ? ORDER BY created_at DESC, id DESC LIMIT ?",
+                (patient_id, limit if limit is not None else -1),
+            ).fetchall()
+        return [analysis_from_row(row) for row in rows]
+
+    def timeline(self, patient_id: str, eye: str, before: Optional[tuple] = None,
+                 limit: int = 25) -> List[AnalysisResult]:
+        """One page of a patient's analyses of one eye, newest first.
+
+        ``before`` is the ``(created_at, id)`` of the last row of the previous page.
+        """
+        created_at, analysis_id = before or (datetime.max, 2 ** 63 - 1)
+        with self.reader() as conn:
+            rows = conn.execute(
+                "SELECT * FROM analyses WHERE patient_id = ? AND eye = ? AND (created_at, id) < (?, ?) "
+                "ORDER BY created_at DESC, id DESC LIMIT ?",
+                (patient_id, eye, created_at.isoformat(), analysis_id, limit),
+            ).fetchall()
+        return [analysis_from_row(row) for row in rows]
+
+    def latest(self, patient_id: str) -> Optional[AnalysisResult]:
+        with self.reader() as conn:
+            row = conn.execute(
+                "SELECT * FROM analyses WHERE patient_id = ? ORDER BY created_at DESC, id DESC LIMIT 1", (patient_id,)
+            ).fetchone()
+        return analysis_from_row(row) if row else None
+
+    def patients_on(self, day: date) -> List[str]:
+        """Patients with at least one analysis created on ``day``, in order of their first one."""
+        with self.reader() as conn:
+            rows = conn.execute(
+                "SELECT patient_id FROM analyses WHERE created_at BETWEEN ? AND ? "
+                "GROUP BY patient_id ORDER BY MIN(created_at)",
+                (datetime.combine(day, time.min).isoformat(), datetime.combine(day, time.max).isoformat()),
+            ).fetchall()
+        return [row["patient_id"] for row in rows]
+
+
+class TrendRepository(Repository):
+    """Per patient/eye summaries (see trends.py), written alongside each analysis."""
+
+    def get(self, patient_id: str, eye: str) -> Optional[TrendSummary]:
+        with self.reader() as conn:
+            row = conn.execute("SELECT * FROM patient_trends WHERE patient_id = ? AND eye = ?",
+                               (patient_id, eye)).fetchone()
+        return trend_from_row(row) if row else None
+
+    def for_patient(self, patient_id: str) -> List[TrendSummary]:
+        with self.reader() as conn:
+            rows = conn.execute("SELECT * FROM patient_trends WHERE patient_id = ? ORDER BY eye",
+                                (patient_id,)).fetchall()
+        return [trend_from_row(row) for row in rows]
+
+    def rebuild(self):
+        """Recompute every summary from the analyses table, e.g. after a bulk import."""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM patient_trends")
+            # Walks idx_analyses_patient_eye, so only one summary is held at a time
+            summary = None
+            for row in conn.execute("SELECT * FROM analyses WHERE eye IS NOT NULL "
+                                    "ORDER BY patient_id, eye, created_at, id"):
+                analysis = analysis_from_row(row)
+                if summary is None or (summary.patient_id, summary.eye) != (analysis.patient_id, analysis.eye):
+                    if summary is not None:
+                        _save_trend(conn, summary)
+                    summary = TrendSummary(patient_id=analysis.patient_id, eye=analysis.eye)
+                summary.add(analysis)
+            if summary is not None:
+                _save_trend(conn, summary)
+
+
+class NotificationRepository(Repository):
+    """Append-only log ordered by ``seq``; readers page through it with cursors."""
+
+    def __init__(self, pool: ConnectionPool, keep: int = config.NOTIFICATION_KEEP):
+        super().__init__(pool)
+        self.keep = keep
+
+    def add(self, notification: Notification) -> Notification:
+        """Append; once more than ``keep`` entries are live, the oldest move to the archive."""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO notifications (id, message, timestamp, level, patient_id) VALUES (?, ?, ?, ?, ?)",
+                (notification.id, notification.message, notification.timestamp.isoformat(),
+                 notification.level, notification.patient_id),
+            )
+            notification.seq = cursor.lastrowid
+            cutoff = notification.seq - self.keep
+            if cutoff > 0:
+                # Usually moves a single row; seq is the primary key, so both are range scans
+                conn.execute(
+                    "INSERT OR IGNORE INTO notifications_archive "
+                    "(seq, id, message, timestamp, level, patient_id, archived_at) "
+                    "SELECT seq, id, message, timestamp, level, patient_id, ? FROM notifications WHERE seq <= ?",
+                    (datetime.now().isoformat(), cutoff),
+                )
+                conn.execute("DELETE FROM notifications WHERE seq <= ?", (cutoff,))
+        return notification
+
+    def since(self, seq: int, limit: int = 100) -> List[Notification]:
+        """The newest ``limit`` entries after ``seq``, oldest first."""
+        with self.reader() as conn:
+            rows = conn.execute(
+                "SELECT * FROM (SELECT * FROM notifications WHERE seq > ? ORDER BY seq DESC LIMIT ?) ORDER BY seq",
+                (seq, limit),
+            ).fetchall()
+        return [notification_from_row(row) for row in rows]
+
+    def recent(self, limit: int = 50, before: Optional[int] = None) -> List[Notification]:
+        """The newest entries (older than ``before`` if given), newest first."""
+        with self.reader() as conn:
+            rows = conn.execute(
+                "SELECT * FROM notifications WHERE seq < ? ORDER BY seq DESC LIMIT ?",
+                (before if before is not None else 2 ** 63 - 1, limit),
+            ).fetchall()
+        return [notification_from_row(row) for row in rows]
+
+    def latest_seq(self) -> int:
+        with self.reader() as conn:
+            return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM notifications").fetchone()[0]
+
+    # Read cursors
+    def read_cursor(self, username: str) -> int:
+        with self.reader() as conn:
+            row = conn.execute("SELECT last_seq FROM notification_cursors WHERE username = ?", (username,)).fetchone()
+        return row["last_seq"] if row else 0
+
+    def mark_read(self, username: str, seq: int):
+        """Move the user's cursor forward to ``seq``; it never moves back."""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO notification_cursors (username, last_seq) VALUES (?, ?) "
+                "ON CONFLICT (username) DO UPDATE SET last_seq = MAX(last_seq, excluded.last_seq)",
+                (username, seq),
+            )
+
+    def unread_count(self, username: str) -> int:
+        """Bounded by ``keep``, since archived entries are never unread."""
+        with self.reader() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM notifications WHERE seq > "
+                "COALESCE((SELECT last_seq FROM notification_cursors WHERE username = ?), 0)",
+                (username,),
+            ).fetchone()[0]
+
+
+class Database:
+    def __init__(self, path: str = config.DATABASE_PATH, pool_size: int = config.DATABASE_POOL_SIZE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.pool = ConnectionPool(path, pool_size)
+        version = self.migrate()
+        self.patients = PatientRepository(self.pool)
+        self.analyses = AnalysisRepository(self.pool)
+        self.notifications = NotificationRepository(self.pool)
+        self.trends = TrendRepository(self.pool)
+        if 0 < version < TRENDS_VERSION:
+            self.trends.rebuild()
+
+    def migrate(self) -> int:
+        """Bring the schema up to date; returns the version it started from."""
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version = {number}")
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+        return version
+
+
+def update_trend(conn: sqlite3.Connection, analysis: AnalysisResult):
+    row = conn.execute("SELECT * FROM patient_trends WHERE patient_id = ? AND eye = ?",
+                       (analysis.patient_id, analysis.eye)).fetchone()
+    summary = trend_from_row(row) if row else TrendSummary(patient_id=analysis.patient_id, eye=analysis.eye)
+    summary.add(analysis)
+    _save_trend(conn, summary)
+
+
+def _save_trend(conn: sqlite3.Connection, summary: TrendSummary):
+    conn.execute(
+        "INSERT OR REPLACE INTO patient_trends "
+        "(patient_id, eye, count, detections, first_at, last_at, last_high_risk_at, points) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (summary.patient_id, summary.eye, summary.count, summary.detections, summary.first_at.isoformat(),
+         summary.last_at.isoformat(),
+         summary.last_high_risk_at.isoformat() if summary.last_high_risk_at else None, summary.points_json()),
+    )
+
+
+def trend_from_row(row) -> TrendSummary:
+    return TrendSummary(
+        patient_id=row["patient_id"], eye=row["eye"], count=row["count"], detections=row["detections"],
+        first_at=datetime.fromisoformat(row["first_at"]), last_at=datetime.fromisoformat(row["last_at"]),
+        last_high_risk_at=datetime.fromisoformat(row["last_high_risk_at"]) if row["last_high_risk_at"] else None,
+        points=points_from_json(row["points"]),
+    )
+
+
+def notification_from_row(row) -> Notification:
+    return Notification(
+        id=row["id"], message=row["message"], timestamp=datetime.fromisoformat(row["timestamp"]),
+        level=row["level"], patient_id=row["patient_id"], seq=row["seq"],
+    )
+
+
+def patient_from_row(row) -> Patient:
+    return Patient(patient_id=row["patient_id"], scan_date=datetime.fromisoformat(row["scan_date"]), eye=row["eye"])
+
+
+def analysis_from_row(row) -> AnalysisResult:
+    return AnalysisResult(
+        patient_id=row["patient_id"], diagnosis=row["diagnosis"], confidence=row["confidence"],
+        details=row["details"], id=row["id"], created_at=datetime.fromisoformat(row["created_at"]),
+        image_ref=row["image_ref"],
+        probabilities=json.loads(row["probabilities"]) if row["probabilities"] else None, eye=row["eye"],
+        heatmap_ref=row["heatmap_ref"],
+    )
+
+
+_database = None
+_database_lock = threading.Lock()
+
+
+def get_database() -> Database:
+    global _database
+    with _database_lock:
+        if _database is None:
+            _database = Database()
+        return _database
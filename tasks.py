@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+from datetime import date
+from uuid import uuid4
+
+import config
+from image_store import get_image_store
+from jobs import JobQueue
+from storage import get_database
+
+BATCH_PROGRESS_SECONDS = 0.5
+
+
+# Job handlers
+def analyze_scan(payload: dict, report) -> dict:
+    """Classify a stored scan; ``payload['volume']`` selects per-slice volume analysis."""
+    from heatmaps import get_heatmap_store
+    from inference import STAGES, get_engine, is_placeholder
+    from notifications import alert_if_high_risk
+    from preprocessing import get_tensor_cache
+    from result_cache import get_result_cache
+    from volumes import OCTVolume, analyze_volume, slice_png
+
+    store = get_image_store()
+    engine = get_engine(payload.get('model_version'))
+    image_ref = payload['image_ref']
+    if payload.get('volume'):
+        volume = OCTVolume(store.path(image_ref))
+        try:
+            result = analyze_volume(volume, engine,
+                                    on_slice=lambda done, total: report(done / total, f"B-scan {done}/{total}"),
+                                    image_ref=image_ref, tensors=get_tensor_cache())
+            thumbnail_ref = store.put(slice_png(volume, result.worst_slice))
+        finally:
+            volume.close()
+        heatmap_ref = None
+        if result.heatmap is not None:
+            heatmap_ref = get_heatmap_store().put(result.heatmap, image_ref, result.model_version, result.worst_slice)
+        alert_if_high_risk(get_database(), result.label, result.confidence, source=f"volume {image_ref[:12]}",
+                           placeholder=is_placeholder(result.model_version))
+        return {
+            'prediction': {'label': result.label, 'confidence': result.confidence,
+                           'probabilities': result.probabilities, 'model_version': result.model_version,
+                           'heatmap_ref': heatmap_ref},
+            'thumbnail_ref': thumbnail_ref,
+            'volume': {'num_slices': result.num_slices, 'abnormal_slices': result.abnormal_slices,
+                       'worst_slice': result.worst_slice, 'slice_confidences': result.slice_confidences},
+        }
+
+    def on_stage(stage):
+        report(STAGES.index(stage) / len(STAGES), stage.capitalize())
+
+    prediction = engine.analyze(store.get(image_ref), image_ref, cache=get_result_cache(), on_stage=on_stage,
+                                tensors=get_tensor_cache(), heatmaps=get_heatmap_store())
+    alert_if_high_risk(get_database(), prediction.label, prediction.confidence, source=f"scan {image_ref[:12]}",
+                       placeholder=is_placeholder(prediction.model_version))
+    return {'prediction': prediction.to_dict()}
+
+
+def analyze_batch(payload: dict, report) -> dict:
+    """Classify a batch of scans for one patient, recording each result as soon as its batch is done.
+
+    Scans come from ``payload['sources']`` (uploads already in the content
+    store, zips included) or ``payload['directory']`` under the upload folder.
+    """
+    from batch import Throughput, count_stored, items_from_directory, items_from_store, run_batch
+    from inference import get_engine
+    from services import record_prediction
+
+    db = get_database()
+    patient_id = payload['patient_id']
+    if payload.get('directory') is not None:
+        items = list(items_from_directory(payload['directory']))
+        total = len(items)
+    else:
+        store = get_image_store()
+        total = count_stored(payload['sources'], store)
+        items = items_from_store(payload['sources'], store)
+
+    rows = []
+    throughput = Throughput()
+    last_report = 0.0
+
+    def on_result(item):
+        nonlocal last_report
+        throughput.tick()
+        if item.error:
+            rows.append({'file': item.name, 'status': 'failed', 'result': item.error})
+        else:
+            prediction = item.prediction
+            record_prediction(db, patient_id, item.name, item.image_ref, prediction)
+            rows.append({'file': item.name, 'status': 'done',
+                         'result': f"{prediction.label} ({prediction.confidence:.1f}%)"})
+        # Progress is written at most a few times a second, not once per scan
+        now = time.monotonic()
+        if now - last_report >= BATCH_PROGRESS_SECONDS or throughput.count == total:
+            last_report = now
+            report(min(throughput.count / max(total, 1), 1.0),
+                   f"{throughput.count}/{total} scans, {throughput.per_second:.1f} scans/s")
+
+    report(0.0, f"0/{total} scans")
+    run_batch(items, get_engine(), on_result)
+    failed = sum(1 for row in rows if row['status'] == 'failed')
+    return {'analysed': throughput.count - failed, 'failed': failed,
+            'scans_per_second': throughput.per_second, 'rows': rows}
+
+
+def render_report(payload: dict, report) -> dict:
+    """One patient's report; reused as-is if none of its analyses changed since last time."""
+    from services import patient_report
+
+    patient_id = payload['patient_id']
+    report(0.0, "Rendering")
+    path = patient_report(get_database(), patient_id)
+    return {'path': path, 'filename': f"report_{patient_id}.pdf"}
+
+
+def export_reports(payload: dict, report) -> dict:
+    """Every patient analysed on ``payload['day']``, as a zip of PDFs or one combined PDF."""
+    from reports import render_many, write_combined_pdf, write_zip
+
+    day = date.fromisoformat(payload['day'])
+    db = get_database()
+    patient_ids = db.analyses.patients_on(day)
+    if not patient_ids:
+        return {'path': None, 'count': 0}
+
+    def counted(paths):
+        for number, path in enumerate(paths, start=1):
+            report(number / len(patient_ids), f"Report {number}/{len(patient_ids)}")
+            yield path
+
+    extension = 'zip' if payload.get('format') == 'zip' else 'pdf'
+    path = os.path.join(config.REPORT_DIR, "exports", f"clinic_{day.isoformat()}_{uuid4().hex}.{extension}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written straight to disk as it is produced, then moved into place
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        if extension == 'zip':
+            write_zip(counted(render_many(patient_ids)), f)
+        else:
+            write_combined_pdf(db, counted(patient_ids), f)
+    os.replace(tmp_path, path)
+    return {'path': path, 'count': len(patient_ids), 'filename': f"reports_{day.isoformat()}.{extension}",
+            'mime': 'application/zip' if extension == 'zip' else 'application/pdf'}
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Process-wide queue with the app's handlers registered and workers running."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(get_database())
+            _queue.register('analyze', analyze_scan)
+            _queue.register('batch', analyze_batch)
+            _queue.register('report', render_report)
+            _queue.register('report_export', export_reports)
+            _queue.start()
+        return _queue
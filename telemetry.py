@@ -0,0 +1,226 @@
+import bisect
+import functools
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+import config
+
+# Upper bounds in seconds, log-spaced from 0.5 ms to 60 s
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram, as Prometheus exposes them."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th quantile (0-1), capped at the max seen."""
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets + (self.max,), self.counts):
+                seen += count
+                if seen >= rank:
+                    return min(bound, self.max)
+            return self.max
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            count, total, peak = self.count, self.sum, self.max
+        return {"count": count, "mean_ms": total / count * 1000 if count else 0.0,
+                "p50_ms": _ms(self.quantile(0.5)), "p95_ms": _ms(self.quantile(0.95)),
+                "p99_ms": _ms(self.quantile(0.99)), "max_ms": peak * 1000}
+
+
+class Registry:
+    def __init__(self):
+        self._histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            items = sorted(self._histograms.items())
+        return {name: histogram.snapshot() for name, histogram in items}
+
+    def prometheus(self) -> str:
+        """Text exposition format: one ``retinaview_span_seconds`` histogram per span name."""
+        lines = ["# HELP retinaview_span_seconds Time spent in instrumented spans",
+                 "# TYPE retinaview_span_seconds histogram"]
+        with self._lock:
+            items = sorted(self._histograms.items())
+        for name, histogram in items:
+            with histogram._lock:
+                counts, count, total = list(histogram.counts), histogram.count, histogram.sum
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'retinaview_span_seconds_bucket{{span="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'retinaview_span_seconds_sum{{span="{name}"}} {total}')
+            lines.append(f'retinaview_span_seconds_count{{span="{name}"}} {count}')
+        rss = process_rss()
+        if rss is not None:
+            lines += ["# TYPE process_resident_memory_bytes gauge", f"process_resident_memory_bytes {rss}"]
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# Spans
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+def span(name: str):
+    """``with span("upload.write"):`` records the block's duration, or does nothing when tracing is off."""
+    if not config.TRACING:
+        return _NULL_SPAN
+    return _Span(registry.histogram(name))
+
+
+def traced(name: str):
+    """Decorator form of ``span``; with tracing off the function is returned unwrapped."""
+    def decorate(function):
+        if not config.TRACING:
+            return function
+        histogram = registry.histogram(name)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+# Prometheus textfile dump
+def dump(path: str = config.METRICS_PATH):
+    from image_store import atomic_write
+
+    atomic_write(path, registry.prometheus().encode())
+
+
+def start_dumping(path: str = config.METRICS_PATH, interval: float = config.METRICS_INTERVAL) -> Optional[threading.Thread]:
+    """Rewrite ``path`` every ``interval`` seconds, for node_exporter's textfile collector or similar."""
+    if not (config.TRACING and path and interval > 0):
+        return None
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                dump(path)
+            except OSError:
+                pass
+
+    thread = threading.Thread(target=loop, name="metrics-dump", daemon=True)
+    thread.start()
+    return thread
+
+
+# Memory
+def process_rss() -> Optional[int]:
+    """Current resident set size in bytes (Linux), else the peak from getrusage."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return None
+
+
+def deep_sizeof(obj, _seen: Optional[set] = None) -> int:
+    """Approximate bytes reachable from ``obj``: containers, object attributes and NumPy buffers."""
+    seen = _seen if _seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    nbytes = getattr(obj, "nbytes", None)
+    if isinstance(nbytes, int) and hasattr(obj, "dtype"):
+        # Memory-mapped and view arrays don't own their buffer
+        return sys.getsizeof(obj) if getattr(obj, "base", None) is not None else sys.getsizeof(obj) + nbytes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool, type(None))):
+        return size
+    if isinstance(obj, dict):
+        return size + sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(deep_sizeof(item, seen) for item in obj)
+    if hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    for slot in getattr(type(obj), "__slots__", ()):
+        if hasattr(obj, slot):
+            size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+
+def session_memory(state) -> List[dict]:
+    """Estimated size of each session-state entry, largest first."""
+    sizes = [{"key": key, "bytes": deep_sizeof(value)} for key, value in state.items()]
+    return sorted(sizes, key=lambda entry: -entry["bytes"])
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return seconds * 1000 if seconds is not None else None
@@ -0,0 +1,90 @@
+import bisect
+import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List, Optional
+
+import config
+from models import AnalysisResult
+
+
+def is_high_risk(diagnosis: str, confidence: float) -> bool:
+    return diagnosis.lower() != "normal" and confidence > config.HIGH_RISK_CONFIDENCE
+
+
+@dataclass
+class TrendPoint:
+    analysis_id: Optional[int]
+    created_at: datetime
+    diagnosis: str
+    confidence: float
+
+    @property
+    def has_detection(self) -> bool:
+        return self.diagnosis.lower() != "normal"
+
+
+@dataclass
+class TrendSummary:
+    """One patient's analyses of one eye, summarised so a timeline needs no scan over them.
+
+    ``points`` holds the newest ``config.TREND_POINTS`` results, oldest first;
+    the counters and timestamps cover every analysis ever added.
+    """
+
+    patient_id: str
+    eye: str
+    count: int = 0
+    detections: int = 0
+    first_at: Optional[datetime] = None
+    last_at: Optional[datetime] = None
+    last_high_risk_at: Optional[datetime] = None
+    points: List[TrendPoint] = field(default_factory=list)
+
+    def add(self, analysis: AnalysisResult, keep: int = config.TREND_POINTS):
+        created_at = analysis.created_at
+        point = TrendPoint(analysis.id, created_at, analysis.diagnosis, analysis.confidence)
+        self.count += 1
+        self.detections += point.has_detection
+        self.first_at = min(self.first_at, created_at) if self.first_at else created_at
+        self.last_at = max(self.last_at, created_at) if self.last_at else created_at
+        if is_high_risk(analysis.diagnosis, analysis.confidence):
+            self.last_high_risk_at = max(self.last_high_risk_at, created_at) if self.last_high_risk_at else created_at
+        # Back-dated imports land in order; anything older than the window falls off the front
+        keys = [(p.created_at, p.analysis_id or 0) for p in self.points]
+        self.points.insert(bisect.bisect(keys, (created_at, analysis.id or 0)), point)
+        del self.points[:-keep]
+
+    @property
+    def latest(self) -> Optional[TrendPoint]:
+        return self.points[-1] if self.points else None
+
+    @property
+    def previous(self) -> Optional[TrendPoint]:
+        return self.points[-2] if len(self.points) > 1 else None
+
+    @property
+    def confidence_delta(self) -> Optional[float]:
+        """Change in confidence since the visit before the latest."""
+        if self.previous is None:
+            return None
+        return self.latest.confidence - self.previous.confidence
+
+    @property
+    def diagnosis_changed(self) -> bool:
+        return self.previous is not None and self.previous.diagnosis != self.latest.diagnosis
+
+    def since_high_risk(self, now: Optional[datetime] = None):
+        """Time since the most recent High Risk result, or None if there never was one."""
+        if self.last_high_risk_at is None:
+            return None
+        return (now or datetime.now()) - self.last_high_risk_at
+
+    def points_json(self) -> str:
+        return json.dumps([[p.analysis_id, p.created_at.isoformat(), p.diagnosis, p.confidence]
+                           for p in self.points], separators=(",", ":"))
+
+
+def points_from_json(text: str) -> List[TrendPoint]:
+    return [TrendPoint(analysis_id, datetime.fromisoformat(created_at), diagnosis, confidence)
+            for analysis_id, created_at, diagnosis, confidence in json.loads(text)]
@@ -0,0 +1,46 @@
+import os
+import shutil
+from dataclasses import dataclass
+
+from image_store import CHUNK_SIZE, ImageStore, get_image_store
+from telemetry import traced
+
+
+@dataclass
+class SavedUpload:
+    filename: str
+    path: str
+    digest: str
+    size: int
+    deduplicated: bool
+
+
+@traced("upload.write")
+def save_upload(fileobj, filename: str, folder: str, store: ImageStore = None,
+                chunk_size: int = CHUNK_SIZE) -> SavedUpload:
+    """Stream an upload into the content store and link it into ``folder``.
+
+    The bytes are stored once per distinct content; the per-patient file is a
+    hard link to that copy (falling back to a symlink, then a plain copy).
+    """
+    store = store or get_image_store()
+    digest, size, is_new = store.put_stream(fileobj, chunk_size)
+    os.makedirs(folder, exist_ok=True)
+    name = f"{digest[:16]}_{os.path.basename(filename)}"
+    path = os.path.join(folder, name)
+    if os.path.exists(path):
+        return SavedUpload(filename=name, path=path, digest=digest, size=size, deduplicated=True)
+    _link(store.path(digest), path)
+    return SavedUpload(filename=name, path=path, digest=digest, size=size, deduplicated=not is_new)
+
+
+def _link(source: str, target: str):
+    tmp_target = f"{target}.tmp-{os.getpid()}"
+    try:
+        os.link(source, tmp_target)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source), tmp_target)
+        except OSError:
+            shutil.copyfile(source, tmp_target)
+    os.replace(tmp_target, target)
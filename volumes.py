@@ -0,0 +1,188 @@
+import mmap
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from inference import CLASSES, InferenceEngine, Prediction
+from preprocessing import VOLUME, preprocess_batch
+from telemetry import traced
+
+DICOM_MAGIC_OFFSET = 128
+TIFF_MAGICS = (b'II*\x00', b'MM\x00*')
+
+
+class OCTVolume:
+    """A stack of B-scans read from a memory-mapped file, decoded one slice at a time.
+
+    Only the slices requested (plus a few recently used ones) are held in memory;
+    the rest of the file stays in the OS page cache.
+    """
+
+    def __init__(self, path: str, cached_slices: int = 4):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cached_slices = cached_slices
+        header = self._mmap[:DICOM_MAGIC_OFFSET + 4]
+        if header[DICOM_MAGIC_OFFSET:DICOM_MAGIC_OFFSET + 4] == b'DICM':
+            self.format = 'dicom'
+            self._open_dicom()
+        else:
+            self.format = 'tiff' if header[:4] in TIFF_MAGICS else 'image'
+            self._open_pillow()
+
+    def _open_pillow(self):
+        from PIL import Image
+
+        # Pillow reads through the mmap, so seeking to a page only touches that page's strips
+        self._image = Image.open(self._mmap)
+        self._frames = None
+        self.num_slices = getattr(self._image, 'n_frames', 1)
+
+    def _open_dicom(self):
+        import pydicom
+
+        dataset = pydicom.dcmread(self.path, defer_size=1024)
+        self.num_slices = int(dataset.get('NumberOfFrames', 1) or 1)
+        rows, cols = int(dataset.Rows), int(dataset.Columns)
+        self._image = None
+        if not dataset.file_meta.TransferSyntaxUID.is_compressed:
+            pixel_element = dataset.get_item(0x7FE00010)
+            # Raw elements (pydicom 2) carry value_tell; converted ones (pydicom 3) carry file_tell
+            offset = getattr(pixel_element, 'value_tell', None)
+            if offset is None:
+                offset = pixel_element.file_tell
+            dtype = np.dtype(f"{'<' if dataset.file_meta.TransferSyntaxUID.is_little_endian else '>'}"
+                             f"{'i' if dataset.get('PixelRepresentation', 0) else 'u'}{int(dataset.BitsAllocated) // 8}")
+            self._frames = np.memmap(self.path, dtype=dtype, mode='r', offset=offset,
+                                     shape=(self.num_slices, rows, cols))
+        else:
+            # Encapsulated (compressed) pixel data cannot be mapped; decode it once
+            self._frames = dataset.pixel_array.reshape(self.num_slices, rows, cols)
+
+    def __len__(self) -> int:
+        return self.num_slices
+
+    def get_slice(self, index: int) -> np.ndarray:
+        """Slice ``index`` as 8-bit grayscale."""
+        if not 0 <= index < self.num_slices:
+            raise IndexError(f"slice {index} out of range for {self.num_slices} slices")
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+            if self._frames is not None:
+                pixels = _to_uint8(np.asarray(self._frames[index]))
+            else:
+                self._image.seek(index)
+                frame = self._image.convert('L') if self._image.mode in ('P', 'LA', 'RGBA') else self._image
+                pixels = _to_uint8(np.asarray(frame))
+            self._cache[index] = pixels
+            if len(self._cache) > self._cached_slices:
+                self._cache.popitem(last=False)
+            return pixels
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+            if self._image is not None:
+                self._image.close()
+            self._frames = None
+            self._mmap.close()
+            self._file.close()
+
+
+def _to_uint8(pixels: np.ndarray) -> np.ndarray:
+    if pixels.ndim == 3:
+        pixels = pixels.mean(axis=2)
+    if pixels.dtype == np.uint8:
+        return pixels
+    pixels = pixels.astype(np.float32)
+    low, high = float(pixels.min()), float(pixels.max())
+    scale = 255.0 / (high - low) if high > low else 0.0
+    return ((pixels - low) * scale).astype(np.uint8)
+
+
+@dataclass
+class VolumeResult:
+    label: str
+    confidence: float
+    has_detection: bool
+    model_version: str
+    num_slices: int
+    abnormal_slices: int
+    worst_slice: int
+    slice_labels: List[str] = field(default_factory=list)
+    slice_confidences: List[float] = field(default_factory=list)
+    probabilities: dict = field(default_factory=dict)
+    heatmap: Optional[np.ndarray] = field(default=None, repr=False)  # of the worst slice
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__dataclass_fields__ if k != 'heatmap'}
+
+
+@traced('analysis.volume')
+def analyze_volume(volume: OCTVolume, engine: InferenceEngine,
+                   on_slice: Optional[Callable[[int, int], None]] = None,
+                   image_ref: Optional[str] = None, tensors=None) -> VolumeResult:
+    """Classify every slice in engine-sized chunks and aggregate to one result.
+
+    The volume is abnormal if any slice is; it takes the label and confidence of
+    the most confident abnormal slice. Per-class probabilities are the maximum
+    over slices, so a lesion visible on a few B-scans is not averaged away.
+    With a tensor cache and the volume's hash, the preprocessed (slices, H, W)
+    stack is stored once and later runs read it instead of decoding slices.
+    """
+    cached = tensors.get(image_ref, VOLUME) if tensors is not None and image_ref else None
+    if cached is not None and len(cached) != len(volume):
+        cached = None
+    predictions: List[Prediction] = []
+    chunks = []
+    for start in range(0, len(volume), engine.max_batch):
+        stop = min(start + engine.max_batch, len(volume))
+        if cached is not None:
+            batch = cached[start:stop]
+        else:
+            # Slices share a shape, so each chunk is preprocessed in one vectorized pass
+            batch = preprocess_batch(np.stack([volume.get_slice(i) for i in range(start, stop)]))
+            chunks.append(batch)
+        predictions.extend(engine.predict_many(list(batch)))
+        if on_slice:
+            on_slice(len(predictions), len(volume))
+    if chunks and tensors is not None and image_ref:
+        tensors.put(image_ref, np.concatenate(chunks), VOLUME)
+
+    abnormal = [i for i, p in enumerate(predictions) if p.has_detection]
+    if abnormal:
+        worst = max(abnormal, key=lambda i: predictions[i].confidence)
+    else:
+        worst = min(range(len(predictions)), key=lambda i: predictions[i].confidence)
+    probabilities = {c: max(p.probabilities.get(c, 0.0) for p in predictions) for c in CLASSES}
+    return VolumeResult(
+        label=predictions[worst].label,
+        confidence=predictions[worst].confidence,
+        has_detection=bool(abnormal),
+        model_version=engine.model_version,
+        num_slices=len(predictions),
+        abnormal_slices=len(abnormal),
+        worst_slice=worst,
+        slice_labels=[p.label for p in predictions],
+        slice_confidences=[p.confidence for p in predictions],
+        probabilities=probabilities,
+        heatmap=predictions[worst].heatmap,
+    )
+
+
+def slice_png(volume: OCTVolume, index: int) -> bytes:
+    from io import BytesIO
+
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.fromarray(volume.get_slice(index)).save(buffer, format='PNG')
+    return buffer.getvalue()